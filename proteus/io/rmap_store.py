@@ -0,0 +1,229 @@
+__author__ = 'Christian Dansereau'
+
+import numpy as np
+import h5py
+
+
+class RmapStore(object):
+    '''
+    Consolidated cohort store of the seed maps in a single HDF5 file
+    The datasets are contiguous (no chunking, no compression) and seed major, so that reading
+    "seed k for all subjects" is one contiguous read and the file can be memory-mapped.
+        avg_data        (seeds x subjects x voxels)
+        dynamic_data    (seeds x windows x voxels), the windows of all the subjects stacked
+        dynamic_offsets (subjects + 1) first window of each subject in dynamic_data
+        subject_ids     (subjects)
+    '''
+
+    def __init__(self, file_name, mode='r'):
+        self.file_name = file_name
+        self.hf = h5py.File(file_name, mode)
+        self.subject_ids = [_to_str(sid) for sid in self.hf['subject_ids'][:]]
+        self.dynamic_offsets = self.hf['dynamic_offsets'][:]
+        self._index = dict((sid, ii) for ii, sid in enumerate(self.subject_ids))
+        self._memmaps = {}
+
+    @classmethod
+    def create(cls, file_name, subject_ids, n_seeds, n_vox, n_windows=None, dtype=np.float32):
+        '''
+            Allocate an empty store
+            n_windows: number of dynamic windows of each subject (None for a static store)
+        '''
+        subject_ids = [str(sid) for sid in subject_ids]
+        if n_windows is None:
+            n_windows = np.zeros(len(subject_ids), dtype=int)
+        offsets = np.hstack(([0], np.cumsum(n_windows))).astype(np.int64)
+        with h5py.File(file_name, 'w') as hf:
+            hf.create_dataset('subject_ids', data=np.array(subject_ids, dtype='S'))
+            hf.create_dataset('dynamic_offsets', data=offsets)
+            _create_contiguous(hf, 'avg_data', (n_seeds, len(subject_ids), n_vox), dtype)
+            _create_contiguous(hf, 'dynamic_data', (n_seeds, offsets[-1], n_vox), dtype)
+        return cls(file_name, mode='r+')
+
+    def close(self):
+        self._memmaps = {}
+        self.hf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.subject_ids)
+
+    def __getstate__(self):
+        # pickled by file name so that the store can be sent to worker processes
+        return {'file_name': self.file_name}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_name'], mode='r')
+
+    @property
+    def n_seeds(self):
+        return self.hf['avg_data'].shape[0]
+
+    def subject_index(self, subject_list):
+        '''
+            Position of the subjects in the store, raise a ValueError listing the missing subjects
+        '''
+        missing = [sid for sid in subject_list if str(sid) not in self._index]
+        if len(missing):
+            raise ValueError('Subjects not in the store ' + self.file_name + ': ' + str(missing))
+        return np.array([self._index[str(sid)] for sid in subject_list], dtype=int)
+
+    def memmap(self, name='avg_data'):
+        '''
+            Read only memory-mapped numpy view of a dataset
+        '''
+        if name not in self._memmaps:
+            self.hf.flush()
+            dset = self.hf[name]
+            offset = dset.id.get_offset()
+            if offset is None:
+                # nothing written yet
+                return dset[...]
+            self._memmaps[name] = np.memmap(self.file_name, mode='r', dtype=dset.dtype, shape=dset.shape,
+                                            offset=offset)
+        return self._memmaps[name]
+
+    def write_subject(self, subject_id, avg_data, dynamic_data=None):
+        '''
+            avg_data (seeds x voxels)
+            dynamic_data (windows x seeds x voxels) as saved by sbp_util.compute_seed_map
+        '''
+        ii = self._index[str(subject_id)]
+        self.hf['avg_data'][:, ii, :] = avg_data
+        if dynamic_data is not None and len(dynamic_data):
+            start, stop = self.dynamic_offsets[ii], self.dynamic_offsets[ii + 1]
+            self.hf['dynamic_data'][:, start:stop, :] = np.swapaxes(dynamic_data, 0, 1)
+        self.hf.flush()
+
+    def grab(self, subject_list, seed_index, dynamic=False):
+        '''
+            Same output as sbp_util.grab_rmap
+            return avg (subjects x voxels) or [list of dynamic (windows x voxels), avg]
+        '''
+        idx = self.subject_index(subject_list)
+        avg_seed = self.memmap('avg_data')[seed_index]
+        if len(idx) and np.all(np.diff(idx) == 1):
+            avg_data = np.array(avg_seed[idx[0]:idx[-1] + 1])
+        else:
+            avg_data = avg_seed[idx]
+        if not dynamic:
+            return avg_data
+        dyn_seed = self.memmap('dynamic_data')[seed_index]
+        dynamic_data = [np.array(dyn_seed[self.dynamic_offsets[ii]:self.dynamic_offsets[ii + 1]]) for ii in idx]
+        return [dynamic_data, avg_data]
+
+
+def convert_rmaps(subject_list, path, store_file, dtype=np.float32, verbose=True):
+    '''
+        Convert the per-subject seed map files (*_vox_dynamic.h5) in a single RmapStore
+    '''
+    from proteus.io import sbp_util
+    list_files = []
+    for sid in subject_list:
+        files = sbp_util.search_path(path, sid)
+        if len(files) == 0:
+            raise ValueError('No seed map file for subject ' + str(sid) + ' in ' + str(path))
+        if len(files) > 1:
+            raise ValueError('Several seed map files for subject ' + str(sid) + ' in ' + str(path) + ': ' + str(files))
+        list_files.append(files[0])
+    # first pass on the shapes to allocate the store
+    n_windows = []
+    for file_name in list_files:
+        with h5py.File(file_name, 'r') as hf:
+            n_seeds, n_vox = hf['avg_data'].shape
+            if 'dynamic_data' in hf and len(hf['dynamic_data'].shape) == 3:
+                n_windows.append(hf['dynamic_data'].shape[0])
+            else:
+                n_windows.append(0)
+
+    store = RmapStore.create(store_file, subject_list, n_seeds, n_vox, n_windows, dtype=dtype)
+    for ii, file_name in enumerate(list_files):
+        with h5py.File(file_name, 'r') as hf:
+            dynamic_data = hf['dynamic_data'][...] if n_windows[ii] > 0 else None
+            store.write_subject(subject_list[ii], hf['avg_data'][...], dynamic_data)
+        if verbose:
+            print('Converted ' + str(ii + 1) + '/' + str(len(list_files)) + ': ' + file_name)
+    return store
+
+
+def _create_contiguous(hf, name, shape, dtype):
+    # contiguous dataset allocated at creation so that it can be memory-mapped
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_alloc_time(h5py.h5d.ALLOC_TIME_EARLY)
+    space = h5py.h5s.create_simple(tuple(int(d) for d in shape))
+    h5py.h5d.create(hf.id, name.encode('utf-8'), h5py.h5t.py_create(np.dtype(dtype)), space, dcpl=dcpl)
+
+
+def _to_str(sid):
+    if isinstance(sid, bytes):
+        return sid.decode('utf-8')
+    return str(sid)
+
+
+def test_rmap_store():
+    import os
+    import pickle
+    import tempfile
+    import shutil
+    rng = np.random.RandomState(0)
+    subjects = ['s1', 's2', 's3']
+    n_windows = [2, 0, 3]
+    avg = rng.randn(3, 4, 5).astype(np.float32)
+    dyn = [rng.randn(n, 4, 5).astype(np.float32) for n in n_windows]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store = RmapStore.create(os.path.join(tmp_dir, 'store.h5'), subjects, 4, 5, n_windows)
+        for sid, avg_data, dynamic_data in zip(subjects, avg, dyn):
+            store.write_subject(sid, avg_data, dynamic_data)
+        assert len(store) == 3 and store.n_seeds == 4
+        assert np.array_equal(store.grab(subjects, 1), avg[:, 1, :])
+        # subjects out of order
+        dynamic_data, avg_data = store.grab(['s3', 's1'], 2, dynamic=True)
+        assert np.array_equal(avg_data, avg[[2, 0], 2, :])
+        assert np.array_equal(dynamic_data[0], dyn[2][:, 2, :])
+        assert np.array_equal(dynamic_data[1], dyn[0][:, 2, :])
+        assert store.grab(['s2'], 0, dynamic=True)[0][0].shape == (0, 5)
+        try:
+            store.grab(['s1', 's4'], 0)
+        except ValueError as e:
+            assert 's4' in str(e)
+        else:
+            raise AssertionError('missing subject not reported')
+        # pickled by file name for the worker processes
+        copy = pickle.loads(pickle.dumps(store))
+        assert np.array_equal(copy.grab(['s2'], 3), avg[[1], 3, :])
+        copy.close()
+        store.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_convert_rmaps():
+    import os
+    import tempfile
+    import shutil
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, '')
+        avg = {}
+        for sid in ['1', '12']:
+            avg[sid] = rng.randn(2, 5)
+            with h5py.File(path + 'fmri_' + sid + '_2_vox_dynamic.h5', 'w') as hf:
+                hf.create_dataset('avg_data', data=avg[sid])
+        store = convert_rmaps(['12', '1'], path, os.path.join(tmp_dir, 'store.h5'), verbose=False)
+        assert np.allclose(store.grab(['1', '12'], 1), np.vstack((avg['1'][1], avg['12'][1])))
+        store.close()
+        try:
+            convert_rmaps(['1', '2'], path, os.path.join(tmp_dir, 'store2.h5'), verbose=False)
+        except ValueError as e:
+            assert 'subject 2' in str(e)
+        else:
+            raise AssertionError('missing subject not reported')
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -1,13 +1,18 @@
 __author__ = 'Christian Dansereau'
 
-import glob, os
+import os
+import re
 import numpy as np
 import nibabel as nib
 import multiprocessing
 from multiprocessing import Pool
 from ..visu import progress
 from ..predic import prediction
+from ..matrix import tseries as ts
+from ..matrix import Atlas
+from .rmap_store import RmapStore
 import time
+import hashlib
 import h5py
 import util
 
@@ -25,14 +30,133 @@ def grab_dynamic(file_name, seed_index, dynamic, verbose=False):
     return data
 
 
+class PathIndex(object):
+    '''
+    Index of the seed map files of a directory (subject id -> files) built with a single directory listing
+    The subject id is parsed from the file names written by compute_seed_map:
+        <path>fmri_<subject id>_<n seeds>_vox_dynamic.h5
+    the other *dynamic.h5 file names are searched by substring as <path>*<subject id>*dynamic.h5.
+    The index is listed again when the directory modification time change, and on a subject not found
+    (a file added in the same time tick).
+    path: same as search_path, the directory followed by an optional file name prefix
+    '''
+    file_pattern = re.compile(r'fmri_(?P<sid>.+)_(?P<n_seed>\d+)_vox_dynamic\.h5$')
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.dir_path = os.path.dirname(self.path) or '.'
+        self.prefix = os.path.basename(self.path)
+        self.mtime = None
+        self.refresh()
+
+    def refresh(self, force=False):
+        mtime = os.stat(self.dir_path).st_mtime
+        if mtime == self.mtime and not force:
+            return
+        self.mtime = mtime
+        self.subjects = {}
+        self.unparsed = []
+        for f in sorted(os.listdir(self.dir_path)):
+            if not f.startswith(self.prefix) or not f.endswith('dynamic.h5'):
+                continue
+            match = self.file_pattern.match(f[len(self.prefix):])
+            if match is not None:
+                self.subjects.setdefault(match.group('sid'), []).append(f)
+            else:
+                self.unparsed.append(f)
+
+    def _search(self, subject_id):
+        sid = str(subject_id)
+        files = self.subjects.get(sid, [])
+        if not len(files):
+            files = [f for f in self.unparsed if sid in f[len(self.prefix):]]
+        return [os.path.join(self.dir_path, f) for f in files]
+
+    def search(self, subject_id):
+        files = self._search(subject_id)
+        if not len(files):
+            self.refresh(force=True)
+            files = self._search(subject_id)
+        return files
+
+    def check(self, subject_list):
+        '''
+            Raise a ValueError listing the subjects without file or with several files
+        '''
+        if any(len(self._search(sid)) == 0 for sid in subject_list):
+            self.refresh(force=True)
+        missing = []
+        duplicates = []
+        for sid in subject_list:
+            n_files = len(self._search(sid))
+            if n_files == 0:
+                missing.append(sid)
+            elif n_files > 1:
+                duplicates.append(sid)
+        if len(missing) or len(duplicates):
+            raise ValueError('Seed maps in ' + self.path + ' missing subjects: ' + str(missing) +
+                             ' duplicate subjects: ' + str(duplicates))
+
+
+def get_path_index(path):
+    '''
+        PathIndex of path, a PathIndex (e.g. held by sbp.SBP for all its seeds) is refreshed and returned
+    '''
+    if isinstance(path, PathIndex):
+        path.refresh()
+        return path
+    return PathIndex(path)
+
+
 def search_path(path, subject_id):
-    list_of_files = glob.glob(str(path) + '*' + str(subject_id) + '*dynamic.h5')
+    list_of_files = get_path_index(path).search(subject_id)
     return list_of_files
 
 
+def test_path_index():
+    import tempfile
+    import shutil
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for sid in ['7', '8', 'sub_01', '17']:
+            open(os.path.join(tmp_dir, 'fmri_' + sid + '_7_vox_dynamic.h5'), 'w').close()
+        open(os.path.join(tmp_dir, 'notes_7.txt'), 'w').close()
+        path = os.path.join(tmp_dir, '')
+        assert search_path(path, '7') == [os.path.join(tmp_dir, 'fmri_7_7_vox_dynamic.h5')]
+        assert search_path(path, 'sub_01') == [os.path.join(tmp_dir, 'fmri_sub_01_7_vox_dynamic.h5')]
+        assert search_path(path, 'vox') == []
+        assert search_path(path, 'fmri') == []
+        index = PathIndex(path)
+        index.check(['7', '8', 'sub_01', '17'])
+        # other file names are found by substring
+        open(os.path.join(tmp_dir, 'rmap_subj42_dynamic.h5'), 'w').close()
+        assert search_path(path, 'subj42') == [os.path.join(tmp_dir, 'rmap_subj42_dynamic.h5')]
+        # a file added after the index was listed, in the same time tick
+        open(os.path.join(tmp_dir, 'fmri_9_7_vox_dynamic.h5'), 'w').close()
+        os.utime(tmp_dir, (index.mtime, index.mtime))
+        assert get_path_index(index) is index
+        assert len(index.search(9)) == 1
+        index.check(['9', '42'])
+        try:
+            index.check(['7', '10'])
+        except ValueError as e:
+            assert "['10']" in str(e)
+        else:
+            raise AssertionError('missing subject not reported')
+        assert os.listdir(tmp_dir).count('.proteus_path_index.json') == 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 def grab_rmap(subject_list, path, seed_index, dynamic=False, flag_std=False, verbose=True):
+    if isinstance(path, RmapStore):
+        # consolidated cohort store
+        return path.grab(subject_list, seed_index, dynamic=dynamic)
     dynamic_data = []
     avg_data = []
+    # report the missing and duplicated subjects before loading anything
+    path = get_path_index(path)
+    path.check(subject_list)
     if verbose: pbar = progress.Progbar(len(subject_list))
     k = 0
     for sid in subject_list:
@@ -60,77 +184,205 @@ def grab_rmap(subject_list, path, seed_index, dynamic=False, flag_std=False, ver
             return np.stack(avg_data)
 
 
+def iter_rmap_chunks(subject_list, path, seed_index, confounds, dynamic=False, chunk_size=50):
+    '''
+        Iterate over the rmaps of a seed by chunks of subjects, yield (confounds, data)
+        with the confounds of a subject repeated for each of its dynamic windows
+    '''
+    if not isinstance(path, RmapStore):
+        # one directory listing for all the chunks
+        path = get_path_index(path)
+    for start in range(0, len(subject_list), chunk_size):
+        sub_list = subject_list[start:start + chunk_size]
+        sub_conf = confounds[start:start + chunk_size]
+        if dynamic:
+            x_dyn = grab_rmap(sub_list, path, seed_index, dynamic=True, verbose=False)[0]
+            conf_dyn = np.vstack([np.tile(sub_conf[jj], (x_dyn[jj].shape[0], 1)) for jj in range(len(x_dyn))])
+            yield conf_dyn, np.vstack(x_dyn)
+        else:
+            yield sub_conf, grab_rmap(sub_list, path, seed_index, dynamic=False, verbose=False)
+
+
 ##### make rmaps #####
 
-def dynamic_rmaps(data_, partition, voxel_mask, window=20, gs=False):
+def dynamic_rmaps(data_, partition, voxel_mask, window=20, gs=False, step=None):
+    '''
+        partition: seed partition or a compiled proteus.matrix.Atlas (voxel_mask=None use the atlas brain mask)
+        window: number of frames of the dynamic windows (0 skip the dynamic rmaps)
+        step: number of frames between two windows (default half a window)
+    '''
+    if voxel_mask is None:
+        voxel_mask = partition.mask
     data = data_.copy()
     if gs:
         cf_rm = prediction.ConfoundsRm(data_[voxel_mask].mean(0).reshape(-1, 1), data_[voxel_mask].T, intercept=False)
         data[voxel_mask] = cf_rm.transform(data_[voxel_mask].mean(0).reshape(-1, 1), data_[voxel_mask].T).T
 
+    # the parcel time series of a window are the window of the parcel time series
+    ts_regions = ts.get_ts(data, partition)
+    ts_allvox = data[voxel_mask]
+
     dynamic_data = []
     if window > 0:
-        n_iter = int(data.shape[-1] / (window / 2.)) - 1
-        for widx in range(n_iter):
-            dynamic_data.append(
-                prediction.get_corrvox(data[..., widx * (window / 2):(widx + 1) * window], voxel_mask, partition))
-        dynamic_data = np.stack(dynamic_data)
+        dynamic_data = ts.sliding_corr(ts_regions, ts_allvox, window, step)
 
-    avg_ref = prediction.get_corrvox(data, voxel_mask, partition)
+    avg_ref = ts.corr(ts_regions, ts_allvox)
     return dynamic_data, avg_ref
 
 
-def dynamic_rmaps_std(data_, partition, voxel_mask, window=20):
+def dynamic_rmaps_std(data_, partition, voxel_mask, window=20, step=None):
+    if voxel_mask is None:
+        voxel_mask = partition.mask
     data = data_.copy()
     cf_rm = prediction.ConfoundsRm(data_[voxel_mask].mean(0).reshape(-1, 1), data_[voxel_mask].T, intercept=False)
     data[voxel_mask] = cf_rm.transform(data_[voxel_mask].mean(0).reshape(-1, 1), data_[voxel_mask].T).T
 
-    n_iter = int(data.shape[-1] / (window / 2.)) - 1
-    dynamic_data = []
-    for widx in range(n_iter):
-        dynamic_data.append(
-            prediction.get_corrvox_std(data[..., widx * (window / 2):(widx + 1) * window], voxel_mask, partition))
-    dynamic_data = np.stack(dynamic_data)
-    avg_ref = prediction.get_corrvox_std(data, voxel_mask, partition)
+    ts_regions = ts.get_ts(data, partition, metric='std')
+    ts_allvox = data[voxel_mask]
+    dynamic_data = ts.sliding_corr(ts_regions, ts_allvox, window, step)
+    avg_ref = ts.corr(ts_regions, ts_allvox)
     return dynamic_data, avg_ref
 
 
 def compute_seed_map(seed_partition, brain_mask, list_files, subject_ids, output_path, multiprocess=True, window=20,
-                     gs=False, dynamic=False):
+                     gs=False, dynamic=False, n_jobs=None, overwrite=False, return_timing=False, input_digest='sample'):
+    '''
+        Compute the seed maps of a cohort, one output file per subject
+        The seed partition is compiled once and sent to every worker once (pool initializer).
+        A subject is skipped when its output already exists and was computed from the same input content
+        and parameters, a crashed run can be resumed without recomputing
+        n_jobs: number of workers (default cpu_count - 1)
+        overwrite: recompute all the subjects
+        input_digest: 'full' hash the whole input file, 'sample' (default) hash its size, first and last MB
+                      (the trailer of a .nii.gz holds the CRC of the whole volume), recorded in the output attrs
+        return_timing: also return the {subject id: (status, time in s)} dictionary
+    '''
     print('Compute seed maps ...')
-    n_seed = len(np.unique(seed_partition.get_data())[1:])
+    atlas = Atlas(seed_partition, mask=brain_mask)
+    n_seed = len(atlas.labels)
     pbar = progress.Progbar(len(list_files))
-    seed_list = []
-    params = []
     if not dynamic:
         window = 0
+    params_hash = _params_hash(atlas, window, gs)
 
+    seed_list = []
+    tasks = []
     for ii in range(len(list_files)):
         subj_id = str(subject_ids[ii])
         new_path = output_path + 'fmri_' + subj_id + '_' + str(n_seed) + '_vox_dynamic.h5'
-        if multiprocess:
-            params.append((subj_id, list_files[ii], seed_partition, brain_mask, new_path, window, gs))
-        else:
-            seed_map_multiprocess((subj_id, list_files[ii], seed_partition, brain_mask, new_path, window, gs))
-            pbar.update(ii + 1)
+        tasks.append((subj_id, list_files[ii], new_path, params_hash, overwrite, input_digest))
         seed_list.append(new_path)
+
+    timing = {}
     if multiprocess:
-        p = Pool(processes=multiprocessing.cpu_count() - 1)
-        rs = p.map_async(seed_map_multiprocess, params)
-        p.close()  # No more work
-        while (True):
-            if (rs.ready()): break
-            remaining = rs._number_left
-            pbar.update(1 + len(list_files) - remaining, force=True)
-            # print "Waiting for", remaining, "tasks to complete..."
-            time.sleep(0.5)
+        if n_jobs is None:
+            n_jobs = max(multiprocessing.cpu_count() - 1, 1)
+        p = Pool(processes=n_jobs, initializer=_init_seed_map_worker, initargs=(atlas, window, gs))
+        try:
+            # collected in the order they finish, a slow subject does not hold the others
+            for res in p.imap_unordered(_seed_map_worker, tasks):
+                _collect_seed_map(res, timing, pbar)
+            p.close()
+        except:
+            # a failed subject stop the run, the remaining workers are killed
+            p.terminate()
+            raise
+        finally:
+            p.join()
+    else:
+        _init_seed_map_worker(atlas, window, gs)
+        for task in tasks:
+            _collect_seed_map(_seed_map_worker(task), timing, pbar)
 
+    n_skipped = np.sum([timing[k][0] == 'skipped' for k in timing])
+    print('Seed maps computed: ' + str(len(timing) - n_skipped) + ' skipped: ' + str(n_skipped))
+    if return_timing:
+        return seed_list, timing
     return seed_list
 
 
+def _collect_seed_map(res, timing, pbar):
+    subj_id, status, elapsed = res
+    timing[subj_id] = (status, elapsed)
+    pbar.update(len(timing), force=True)
+
+
+def _params_hash(atlas, window, gs):
+    # signature of the seed partition, brain mask and parameters
+    h = hashlib.sha1()
+    for arr in [atlas.labels, atlas.voxels, atlas.inverse, atlas.mask_index]:
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(repr((window, bool(gs))).encode('utf-8'))
+    return h.hexdigest()
+
+
+_digest_block = 2 ** 20
+
+
+def _input_hash(file_path, params_hash, digest='sample'):
+    # signature of the content of the input file and of the parameters
+    # digest: 'full' the whole file, 'sample' the size, the first and the last block
+    if digest not in ('full', 'sample'):
+        raise ValueError("input_digest must be 'full' or 'sample', got " + str(digest))
+    size = os.path.getsize(file_path)
+    h = hashlib.sha1()
+    h.update(params_hash.encode('utf-8'))
+    h.update(repr((digest, size)).encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        if digest == 'full' or size <= 2 * _digest_block:
+            for block in iter(lambda: f.read(_digest_block), b''):
+                h.update(block)
+        else:
+            h.update(f.read(_digest_block))
+            f.seek(-_digest_block, os.SEEK_END)
+            h.update(f.read(_digest_block))
+    return h.hexdigest()
+
+
+def _stored_hash(file_name):
+    try:
+        with h5py.File(file_name, 'r') as hf:
+            return hf.attrs.get('input_hash', None)
+    except (IOError, OSError):
+        # missing or corrupted file
+        return None
+
+
+# compiled seed partition and parameters of the seed map workers
+_seed_map_params = {}
+
+
+def _init_seed_map_worker(atlas, window, gs):
+    _seed_map_params['atlas'] = atlas
+    _seed_map_params['window'] = window
+    _seed_map_params['gs'] = gs
+
+
+def _seed_map_worker(args):
+    subj_id, file_path, output_path, params_hash, overwrite, input_digest = args
+    start = time.time()
+    input_hash = _input_hash(file_path, params_hash, input_digest)
+    if not overwrite:
+        stored_hash = _stored_hash(output_path)
+        if stored_hash is not None and str(stored_hash) == input_hash:
+            return subj_id, 'skipped', time.time() - start
+
+    vol_file = nib.load(file_path).get_data()
+    dynamic_data, avg_data = dynamic_rmaps(vol_file, _seed_map_params['atlas'], None,
+                                           window=_seed_map_params['window'], gs=_seed_map_params['gs'])
+    del vol_file
+    # write in a temporary file first, an interrupted write never look like a valid output
+    tmp_path = output_path + '.part'
+    util.write({'dynamic_data': dynamic_data, 'avg_data': avg_data}, tmp_path,
+               attrs={'input_hash': input_hash, 'input_digest': input_digest})
+    os.rename(tmp_path, output_path)
+    del dynamic_data, avg_data
+    return subj_id, 'computed', time.time() - start
+
+
 def seed_map_multiprocess((subj_id, file_path, seed_partition, brain_mask, output_path, window, gs)):
     vol_file = nib.load(file_path).get_data()
-    dynamic_data, avg_data = dynamic_rmaps(vol_file, seed_partition.get_data(), brain_mask, window=window, gs=gs)
+    dynamic_data, avg_data = dynamic_rmaps(vol_file, Atlas(seed_partition, mask=brain_mask), None, window=window, gs=gs)
     del vol_file
     # np.savez_compressed(output_path,dynamic_data=dynamic_data,avg_data=avg_data)
     util.write({'dynamic_data': dynamic_data, 'avg_data': avg_data}, output_path)
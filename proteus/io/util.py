@@ -12,11 +12,15 @@ import nibabel as nib
 import h5py
 
 
-def write(dict_data, file_name, compress=4):
+def write(dict_data, file_name, compress=4, attrs=None):
+    if attrs is None:
+        attrs = {}
     with h5py.File(file_name, 'w') as hf:
         for ii in range(len(dict_data.keys())):
             item_id = dict_data.keys()[ii]
             hf.create_dataset(item_id, data=dict_data[item_id], compression="gzip", compression_opts=compress)
+        for key in attrs:
+            hf.attrs[key] = attrs[key]
 
 
 def load(file_name):
@@ -116,10 +120,7 @@ def grabConnectivityWindowsStats(root_path, part_, windowsize=20):
         if tmp_vol.shape[3] > 40:
             subj_list.append(tmp_subjid)
             ts_ = ts.get_ts(tmp_vol, part_.get_data())
-            windows_val = clust.getWindows(ts_, windowsize)
-            print windows_val.shape
-            tmp_data_mean = windows_val.mean(axis=0)
-            tmp_data_std = windows_val.std(axis=0)
+            tmp_data_mean, tmp_data_std = clust.window_stats(ts_, windowsize)
             if k == 0:
                 means_array = tmp_data_mean[np.newaxis, :]
                 stds_array = tmp_data_std[np.newaxis, :]
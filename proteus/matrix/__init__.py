@@ -1,3 +1,5 @@
 __author__ = 'Christian Dansereau'
 
-__all__ = ["tseries","deepmotion"]
+__all__ = ["tseries","deepmotion","atlas"]
+
+from proteus.matrix.atlas import Atlas
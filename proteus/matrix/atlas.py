@@ -0,0 +1,111 @@
+__author__ = 'Christian Dansereau'
+
+import numpy as np
+from proteus.matrix import tseries as ts
+
+
+class Atlas(object):
+    '''
+    Compiled partition, the labels, voxel indices and reduction operator are
+    computed once and reused for every subject and every window
+    '''
+
+    def __init__(self, partition, mask=None, weights=None, probabilistic=False):
+        '''
+        partition:     nibabel image or array, 3D partition (0 is the background) or 4D probabilistic atlas
+        mask:          optional brain mask (nibabel image or array) used for the voxel level data,
+                       default to the voxels of the partition
+        weights:       optional voxel weights for a 3D partition
+        probabilistic: the partition is a probabilistic atlas, the last dimension is the parcels
+        '''
+        part = _get_data(partition)
+        self.shape = part.shape[:-1] if probabilistic else part.shape
+        self.labels, self.voxels, self.operator = ts.parcel_operator(part, weights, probabilistic)
+        # number of voxels in each label
+        self.counts = np.diff(self.operator.indptr)
+        # label of each voxel (the most probable one for a probabilistic atlas)
+        self.inverse = np.asarray(self.operator.argmax(axis=0)).ravel()
+
+        if mask is None:
+            self.mask = np.zeros(self.shape, dtype=bool)
+            self.mask.flat[self.voxels] = True
+        else:
+            self.mask = _get_data(mask).astype(bool)
+        self.mask_index = np.flatnonzero(self.mask)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def voxel_index(self, label):
+        '''
+            Flat index of the voxels of a given label
+        '''
+        k = np.searchsorted(self.labels, label)
+        return self.voxels[self.operator.indices[self.operator.indptr[k]:self.operator.indptr[k + 1]]]
+
+    def get_ts(self, vol, metric='mean'):
+        '''
+            Create a NxT (partitions x time points) array from a 3D or 4D volume
+        '''
+        x = np.asarray(vol).reshape((int(np.prod(self.shape)), -1))[self.voxels]
+        return ts.parcel_reduce(self.operator, x.astype(float), metric)
+
+    def get_vox(self, vol):
+        '''
+            Voxels X time array of the voxels in the brain mask, same as vol[mask]
+        '''
+        vol = np.asarray(vol)
+        return vol.reshape((int(np.prod(self.shape)),) + vol.shape[len(self.shape):])[self.mask_index]
+
+    def vec2vol(self, vec, level='label'):
+        '''
+            Map one value (or time series) per label, or per voxel of the brain mask, back in the volume space
+            level: 'label' (vec is labels x ...) or 'voxel' (vec is mask voxels x ...)
+        '''
+        vec = np.asarray(vec)
+        if level == 'label':
+            index, n = self.voxels, len(self.labels)
+        elif level == 'voxel':
+            index, n = self.mask_index, len(self.mask_index)
+        else:
+            raise ValueError("level must be 'label' or 'voxel', got " + str(level))
+        if len(vec) != n:
+            raise ValueError('Expected ' + str(n) + ' values at the ' + level + ' level, got ' + str(len(vec)))
+        vol = np.zeros((int(np.prod(self.shape)),) + vec.shape[1:])
+        if level == 'label':
+            vol[index] = vec[self.inverse]
+        else:
+            vol[index] = vec
+        return vol.reshape(self.shape + vec.shape[1:])
+
+def _get_data(img):
+    if hasattr(img, 'get_data'):
+        return np.asarray(img.get_data())
+    return np.asarray(img)
+
+
+def test_vec2vol():
+    part = np.zeros((4, 3, 2), dtype=int)
+    part[:2, :, 0] = 1
+    part[2:, :, 0] = 2
+    mask = part > 0
+    atlas = Atlas(part, mask=mask)
+    vol = atlas.vec2vol(np.array([5., 7.]))
+    assert np.all(vol[part == 1] == 5.) and np.all(vol[part == 2] == 7.) and np.all(vol[part == 0] == 0)
+    vec = np.arange(mask.sum(), dtype=float)
+    assert np.array_equal(atlas.vec2vol(vec, level='voxel')[mask], vec)
+    assert atlas.vec2vol(np.ones((2, 3))).shape == (4, 3, 2, 3)
+
+    # as many labels as mask voxels: the level decides, not the length
+    part = np.zeros((2, 2, 1), dtype=int)
+    part[0, 0, 0] = 2
+    part[1, 1, 0] = 1
+    atlas = Atlas(part)
+    assert atlas.vec2vol([3., 4.])[1, 1, 0] == 3.
+    assert atlas.vec2vol([3., 4.], level='voxel')[0, 0, 0] == 3.
+    try:
+        Atlas(np.array([[[1, 1, 2]]])).vec2vol([1., 2., 3.])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('a voxel vector was accepted at the label level')
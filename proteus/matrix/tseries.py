@@ -3,6 +3,7 @@ __author__ = 'Christian Dansereau'
 import numpy as np
 import copy
 from numba import jit
+from scipy import sparse
 import math
 
 
@@ -26,16 +27,62 @@ def vol2vec(vol):
     return vec_vol
 
 
+# memoized triangle index tables, key: (N, include_diag)
+_tri_index = {}
+
+
+def tri_index(N, include_diag=False):
+    '''
+        Index of the lower triangle of a NxN matrix in the matlab (column-wise) order
+        The tables are computed once per (N, include_diag)
+    '''
+    key = (int(N), bool(include_diag))
+    if key not in _tri_index:
+        if include_diag:
+            inddown = np.triu_indices(N, 0)
+        else:
+            inddown = np.triu_indices(N, 1)
+        # Hack to be compatible with matlab column-wise instead of row-wise
+        inddown = (inddown[1], inddown[0])
+        inddown[0].flags.writeable = False
+        inddown[1].flags.writeable = False
+        _tri_index[key] = inddown
+    return _tri_index[key]
+
+
+def vec2N(M, include_diag=False):
+    # size of the matrix from the length of the vector
+    if include_diag:
+        return int(round((-1 + math.sqrt(1 + 8 * M)) / 2))
+    return int(round((1 + math.sqrt(1 + 8 * M)) / 2))
+
+
 #@jit
 def mat2vec(m, include_diag=False):
-    # Hack to be compatible with matlab column-wise instead of row-wise
-    if include_diag:
-        inddown = np.triu_indices_from(m, 0)
-    else:
-        inddown = np.triu_indices_from(m, 1)
+    return m[tri_index(m.shape[0], include_diag)]
+
+
+def mats2vecs(mats, include_diag=False):
+    '''
+        Batched mat2vec: (subjects x N x N) to (subjects x edges)
+    '''
+    inddown = tri_index(mats.shape[1], include_diag)
+    return mats[:, inddown[0], inddown[1]]
+
 
-    inddown = (inddown[1], inddown[0])
-    return m[inddown]
+def vecs2mats(vecs, val_diag=0., include_diag=False):
+    '''
+        Batched vec2mat: (subjects x edges) to (subjects x N x N)
+    '''
+    vecs = np.asarray(vecs)
+    N = vec2N(vecs.shape[1], include_diag)
+    inddown = tri_index(N, include_diag)
+    mats = np.zeros((vecs.shape[0], N, N))
+    if not include_diag:
+        mats[:, np.arange(N), np.arange(N)] = val_diag
+    mats[:, inddown[0], inddown[1]] = vecs
+    mats[:, inddown[1], inddown[0]] = vecs
+    return mats
 
 
 #@jit
@@ -71,23 +118,17 @@ def vec2mat(vec, val_diag=0., include_diag=False, style='python'):
 def vec2mat(vec, val_diag=0., include_diag=False):
     if vec.ndim > 1:
         vec = vec[:, 0]
-    M = len(vec)
+    N = vec2N(len(vec), include_diag)
     if include_diag:
         # Create the matrix with diagonal
-        N = int(round(-1 + (math.sqrt(1 + 8 * M)) / 2))
         m = np.zeros((N, N))
-        inddown = np.triu_indices_from(m, 0)
     else:
-        N = int(round((1 + math.sqrt(1 + 8 * M)) / 2))
         m = np.identity(N) * val_diag
-        inddown = np.triu_indices_from(m, 1)
-    # indup = np.triu_indices_from(m,1)
     # need a hack to be compatible with matlab
     # python give indices row-wise and matlab column-wise ...
-    inddown = (inddown[1], inddown[0])
-    m[inddown] = vec
-    m = m.T
+    inddown = tri_index(N, include_diag)
     m[inddown] = vec
+    m[inddown[1], inddown[0]] = vec
     return m
 
 
@@ -95,8 +136,14 @@ def ts2vol(vec, part):
     pass
 
 
-@jit
-def vec2vol(vec, part):
+def vec2vol(vec, part, level='label'):
+    '''
+        level: for a compiled proteus.matrix.Atlas, 'label' (one value per label) or 'voxel' (one value per
+               voxel of its brain mask)
+    '''
+    if hasattr(part, 'vec2vol'):
+        # compiled proteus.matrix.Atlas
+        return part.vec2vol(vec, level)
     if len(np.unique(part)) == 2:
         # this is a binary mask
         if len(vec.shape) == 2:
@@ -115,47 +162,184 @@ def vec2vol(vec, part):
     return vol
 
 
-def corr(ref_ts, voxel_ts):
+def normalize_rows(x):
+    '''
+        Center each row and scale it to a unit norm, constant rows are set to zero
+    '''
+    x_ = np.array(x, dtype=float)
+    x_ -= x_.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt((x_ ** 2).sum(axis=1))
+    norm[norm == 0] = np.inf
+    x_ /= norm[:, np.newaxis]
+    return x_
+
+
+def corr(ref_ts, voxel_ts, fisher=False, dtype=np.float64, chunk_size=20000):
     '''
         ref_ts (regions X time)
         voxel_ts (voxels X time)
+        fisher: apply the fisher transform (arctanh) to the correlations
+        dtype: output type (np.float32 halve the memory of large rmaps)
+        chunk_size: number of voxels normalized at once to bound the memory
+        return the (regions X voxels) correlation matrix, constant series and series with NaN give a correlation of 0
     '''
-    corr_mat = []
-    for ii in range(voxel_ts.shape[0]):
-        corr_mat.append(np.corrcoef(voxel_ts[ii, :], ref_ts)[0, :][1:])
-
-    # put all constant value that gave Nan to zero
-    corr_mat = np.nan_to_num(np.array(corr_mat).T)
-    # fisher transform
-    # corr_mat = np.arctanh(corr_mat)
+    ref_ = normalize_rows(np.atleast_2d(ref_ts)).astype(dtype)
+    n_vox = voxel_ts.shape[0]
+    corr_mat = np.empty((ref_.shape[0], n_vox), dtype=dtype)
+    for start in range(0, n_vox, chunk_size):
+        stop = min(start + chunk_size, n_vox)
+        corr_mat[:, start:stop] = ref_.dot(normalize_rows(voxel_ts[start:stop, :]).astype(dtype).T)
+
+    # put all the values that gave NaN to zero
+    corr_mat[np.isnan(corr_mat)] = 0
+    np.clip(corr_mat, -1., 1., out=corr_mat)
+    if fisher:
+        # keep finite values for perfectly correlated series
+        eps = np.finfo(dtype).eps
+        np.clip(corr_mat, -1. + eps, 1. - eps, out=corr_mat)
+        np.arctanh(corr_mat, out=corr_mat)
     return corr_mat
 
 
-@jit
-def get_ts(vol, part, metric='mean'):
-    # create a NxT (partitions x time points)
-    part = np.array(part, dtype=int)
-    idx = np.unique(part)
-    idx = idx[idx > 0]  # exclude the index 0
-    ts = np.array([])
-    for i in idx:
-        mask_parcel = part == i
-        # compute the average of the time series defined in a partition
-        # print vol.shape,mask_parcel.shape
-        # if len(vol[mask_parcel].shape)>1:
-        if metric == 'std':
-            ts_new = np.array(vol[mask_parcel].std(axis=0))
-        else:
-            ts_new = np.array(vol[mask_parcel].mean(axis=0))
-        # else:
-        #    ts_new = np.mean(vol[mask_parcel])
-        # print ts_new.shape
-        # print ts.shape
-        if len(ts) == 0:
-            ts = np.vstack((ts_new,))
+_var_rtol = 1e-12
+
+
+def iter_sliding_corr(ref_ts, voxel_ts, window, step=None):
+    '''
+        Seed to voxel correlation on sliding windows
+        The running sums, sums of squares and cross-products are updated with the frames
+        leaving and entering the window, each window cost O(step) instead of O(window)
+        ref_ts (regions X time)
+        voxel_ts (voxels X time)
+        window: number of frames in a window
+        step: number of frames between two windows (default half a window)
+        yield the (regions X voxels) correlation of each window, constant series give 0
+    '''
+    if step is None:
+        step = max(window // 2, 1)
+    # center the series on their global mean to limit the cancellation in the running sums
+    ref_ = np.atleast_2d(np.array(ref_ts, dtype=float))
+    ref_ -= ref_.mean(axis=1)[:, np.newaxis]
+    vox_ = np.array(voxel_ts, dtype=float)
+    vox_ -= vox_.mean(axis=1)[:, np.newaxis]
+
+    n_windows = (ref_.shape[1] - window) // step + 1
+    w = float(window)
+    for widx in range(n_windows):
+        start = widx * step
+        if widx == 0 or step >= window:
+            # no overlap with the previous window
+            s_ref = ref_[:, start:start + window].sum(axis=1)
+            ss_ref = (ref_[:, start:start + window] ** 2).sum(axis=1)
+            s_vox = vox_[:, start:start + window].sum(axis=1)
+            ss_vox = (vox_[:, start:start + window] ** 2).sum(axis=1)
+            s_cross = ref_[:, start:start + window].dot(vox_[:, start:start + window].T)
         else:
-            ts = np.vstack((ts, ts_new))
-    return ts
+            out_ = slice(start - step, start)
+            in_ = slice(start - step + window, start + window)
+            s_ref += ref_[:, in_].sum(axis=1) - ref_[:, out_].sum(axis=1)
+            ss_ref += (ref_[:, in_] ** 2).sum(axis=1) - (ref_[:, out_] ** 2).sum(axis=1)
+            s_vox += vox_[:, in_].sum(axis=1) - vox_[:, out_].sum(axis=1)
+            ss_vox += (vox_[:, in_] ** 2).sum(axis=1) - (vox_[:, out_] ** 2).sum(axis=1)
+            s_cross += ref_[:, in_].dot(vox_[:, in_].T) - ref_[:, out_].dot(vox_[:, out_].T)
+
+        # a constant window leaves a rounding residual in the running sums, it is set to a zero variance
+        var_ref = w * ss_ref - s_ref ** 2
+        var_ref[var_ref <= _var_rtol * w * ss_ref] = 0
+        var_vox = w * ss_vox - s_vox ** 2
+        var_vox[var_vox <= _var_rtol * w * ss_vox] = 0
+        denom = np.sqrt(np.outer(var_ref, var_vox))
+        denom[denom == 0] = np.inf
+        yield np.clip((w * s_cross - np.outer(s_ref, s_vox)) / denom, -1., 1.)
+
+
+def sliding_corr(ref_ts, voxel_ts, window, step=None, dtype=np.float64):
+    '''
+        Same as iter_sliding_corr but return a (windows X regions X voxels) array
+    '''
+    if step is None:
+        step = max(window // 2, 1)
+    n_windows = max((np.shape(ref_ts)[-1] - window) // step + 1, 0)
+    corr_mat = np.empty((n_windows, np.atleast_2d(ref_ts).shape[0], voxel_ts.shape[0]), dtype=dtype)
+    for widx, corr_win in enumerate(iter_sliding_corr(ref_ts, voxel_ts, window, step)):
+        corr_mat[widx] = corr_win
+    return corr_mat
+
+
+def label_index(part):
+    '''
+        Single pass index of a hard partition (0 is the background)
+        return the sorted labels, the flat index of the labelled voxels and
+        the position in labels of each of those voxels
+    '''
+    flat_part = np.asarray(part).astype(int).ravel()
+    voxels = np.flatnonzero(flat_part > 0)
+    labels, inverse = np.unique(flat_part[voxels], return_inverse=True)
+    return labels, voxels, inverse.ravel()
+
+
+def parcel_operator(part, weights=None, probabilistic=False):
+    '''
+        Build the sparse (parcels x voxels) reduction operator of a partition
+        part:          hard partition (any shape) or probabilistic atlas (voxels dimensions x parcels)
+        weights:       optional voxel weights (same shape as a hard partition)
+        probabilistic: part is a probabilistic atlas, the last dimension is the parcels
+        return labels, voxels (flat index of the voxels used) and the operator
+    '''
+    part = np.asarray(part)
+    if probabilistic:
+        # a voxel can contribute to several parcels
+        w = part.reshape((-1, part.shape[-1])).astype(float)
+        voxels = np.flatnonzero(np.any(w != 0, axis=1))
+        labels = np.arange(1, part.shape[-1] + 1)
+        return labels, voxels, sparse.csr_matrix(w[voxels].T)
+
+    labels, voxels, inverse = label_index(part)
+    if weights is None:
+        data = np.ones(len(voxels))
+    else:
+        data = np.asarray(weights, dtype=float).ravel()[voxels]
+    operator = sparse.csr_matrix((data, (inverse, np.arange(len(voxels)))), shape=(len(labels), len(voxels)))
+    return labels, voxels, operator
+
+
+def parcel_reduce(operator, x, metric='mean'):
+    '''
+        Reduce the voxels time series with a parcel operator
+        operator (parcels x voxels)
+        x (voxels x time)
+        return a (parcels x time) array of the weighted mean or std
+    '''
+    norm = np.asarray(operator.sum(axis=1), dtype=float)
+    mean_ts = operator.dot(x) / norm
+    if metric != 'std':
+        return mean_ts
+    # the variance is shift invariant, center each time point to limit cancellation
+    x_c = x - x.mean(axis=0)
+    mean_c = operator.dot(x_c) / norm
+    var_ts = operator.dot(x_c ** 2) / norm - mean_c ** 2
+    return np.sqrt(np.clip(var_ts, 0, None))
+
+
+def get_ts(vol, part, metric='mean', weights=None, probabilistic=False):
+    '''
+        Create a NxT (partitions x time points) array
+        vol:           volume, the first dimensions are the voxels dimensions of part followed by time
+                       (e.g. (x, y, z, time) with a 3D partition or (voxels, time) with a 1D partition)
+        part:          partition (0 is excluded), probabilistic atlas or a compiled proteus.matrix.Atlas
+        metric:        'mean' or 'std' of the voxels in each parcel
+        weights:       optional voxel weights for a hard partition
+        probabilistic: part is a probabilistic atlas (voxels dimensions x parcels)
+    '''
+    if hasattr(part, 'operator'):
+        return part.get_ts(vol, metric)
+    vol = np.asarray(vol)
+    part = np.asarray(part)
+    vox_shape = part.shape[:-1] if probabilistic else part.shape
+    n_vox = int(np.prod(vox_shape))
+    labels, voxels, operator = parcel_operator(part, weights, probabilistic)
+    x = vol.reshape((n_vox, -1))[voxels].astype(float)
+    return parcel_reduce(operator, x, metric)
 
 
 def get_connectome(vol, part):
@@ -188,6 +372,70 @@ def test_mat2vec():
     assert np.all(new_a == a)
 
 
+def test_get_ts():
+    vol = np.arange(24, dtype=float).reshape((2, 2, 2, 3))
+    part = np.array([[[1, 1], [0, 2]], [[2, 2], [0, 0]]])
+    res = get_ts(vol, part)
+    assert res.shape == (2, 3)
+    assert np.allclose(res[0], vol[0, 0, :2].mean(0))
+    assert np.allclose(get_ts(vol, part, metric='std')[1], vol[part == 2].std(0))
+
+
+def test_get_ts_1d():
+    # (voxels x time) data with a 1D partition
+    vol = np.arange(300, dtype=float).reshape((10, 30))
+    part = np.array([0, 1, 1, 2, 2, 2, 3, 0, 3, 1])
+    res = get_ts(vol, part)
+    assert res.shape == (3, 30)
+    for k in range(3):
+        assert np.allclose(res[k], vol[part == k + 1].mean(0))
+    # probabilistic atlas (voxels x parcels)
+    prob = np.stack([part == k + 1 for k in range(3)], axis=1).astype(float)
+    assert np.allclose(get_ts(vol, prob, probabilistic=True), res)
+
+
+def test_corr():
+    rng = np.random.RandomState(0)
+    ref_ts = rng.randn(3, 40)
+    voxel_ts = rng.randn(50, 40) + ref_ts[0]
+    voxel_ts[4] = 2.
+    voxel_ts[7, 10] = np.nan
+    ref_ts[2, 5] = np.nan
+    # loop of the previous implementation
+    ref = []
+    for ii in range(voxel_ts.shape[0]):
+        ref.append(np.corrcoef(voxel_ts[ii, :], ref_ts)[0, :][1:])
+    ref = np.nan_to_num(np.array(ref).T)
+    assert np.allclose(corr(ref_ts, voxel_ts, chunk_size=16), ref)
+    assert np.all(corr(ref_ts, voxel_ts)[:, [4, 7]] == 0) and np.all(corr(ref_ts, voxel_ts)[2] == 0)
+    assert np.allclose(corr(ref_ts, voxel_ts, fisher=True), np.arctanh(ref))
+    assert np.allclose(corr(ref_ts[0], voxel_ts, dtype=np.float32), ref[:1], atol=1e-6)
+
+
+def test_sliding_corr():
+    rng = np.random.RandomState(0)
+    ref_ts = rng.randn(2, 103) + np.linspace(0, 50, 103)
+    voxel_ts = rng.randn(30, 103) + 3. * ref_ts[0]
+    voxel_ts[3, 20:60] = 1.
+    for window, step in [(20, None), (20, 7), (10, 10), (8, 13)]:
+        res = sliding_corr(ref_ts, voxel_ts, window, step)
+        step_ = step if step is not None else window // 2
+        # correlation of each window computed from scratch
+        starts = range(0, ref_ts.shape[1] - window + 1, step_)
+        assert res.shape == (len(starts), 2, 30)
+        for widx, start in enumerate(starts):
+            assert np.allclose(res[widx], corr(ref_ts[:, start:start + window], voxel_ts[:, start:start + window]),
+                               atol=1e-10)
+
+
+def test_vecs2mats():
+    a = np.array([[1, 2, 3], [2, 1, 4], [3, 4, 1]])
+    vecs = mats2vecs(np.stack((a, 2 * a)))
+    assert np.all(vecs == [[2, 3, 4], [4, 6, 8]])
+    assert np.all(vecs2mats(vecs, val_diag=1)[0] == a)
+    assert np.all(vecs2mats(mats2vecs(np.stack((a,)), include_diag=True), include_diag=True)[0] == a)
+
+
 def test_vec2mat():
     a = np.array([[1, 2, 3], [2, 1, 4], [3, 4, 1]])
     # [2, 3, 4]
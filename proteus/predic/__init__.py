@@ -1,3 +1,3 @@
 __author__ = 'Christian Dansereau'
 
-__all__ = ["predlib","prediction","betacluster","clustering","fselection","stability","subtypes","sbp"]
+__all__ = ["predlib","prediction","betacluster","clustering","fselection","stability","subtypes","sbp","resampling","search","kernels","artifacts"]
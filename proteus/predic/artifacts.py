@@ -0,0 +1,365 @@
+__author__ = 'Christian Dansereau'
+
+"""
+Persisted model artifacts for SBP and TwoStagesPrediction
+An artifact is a directory with a JSON manifest (hyper-parameters, versions, model types) and a single HDF5 file
+holding the arrays needed for inference only: confounds regression coefficients, subtype templates, scaler means
+and the coefficients of the linear (or rbf support vectors) models. The grid search state is not saved.
+    manifest.json
+    arrays.h5       seeds/<ii>/crm, seeds/<ii>/st1, seeds/<ii>/st2 (only if stage 2 has its own subtypes), tlp/...
+"""
+import os
+import json
+import time
+import numpy as np
+import h5py
+import sklearn
+from sklearn.metrics.pairwise import rbf_kernel
+
+from proteus.predic import prediction
+from proteus.predic import subtypes
+from proteus.predic import sbp
+from proteus.predic.high_confidence import TwoStagesPrediction, nullClassifier
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+ARRAYS_FILE = 'arrays.h5'
+
+_sbp_params = ['verbose', 'dynamic', 'stage1_model_type', 'nSubtypes', 'nSubtypes_stage2', 'stage1_metric',
+               'stage2_metric', 's2_branches', 'min_gamma', 'thresh_ratio', 'n_iter', 'shuffle_test_split', 'gamma',
+               'gamma_auto_adjust', 'flag_recurrent', 'recurrent_modes', 'chunk_size', 'tmp_dir', 'n_jobs',
+               'tlp_n_jobs', 'ward_max_rows', 'ward_centroids']
+_tlp_params = ['verbose', 'gamma', 'n_iter', 'min_gamma', 'thresh_ratio', 'shuffle_test_split', 'gamma_auto_adjust',
+               'recurrent_modes', 'hitprobability_strategy', 'random_state', 'n_jobs',
+               'warm_start']
+_tlp_models = ['basemodel', 'confidencemodel', 'hitproba', 'joint_class_hc']
+
+
+class CenteringScaler(object):
+    '''
+    Inference only StandardScaler(with_std=False)
+    '''
+
+    def __init__(self, mean):
+        self.mean_ = mean
+
+    def transform(self, x):
+        # same dtype rule as StandardScaler: float32 is kept, everything else is centered in float64
+        x = np.array(x)
+        if x.dtype not in (np.float32, np.float64):
+            x = x.astype(np.float64)
+        x -= self.mean_
+        return x
+
+
+class LinearScorer(object):
+    '''
+    Inference only linear model (SVC with a linear kernel, LogisticRegression, PrimalLinearSvc, SVR)
+    classes: None for a regression model
+    '''
+
+    def __init__(self, coef, intercept, classes=None):
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.classes_ = classes
+
+    def decision_function(self, x):
+        df = np.asarray(x).dot(self.coef_.T) + self.intercept_
+        if self.coef_.shape[0] == 1:
+            return df.ravel()
+        return df
+
+    def predict(self, x):
+        df = self.decision_function(x)
+        if self.classes_ is None:
+            return df
+        if df.ndim == 1:
+            return self.classes_[(df > 0).astype(int)]
+        return self.classes_[df.argmax(1)]
+
+
+class RbfScorer(object):
+    '''
+    Inference only binary SVC with a rbf kernel
+    '''
+
+    def __init__(self, support_vectors, dual_coef, intercept, gamma, classes):
+        self.support_vectors_ = support_vectors
+        self.dual_coef_ = dual_coef
+        self.intercept_ = intercept
+        self.gamma = gamma
+        self.classes_ = classes
+
+    def decision_function(self, x):
+        k = rbf_kernel(np.asarray(x, dtype=np.float64), self.support_vectors_, gamma=self.gamma)
+        return (k.dot(self.dual_coef_.T) + self.intercept_).ravel()
+
+    def predict(self, x):
+        return self.classes_[(self.decision_function(x) > 0).astype(int)]
+
+
+class StackedScorer(object):
+    '''
+    Decision functions of a list of models stacked by column (ConfidenceLR, MulticlassLR)
+    '''
+
+    def __init__(self, clfs):
+        self.clfs = clfs
+
+    def decision_function(self, x):
+        return np.stack([np.array(clf.decision_function(x)) for clf in self.clfs]).T
+
+
+class _LazySeeds(object):
+    # list of the [ConfoundsRm, clusteringST, clusteringST stage 2] of each seed, read on first access
+    def __init__(self, file_name, seeds_manifest):
+        self.file_name = file_name
+        self.seeds_manifest = seeds_manifest
+        self._seeds = {}
+
+    def __len__(self):
+        return len(self.seeds_manifest)
+
+    def __getitem__(self, ii):
+        if ii not in self._seeds:
+            with h5py.File(self.file_name, 'r') as hf:
+                self._seeds[ii] = _read_seed(hf['seeds/' + str(ii)], self.seeds_manifest[ii])
+        return self._seeds[ii]
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+
+def save_sbp(model, path):
+    '''
+        Save a fitted sbp.SBP in the artifact directory path
+    '''
+    manifest = _base_manifest('SBP')
+    manifest['params'] = _params(model, _sbp_params)
+    with h5py.File(_prepare(path), 'w') as hf:
+        mask_part = np.asarray(model.mask_part)
+        if mask_part.size:
+            hf.create_dataset('mask_part', data=mask_part)
+        manifest['seeds'] = [_write_seed(hf.create_group('seeds/' + str(ii)), st_crm)
+                             for ii, st_crm in enumerate(model.st_crm)]
+        manifest['tlp'] = _write_tlp(hf.create_group('tlp'), model.tlp)
+    _write_manifest(path, manifest)
+
+
+def load_sbp(path, lazy=True):
+    '''
+        Load a SBP saved with save_sbp, ready for predict and predict_files
+        lazy: the confounds and subtype models of each seed are read from the file on first use
+    '''
+    manifest = _read_manifest(path, 'SBP')
+    file_name = os.path.join(path, ARRAYS_FILE)
+    params = dict(manifest['params'])
+    with h5py.File(file_name, 'r') as hf:
+        params['mask_part'] = hf['mask_part'][...] if 'mask_part' in hf else []
+        tlp = _read_tlp(hf['tlp'], manifest['tlp'])
+    model = sbp.SBP(**params)
+    model.tlp = tlp
+    model.st_crm = _LazySeeds(file_name, manifest['seeds'])
+    if not lazy:
+        model.st_crm = list(model.st_crm)
+    return model
+
+
+def save_two_stages(tlp, path):
+    '''
+        Save a fitted TwoStagesPrediction in the artifact directory path
+    '''
+    manifest = _base_manifest('TwoStagesPrediction')
+    with h5py.File(_prepare(path), 'w') as hf:
+        manifest['tlp'] = _write_tlp(hf.create_group('tlp'), tlp)
+    _write_manifest(path, manifest)
+
+
+def load_two_stages(path):
+    manifest = _read_manifest(path, 'TwoStagesPrediction')
+    with h5py.File(os.path.join(path, ARRAYS_FILE), 'r') as hf:
+        return _read_tlp(hf['tlp'], manifest['tlp'])
+
+
+def _base_manifest(model_type):
+    return {'model_type': model_type,
+            'format_version': FORMAT_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'versions': {'numpy': np.__version__, 'sklearn': sklearn.__version__, 'h5py': h5py.__version__}}
+
+
+def _prepare(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, ARRAYS_FILE)
+
+
+def _write_manifest(path, manifest):
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def _read_manifest(path, model_type):
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('model_type') != model_type:
+        raise ValueError(path + ' is not a ' + model_type + ' artifact')
+    if manifest.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError(path + ' was saved with a newer artifact format (' + str(manifest['format_version']) + ')')
+    return manifest
+
+
+def _params(obj, names):
+    # json serializable hyper-parameters
+    params = {}
+    for name in names:
+        value = getattr(obj, name, None)
+        if isinstance(value, np.generic):
+            value = value.item()
+        if value is None or isinstance(value, (bool, int, float, str)):
+            params[name] = value
+    return params
+
+
+def _write_seed(group, st_crm):
+    crm, st, st_s2 = st_crm
+    info = {'nconfounds': int(crm.nconfounds), 'fit_intercept': bool(crm.fit_intercept),
+            'data_dim': [int(d) for d in crm.data_dim], 'shared_stage2': st_s2 is st}
+    if crm.nconfounds:
+        group.create_dataset('crm/beta', data=crm._get_beta(np.float64))
+    _write_subtypes(group.create_group('st1'), st)
+    if not info['shared_stage2']:
+        _write_subtypes(group.create_group('st2'), st_s2)
+    return info
+
+
+def _read_seed(group, info):
+    crm = prediction.ConfoundsRm(intercept=info['fit_intercept'])
+    crm.nconfounds = info['nconfounds']
+    crm.data_dim = tuple(info['data_dim'])
+    if crm.nconfounds:
+        crm.beta = group['crm/beta'][...]
+        crm._beta32 = None
+    st = _read_subtypes(group['st1'])
+    st_s2 = st if info['shared_stage2'] else _read_subtypes(group['st2'])
+    return [crm, st, st_s2]
+
+
+def _write_subtypes(group, st):
+    if getattr(st, 'unit_templates', None) is None:
+        st._freeze_templates()
+    n_net = st.st_templates.shape[0]
+    group.create_dataset('st_templates', data=st.st_templates)
+    group.create_dataset('normalized_net_template', data=np.array(st.normalized_net_template[:n_net]))
+    group.create_dataset('average_template', data=st.average_template)
+    group.create_dataset('unit_templates', data=st.unit_templates)
+
+
+def _read_subtypes(group):
+    st = subtypes.clusteringST(verbose=False)
+    for name in ['st_templates', 'normalized_net_template', 'average_template', 'unit_templates']:
+        setattr(st, name, group[name][...])
+    return st
+
+
+def _write_tlp(group, tlp):
+    group.create_dataset('scaler_s1_mean', data=tlp.scaler_s1.mean_)
+    group.create_dataset('scaler_s2_mean', data=tlp.scaler_s2.mean_)
+    info = {'params': _params(tlp, _tlp_params), 'models': {}}
+    for name in _tlp_models:
+        info['models'][name] = _write_model(group.create_group(name), getattr(tlp, name))
+    return info
+
+
+def _read_tlp(group, info):
+    tlp = TwoStagesPrediction(**info['params'])
+    tlp.scaler_s1 = CenteringScaler(group['scaler_s1_mean'][...])
+    tlp.scaler_s2 = CenteringScaler(group['scaler_s2_mean'][...])
+    for name in _tlp_models:
+        setattr(tlp, name, _read_model(group[name], info['models'][name]))
+    return tlp
+
+
+def _write_model(group, model):
+    '''
+        Write the arrays of a fitted model in group, return its manifest entry
+    '''
+    if hasattr(model, 'clfs'):
+        return {'type': 'stacked', 'clfs': [_write_model(group.create_group(str(ii)), clf)
+                                            for ii, clf in enumerate(model.clfs)]}
+    if hasattr(model, 'gridclf'):
+        # proteus wrappers of a sklearn model (BaseSvc, BaseLR, HC_LR, HitProbability)
+        model = model.clf
+    if isinstance(model, nullClassifier):
+        return {'type': 'null'}
+
+    classes = getattr(model, 'classes_', None)
+    if classes is not None:
+        group.create_dataset('classes', data=classes)
+    kernel = getattr(model, 'kernel', 'linear')
+    if kernel == 'rbf':
+        if len(classes) != 2:
+            raise ValueError('Only the binary rbf SVC can be saved')
+        gamma = getattr(model, 'gamma_', getattr(model, '_gamma', model.gamma))
+        group.create_dataset('support_vectors', data=model.support_vectors_)
+        group.create_dataset('dual_coef', data=model.dual_coef_)
+        group.create_dataset('intercept', data=model.intercept_)
+        return {'type': 'rbf', 'gamma': float(gamma)}
+    if kernel != 'linear':
+        raise ValueError('Unsupported kernel: ' + str(kernel))
+    if hasattr(model, 'support_vectors_') and classes is not None and len(classes) > 2:
+        raise ValueError('The multiclass SVC (one vs one) can not be saved, use a one vs rest model')
+    group.create_dataset('coef', data=np.atleast_2d(model.coef_))
+    group.create_dataset('intercept', data=np.atleast_1d(model.intercept_))
+    return {'type': 'linear'}
+
+
+def _read_model(group, info):
+    if info['type'] == 'stacked':
+        return StackedScorer([_read_model(group[str(ii)], clf_info) for ii, clf_info in enumerate(info['clfs'])])
+    if info['type'] == 'null':
+        return nullClassifier()
+    classes = group['classes'][...] if 'classes' in group else None
+    if info['type'] == 'rbf':
+        return RbfScorer(group['support_vectors'][...], group['dual_coef'][...], group['intercept'][...],
+                         info['gamma'], classes)
+    return LinearScorer(group['coef'][...], group['intercept'][...], classes)
+
+
+def test_save_load():
+    import tempfile
+    import shutil
+    rng = np.random.RandomState(0)
+    x = rng.randn(60, 2, 100)
+    confounds = rng.randn(60, 2)
+    y = (x[:, 0, :5].sum(1) > 0).astype(int)
+    model = sbp.SBP(nSubtypes=3, nSubtypes_stage2=2, verbose=False, n_iter=10)
+    model.fit(x, confounds, x, confounds, y)
+    pred = model.predict(x, confounds)
+    xw, xw2 = model.get_w(x, confounds)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # same stage 1 labels and decision values as the fitted model
+        path = os.path.join(tmp_dir, 'sbp')
+        save_sbp(model, path)
+        for lazy in [True, False]:
+            loaded_pred = load_sbp(path, lazy=lazy).predict(x, confounds)
+            assert np.all((loaded_pred[:, 0] > 0) == (pred[:, 0] > 0))
+            assert np.allclose(loaded_pred, pred, equal_nan=True)
+
+        path = os.path.join(tmp_dir, 'tlp')
+        save_two_stages(model.tlp, path)
+        tlp = load_two_stages(path)
+        assert np.all(tlp.basemodel.predict(tlp.scaler_s1.transform(xw)) ==
+                      model.tlp.basemodel.predict(model.tlp.scaler_s1.transform(xw)))
+        assert np.allclose(tlp.predict(xw, xw2)[0], model.tlp.predict(xw, xw2)[0], equal_nan=True)
+        try:
+            load_sbp(path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('a TwoStagesPrediction artifact was loaded as a SBP')
+    finally:
+        shutil.rmtree(tmp_dir)
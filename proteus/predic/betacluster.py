@@ -6,6 +6,7 @@ import pandas as pd
 import clustering as cls
 from sklearn import linear_model
 import numpy as np
+from scipy import sparse
 from proteus.predic import stability 
 
 
@@ -44,6 +45,7 @@ class BetaCluster:
 
         # Hierachical clustering on the beta matrix
         self.ind = cls.hclustering(self.beta, n_cluster)
+        self.bc_agg = self._aggregation_matrix()
 
         # Stability estimation
         if k_feature != 0:
@@ -53,25 +55,68 @@ class BetaCluster:
             self.selectidx = stability.getkBest(bc_x,y,k_feature)
 
 
+    def _aggregation_matrix(self):
+        '''
+        Sparse (edges x cluster pairs) matrix averaging the edges of the connectomes in the blocks of the
+        partition, the cluster pairs are in the mats2vecs order (with diagonal)
+        '''
+        n = self.beta.shape[0]
+        n_cluster = np.max(self.ind)
+        counts = np.bincount(self.ind, minlength=n_cluster + 1)[1:].astype(float)
+        pair_index = np.zeros((n_cluster, n_cluster), dtype=int)
+        pi, pj = ts.tri_index(n_cluster, include_diag=True)
+        pair_index[pi, pj] = np.arange(len(pi))
+        pair_index[pj, pi] = np.arange(len(pi))
+        # cluster of the two nodes of each edge
+        ii, jj = ts.tri_index(n)
+        ci, cj = self.ind[ii] - 1, self.ind[jj] - 1
+        # the diagonal blocks count each edge twice
+        with np.errstate(divide='ignore'):
+            w = np.where(ci == cj, 2. / counts[ci] ** 2, 1. / (counts[ci] * counts[cj]))
+        if self.sparse:
+            w[self.beta[ii, jj] == 0] = 0
+        self.bc_empty = np.flatnonzero(counts[pi] * counts[pj] == 0)
+        agg = sparse.csr_matrix((w, (np.arange(len(ii)), pair_index[ci, cj])), shape=(len(ii), len(pi)))
+        agg.eliminate_zeros()
+        return agg
+
     def bc_transform(self,x):
-        # average resulting new partition
-        # Obtain the new individual conectomes in a vector format
-        x_subf = []
-        beta_mask = self.beta==0
-        for i1 in range(0, x.shape[0]):
-            m = ts.vec2mat(x[i1, :])
-            if self.sparse:
-                m[beta_mask]=0
-            m = cls.part(m, self.ind)
-            if len(x_subf)==0:
-                x_subf = ts.mat2vec(m,include_diag=True)
-            else:
-                x_subf = np.vstack((x_subf,ts.mat2vec(m,include_diag=True)))
-        return x_subf
+        # average the connectomes (subjects x edges) in the blocks of the new partition
+        if getattr(self, 'bc_agg', None) is None:
+            self.bc_agg = self._aggregation_matrix()
+        bc_x = self.bc_agg.T.dot(np.asarray(x, dtype=float).T).T
+        bc_x[:, self.bc_empty] = np.nan
+        return bc_x
 
     def transform(self,x):
         bc_x = self.bc_transform(x)
         # check if we do a feature selection
         if self.k_feature != 0:
-            return x[:,self.selectidx]
+            return bc_x[:,self.selectidx]
         return bc_x
+
+
+def test_bc_transform():
+    # reference: block means of the connectome matrices, one subject at a time
+    rng = np.random.RandomState(0)
+    x = rng.randn(30, 45)
+    y = x[:, :5].sum(1) + rng.randn(30)
+    for sparse_beta in [False, True]:
+        bc = BetaCluster(x, y, 4, sparse=sparse_beta)
+        # a few masked out edges, the aggregation matrix is built again
+        bc.beta[1, 2] = bc.beta[2, 1] = bc.beta[0, 7] = bc.beta[7, 0] = 0
+        bc.bc_agg = None
+        n_cluster = np.max(bc.ind)
+        ref = []
+        for vec in x:
+            m = ts.vec2mat(vec)
+            if sparse_beta:
+                m[bc.beta == 0] = 0
+            new_m = np.identity(n_cluster)
+            for i1 in range(n_cluster):
+                for i2 in range(i1, n_cluster):
+                    new_m[i1, i2] = np.mean(m[bc.ind == i1 + 1, :][:, bc.ind == i2 + 1])
+            new_m += np.triu(new_m, 1).T
+            ref.append(ts.mat2vec(new_m, include_diag=True))
+        assert np.allclose(bc.bc_transform(x), np.array(ref), equal_nan=True)
+        assert np.allclose(bc.transform(x), np.array(ref), equal_nan=True)
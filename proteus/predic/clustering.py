@@ -6,20 +6,101 @@ from scipy.cluster.hierarchy import linkage
 from scipy.cluster.hierarchy import fcluster
 import numpy as np
 from sklearn.preprocessing import scale
+from sklearn.cluster import MiniBatchKMeans
 from proteus.matrix import tseries as ts
 
-def hclustering(data, t):
-    # Normalize features
-    data_ = scale(data, axis=0, with_mean=True, with_std=True, copy=True)
-    # Normalize observation
-    #data_ = scale(data_, axis=1, with_mean=True, with_std=True)
+# above this number of rows the Ward clustering is done on the centroids of a k-means pre-clustering
+# (the exact linkage keeps rows * (rows - 1) / 2 float64 distances, 100 MB for 5000 rows)
+WARD_MAX_ROWS = 5000
 
-    #row_dist = pd.DataFrame(squareform(pdist(data, metric='euclidean')))
-    #row_dist = np.corrcoef(data)
-    #row_dist = data
-    row_clusters = linkage(data_, method='ward')
-    ind = fcluster(row_clusters, t, criterion='maxclust')
-    return ind
+
+def weighted_ward(centers, counts):
+    '''
+        Ward linkage (scipy format) of clusters of counts rows with the given centroids.
+        The Lance-Williams recurrence starts from the Ward distance of the clusters, 2 n_a n_b / (n_a + n_b) |c_a - c_b|^2,
+        so the tree is the one of the exact linkage of the rows once each cluster is merged.
+        The last column counts the centroids of each merged cluster (scipy convention for a linkage of k leaves).
+    '''
+    k = len(counts)
+    size = np.asarray(counts, dtype=float).copy()
+    leaves = np.ones(k)
+    d = squareform(pdist(centers, 'sqeuclidean'))
+    d *= 2 * np.outer(size, size) / (size[:, np.newaxis] + size[np.newaxis, :])
+    np.fill_diagonal(d, np.inf)
+    ids = np.arange(k)
+    z = np.zeros((k - 1, 4))
+    for step in range(k - 1):
+        i, j = np.unravel_index(np.argmin(d), d.shape)
+        if i > j:
+            i, j = j, i
+        d_ij = d[i, j]
+        n_ij = size[i] + size[j]
+        new = ((size[i] + size) * d[i] + (size[j] + size) * d[j] - size * d_ij) / (n_ij + size)
+        z[step] = [min(ids[i], ids[j]), max(ids[i], ids[j]), np.sqrt(max(d_ij, 0.)), leaves[i] + leaves[j]]
+        # the merged cluster takes the place of i, j is removed
+        new[[i, j]] = np.inf
+        d[i, :] = new
+        d[:, i] = new
+        d[j, :] = np.inf
+        d[:, j] = np.inf
+        size[i] = n_ij
+        leaves[i] += leaves[j]
+        ids[i] = k + step
+    return z
+
+
+class WardTree(object):
+    '''
+    Ward hierarchical clustering of the rows (features normalized).
+    Exact Ward linkage up to max_rows rows, otherwise a mini-batch k-means pre-clustering in
+    n_centroids clusters followed by the size weighted Ward linkage of the centroids, in O(rows x n_centroids) memory.
+    '''
+
+    def __init__(self, max_rows=WARD_MAX_ROWS, n_centroids=1000, random_state=0):
+        self.max_rows = max_rows
+        self.n_centroids = n_centroids
+        self.random_state = random_state
+
+    def fit(self, data):
+        # Normalize features
+        data_ = scale(data, axis=0, with_mean=True, with_std=True, copy=True)
+        if data_.shape[0] <= self.max_rows:
+            self.labels_ = None
+            self.linkage_ = linkage(data_, method='ward')
+        else:
+            km = MiniBatchKMeans(n_clusters=self.n_centroids, random_state=self.random_state, n_init=3,
+                                 batch_size=max(1000, 3 * self.n_centroids))
+            labels = km.fit_predict(data_)
+            # drop the empty centroids
+            used, self.labels_, counts = np.unique(labels, return_inverse=True, return_counts=True)
+            self.linkage_ = weighted_ward(km.cluster_centers_[used], counts)
+        return self
+
+    def cut(self, t):
+        '''
+            Cluster (1..t) of each row
+        '''
+        ind = fcluster(self.linkage_, t, criterion='maxclust')
+        if self.labels_ is None:
+            return ind
+        return ind[self.labels_]
+
+
+def ward_tree(data, max_rows=WARD_MAX_ROWS, n_centroids=1000):
+    return WardTree(max_rows, n_centroids).fit(data)
+
+
+def cut_tree(tree, t):
+    '''
+        Cut a WardTree (or a scipy linkage matrix) in (at most) t clusters, the same tree can be cut at several t
+    '''
+    if hasattr(tree, 'cut'):
+        return tree.cut(t)
+    return fcluster(tree, t, criterion='maxclust')
+
+
+def hclustering(data, t, max_rows=WARD_MAX_ROWS, n_centroids=1000):
+    return cut_tree(ward_tree(data, max_rows, n_centroids), t)
 
 '''
 def part_inter(m,ind):
@@ -33,29 +114,46 @@ def part_inter(m,ind):
     return new_m
 '''
 
+def onehot(ind, n_cluster=None):
+    '''
+    Indicator matrix (elements x clusters) of a partition labelled 1..n_cluster (0 is unassigned)
+    '''
+    ind = np.asarray(ind)
+    if n_cluster is None:
+        n_cluster = np.max(ind)
+    return (ind[:, np.newaxis] == np.arange(1, n_cluster + 1)).astype(float)
+
 def part(m,ind):
     # This function calculate the new partition with the intracluster values
-    n_cluster = np.max(ind)
-    new_m = np.identity(n_cluster, dtype=None)
-    for i1 in range(0, n_cluster):
-        for i2 in range(i1, n_cluster):
-            new_m[i1, i2] = np.mean(m[ind==i1+1,:][:,ind==i2+1])
+    return parts(m[np.newaxis, ...], ind)[0]
 
-    new_m += np.triu(new_m,1).T
-    return new_m
+def parts(ms, ind):
+    '''
+    Batched part() of a stack of matrices (subjects x n x n), the block means are P' M P / counts
+    '''
+    p = onehot(ind)
+    counts = p.sum(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_m = np.matmul(np.matmul(p.T, ms), p) / np.outer(counts, counts)
+    # symmetric, from the upper triangle
+    return np.triu(new_m) + np.swapaxes(np.triu(new_m, 1), -1, -2)
 
 def projectmat(source,ind):
     '''
     source: is a matrix
     part  : is a partition that we whant to map the data of the source in it
     '''
-    n_cluster = np.max(ind)
-    n = len(ind)
-    new_m = np.zeros((n,n))
-    for i1 in range(0,n_cluster):
-        for i2 in range(0,n_cluster):
-            index_2modif = getCoordo(ind,i1+1,i2+1,n)
-            new_m[index_2modif] = source[i1,i2]
+    return projectmats(source[np.newaxis, ...], ind)[0]
+
+def projectmats(sources, ind):
+    '''
+    Batched projectmat() of a stack of matrices (subjects x clusters x clusters)
+    '''
+    ind = np.asarray(ind)
+    valid = np.flatnonzero(ind > 0)
+    idx = ind[valid] - 1
+    new_m = np.zeros((sources.shape[0], len(ind), len(ind)))
+    new_m[:, valid[:, np.newaxis], valid] = np.take(np.take(sources, idx, axis=1), idx, axis=2)
     return new_m
 
 
@@ -67,13 +165,15 @@ def getCoordo(ind,i1,i2,n):
     return np.where(np.logical_and(new_m1,new_m2))
 
 def ind2matrix(ind):
-    n_cluster = np.max(ind)
-    new_m = np.zeros((len(ind), len(ind)))
-    for i1 in range(0, len(ind)):
-        same_id = np.where(ind == ind[i1])
-        new_m[i1, same_id] = ind[i1]
-        new_m[same_id,i1] = ind[i1]
-    return new_m
+    return ind2matrices(np.asarray(ind)[np.newaxis, :])[0]
+
+def ind2matrices(inds):
+    '''
+    Batched ind2matrix() of a stack of partitions (partitions x elements)
+    '''
+    inds = np.asarray(inds)
+    same = inds[:, :, np.newaxis] == inds[:, np.newaxis, :]
+    return np.where(same, inds[:, :, np.newaxis], 0).astype(float)
 
 def order(ind):
     order_idx = []
@@ -110,35 +210,113 @@ def get_mask_high2low(template_mask,template_high):
     return np.array(ind_low_scale)
 
 def getWindowCluster(timeseries,nclusters=12,window_size=20):
-    binary_mat = np.array([])
+    binary_mat = []
     for i in range(0,timeseries.shape[1]-window_size+1,1):
 
         clust_ind = hclustering(timeseries[:,i:i+window_size],nclusters)
 
-        tmp_mat = np.array(ind2matrix(clust_ind)>0,dtype=int)
-
-        if i==0:
-            binary_mat = ts.mat2vec(tmp_mat)[np.newaxis,:]
-        else:
-            binary_mat = np.vstack((binary_mat, ts.mat2vec(tmp_mat)[np.newaxis,:]))
+        binary_mat.append(np.array(ind2matrix(clust_ind)>0,dtype=int))
 
+    binary_mat = ts.mats2vecs(np.stack(binary_mat))
     print(binary_mat.shape)
     return binary_mat
 
+def _window_moments(x, window_size):
+    # window sums of each series and of its square from cumulative sums
+    cs = np.hstack((np.zeros((x.shape[0], 1)), np.cumsum(x, axis=1)))
+    css = np.hstack((np.zeros((x.shape[0], 1)), np.cumsum(x ** 2, axis=1)))
+    s = cs[:, window_size:] - cs[:, :-window_size]
+    ss = css[:, window_size:] - css[:, :-window_size]
+    return s, _window_var(window_size, s, ss)
+
+
+def _window_var(window_size, s, ss):
+    # window variance (times window_size^2), constant windows are set to nan
+    var = window_size * ss - s ** 2
+    var[var <= 1e-10 * window_size * ss] = np.nan
+    return var
+
+
+def window_corr(timeseries, window_size=20, chunk_size=2000, block_size=500):
+    '''
+        Rolling connectivity (one frame step) of all the windows in one pass from cumulative sums
+        timeseries (regions X time)
+        chunk_size: number of edges processed at once to bound the memory
+        block_size: number of windows sharing the same cumulative sums, the series are recentered on each block
+                    so that a drift of long series does not cancel the precision of the sums
+        return (windows X edges) in the mat2vec order, constant windows give nan like np.corrcoef
+    '''
+    x = np.array(timeseries, dtype=float)
+    n_windows = x.shape[1] - window_size + 1
+    idx_i, idx_j = np.triu_indices(x.shape[0], 1)
+    conn = np.empty((max(n_windows, 0), len(idx_i)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for wstart in range(0, n_windows, block_size):
+            wstop = min(wstart + block_size, n_windows)
+            x_ = x[:, wstart:wstop + window_size - 1]
+            x_ = x_ - x_.mean(axis=1)[:, np.newaxis]
+            s, var = _window_moments(x_, window_size)
+            for start in range(0, len(idx_i), chunk_size):
+                ii = idx_i[start:start + chunk_size]
+                jj = idx_j[start:start + chunk_size]
+                csp = np.hstack((np.zeros((len(ii), 1)), np.cumsum(x_[ii, :] * x_[jj, :], axis=1)))
+                sp = csp[:, window_size:] - csp[:, :-window_size]
+                num = window_size * sp - s[ii, :] * s[jj, :]
+                conn[wstart:wstop, start:start + chunk_size] = (num / np.sqrt(var[ii, :] * var[jj, :])).T
+    return np.clip(conn, -1., 1., out=conn)
+
+
+def iter_windows(timeseries, window_size=20):
+    '''
+        Streaming version of window_corr, yield the (edges) connectivity vector of each window
+        Only the running sums of the current window are kept in memory
+    '''
+    x = np.array(timeseries, dtype=float)
+    x -= x.mean(axis=1)[:, np.newaxis]
+    idx_i, idx_j = np.triu_indices(x.shape[0], 1)
+    w = window_size
+    s = x[:, :w].sum(axis=1)
+    ss = (x[:, :w] ** 2).sum(axis=1)
+    sp = (x[idx_i, :w] * x[idx_j, :w]).sum(axis=1)
+    for t in range(x.shape[1] - w + 1):
+        if t > 0:
+            out_, in_ = x[:, t - 1], x[:, t + w - 1]
+            s += in_ - out_
+            ss += in_ ** 2 - out_ ** 2
+            sp += in_[idx_i] * in_[idx_j] - out_[idx_i] * out_[idx_j]
+        var = _window_var(w, s, ss)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            yield np.clip((w * sp - s[idx_i] * s[idx_j]) / np.sqrt(var[idx_i] * var[idx_j]), -1., 1.)
+
+
+def window_stats(timeseries, window_size=20):
+    '''
+        Mean and std of the connectivity of each edge over the windows without keeping the windows
+        (Welford running accumulators on iter_windows)
+    '''
+    n = 0
+    mean_ = 0.
+    m2 = 0.
+    for conn in iter_windows(timeseries, window_size):
+        n += 1
+        delta = conn - mean_
+        mean_ = mean_ + delta / n
+        m2 = m2 + delta * (conn - mean_)
+    return mean_, np.sqrt(m2 / n)
+
+
 def getWindows(timeseries,window_size=20,vectorize=True):
-    conn_mat = []
-    for i in range(0,timeseries.shape[1]-window_size+1,1):
-        if vectorize:
-            tmp_conn_mat = np.corrcoef(timeseries[:,i:i+window_size])
-            if i==0:
-                conn_mat = ts.mat2vec(tmp_conn_mat)[np.newaxis,:]
-            else:
-                conn_mat = np.vstack((conn_mat, ts.mat2vec(tmp_conn_mat)[np.newaxis,:]))
-        else:
-            tmp_conn_mat = np.corrcoef(timeseries[:,i:i+window_size])
-            conn_mat.append(tmp_conn_mat)
-    conn_mat = np.array(conn_mat)
-    #print conn_mat.shape
+    conn_vec = window_corr(timeseries, window_size)
+    if vectorize:
+        return conn_vec
+    # (windows X regions X regions)
+    n = timeseries.shape[0]
+    idx_i, idx_j = np.triu_indices(n, 1)
+    conn_mat = np.empty((conn_vec.shape[0], n, n))
+    conn_mat[:, idx_i, idx_j] = conn_vec
+    conn_mat[:, idx_j, idx_i] = conn_vec
+    s, var = _window_moments(timeseries - timeseries.mean(axis=1)[:, np.newaxis], window_size)
+    conn_mat[:, np.arange(n), np.arange(n)] = np.where(np.isnan(var), np.nan, 1.).T
     return conn_mat
 
 # Test functions
@@ -148,3 +326,95 @@ def test_ind2matrix():
        [ 0.,  2.,  0.,  0.],
        [ 0.,  0.,  3.,  0.],
        [ 1.,  0.,  0.,  1.]]))
+
+
+def test_parts():
+    # reference: the loops over the clusters
+    rng = np.random.RandomState(0)
+    ind = np.array([1, 3, 2, 0, 1, 3, 3, 2, 0, 1])
+    ms = rng.randn(4, 10, 10)
+    ms += np.swapaxes(ms, 1, 2)
+    sources = rng.randn(4, 3, 3)
+    for m, pm, source, new_source in zip(ms, parts(ms, ind), sources, projectmats(sources, ind)):
+        ref = np.identity(3)
+        for i1 in range(3):
+            for i2 in range(i1, 3):
+                ref[i1, i2] = np.mean(m[ind == i1 + 1, :][:, ind == i2 + 1])
+        ref += np.triu(ref, 1).T
+        assert np.allclose(pm, ref) and np.allclose(part(m, ind), ref)
+
+        ref = np.zeros((10, 10))
+        for i1 in range(3):
+            for i2 in range(3):
+                ref[getCoordo(ind, i1 + 1, i2 + 1, 10)] = source[i1, i2]
+        assert np.allclose(new_source, ref) and np.allclose(projectmat(source, ind), ref)
+
+    inds = rng.randint(0, 4, (3, 10))
+    for ind_, new_m in zip(inds, ind2matrices(inds)):
+        ref = np.zeros((10, 10))
+        for i1 in range(10):
+            same_id = np.where(ind_ == ind_[i1])
+            ref[i1, same_id] = ind_[i1]
+            ref[same_id, i1] = ind_[i1]
+        assert np.all(new_m == ref) and np.all(ind2matrix(ind_) == ref)
+
+
+def test_window_corr():
+    rng = np.random.RandomState(0)
+    x = rng.randn(5, 300) + np.linspace(0, 100, 300) * np.array([1., 2., -1., .5, 0.])[:, np.newaxis]
+    x[4, 40:70] = 3.
+    window_size = 20
+    # loop of the previous getWindows
+    ref = []
+    ref_mat = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(0, x.shape[1] - window_size + 1, 1):
+            ref_mat.append(np.corrcoef(x[:, i:i + window_size]))
+            ref.append(ts.mat2vec(ref_mat[-1]))
+    ref = np.array(ref)
+    ref_mat = np.array(ref_mat)
+    assert np.allclose(window_corr(x, window_size, chunk_size=3, block_size=7), ref, equal_nan=True)
+    assert np.allclose(getWindows(x, window_size), ref, equal_nan=True)
+    assert np.allclose(getWindows(x, window_size, vectorize=False), ref_mat, equal_nan=True)
+    assert np.allclose(np.array(list(iter_windows(x, window_size))), ref, atol=1e-8, equal_nan=True)
+
+    # mean and std over the windows
+    ref = window_corr(x[:4], window_size)
+    mean_, std_ = window_stats(x[:4], window_size)
+    assert np.allclose(mean_, ref.mean(0)) and np.allclose(std_, ref.std(0))
+
+
+def test_weighted_ward():
+    rng = np.random.RandomState(0)
+    x = rng.randn(30, 4)
+    # singleton clusters: the exact Ward linkage
+    assert np.allclose(weighted_ward(x, np.ones(30))[:, 2], linkage(x, method='ward')[:, 2])
+    # clusters of repeated rows: the exact linkage once the repeated rows are merged
+    counts = rng.randint(1, 6, 30)
+    z = weighted_ward(x, counts)
+    z_rows = linkage(np.repeat(x, counts, axis=0), method='ward')
+    assert np.allclose(z[:, 2], z_rows[-29:, 2])
+    assert z[-1, 3] == 30
+    ind = fcluster(z, 4, criterion='maxclust')
+    ind_rows = fcluster(z_rows, 4, criterion='maxclust')[np.cumsum(counts) - 1]
+    assert np.all((ind[:, np.newaxis] == ind) == (ind_rows[:, np.newaxis] == ind_rows))
+
+
+def test_ward_tree():
+    # separable groups of unequal sizes, the k-means path gives the exact partition
+    rng = np.random.RandomState(0)
+    sizes = [400, 150, 50]
+    centers = 10 * rng.randn(3, 5)
+    x = np.vstack([c + rng.randn(n, 5) for c, n in zip(centers, sizes)])
+    truth = np.repeat(np.arange(3), sizes)
+    exact = WardTree().fit(x)
+    approx = WardTree(max_rows=100, n_centroids=60).fit(x)
+    assert exact.labels_ is None
+    assert approx.labels_ is not None
+    for tree in [exact, approx]:
+        ind = tree.cut(3)
+        # one label per group and one group per label
+        assert len(np.unique(ind)) == 3
+        for k in range(3):
+            assert len(np.unique(ind[truth == k])) == 1
+    assert np.all(hclustering(x, 3, max_rows=100, n_centroids=60) == approx.cut(3))
@@ -7,6 +7,7 @@ Copyright 2016 Christian Dansereau all right reserved
 """
 import numpy as np
 from sklearn.svm import SVC, SVR
+from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import StratifiedShuffleSplit, ShuffleSplit
@@ -15,6 +16,34 @@ from sklearn.preprocessing import scale
 
 from scipy.cluster.hierarchy import linkage
 from scipy.cluster.hierarchy import fcluster
+from scipy.optimize import minimize
+from proteus.predic import resampling
+from proteus.predic.search import PathSearchCV
+from proteus.predic import kernels
+
+
+def _search_cv(clf, param_grid, cv, scoring, search='grid'):
+    # search='path': regularization paths and pruning of the worse grid points (PathSearchCV) instead of the full grid.
+    # The paths are warm started only for the solvers that support it (PrimalLinearSvc, lbfgs/saga logistic
+    # regression), liblinear and libsvm refit each C from scratch and only gain from the pruning.
+    if search == 'path':
+        return PathSearchCV(clf, param_grid=param_grid, cv=cv, n_jobs=-1, scoring=scoring)
+    return GridSearchCV(clf, param_grid=param_grid, cv=cv, n_jobs=-1, scoring=scoring)
+
+
+def _set_kernel_cache(cache, *estimators):
+    # kernels of the PrecomputedSVC estimators, None releases the cache once the model is fitted
+    for estimator in estimators:
+        estimator.set_params(cache=cache)
+
+
+def _cached_call(clf, method, x, cache):
+    # x is the column of row indexes of the subjects in cache
+    clf.set_params(cache=cache)
+    try:
+        return getattr(clf, method)(x)
+    finally:
+        clf.set_params(cache=None)
 
 
 class nullClassifier(object):
@@ -28,21 +57,108 @@ class nullClassifier(object):
         return -np.ones_like(x[:, 0])
 
 
+def _squared_hinge(w, x, y, sample_weight, C):
+    # L2 regularized squared hinge loss and its gradient, the intercept (last term) is not regularized
+    coef = w[:-1]
+    margin = 1. - y * (x.dot(coef) + w[-1])
+    margin[margin < 0] = 0.
+    loss = .5 * coef.dot(coef) + C * np.sum(sample_weight * margin ** 2)
+    grad_f = -2. * C * sample_weight * margin * y
+    return loss, np.hstack((coef + x.T.dot(grad_f), grad_f.sum()))
+
+
+class PrimalLinearSvc(BaseEstimator, ClassifierMixin):
+    """
+    Linear SVM (L2 regularized squared hinge loss) solved in the primal with L-BFGS, one vs rest for multiclass.
+    With warm_start the previous solution is the starting point of the next fit, e.g. along the C path of
+    search.PathSearchCV where the consecutive fits are on the same training set.
+    """
+
+    def __init__(self, C=1., class_weight='balanced', warm_start=False, tol=1e-5, max_iter=500):
+        self.C = C
+        self.class_weight = class_weight
+        self.warm_start = warm_start
+        self.tol = tol
+        self.max_iter = max_iter
+
+    def fit(self, x, y):
+        x = np.asarray(x, dtype=float)
+        self.classes_ = np.unique(y)
+        targets = self.classes_[1:] if len(self.classes_) == 2 else self.classes_
+        if self.class_weight == 'balanced':
+            counts = np.array([np.sum(y == label) for label in self.classes_], dtype=float)
+            sample_weight = (len(y) / (len(self.classes_) * counts))[np.searchsorted(self.classes_, y)]
+        else:
+            sample_weight = np.ones(len(y))
+
+        w0 = np.zeros((len(targets), x.shape[1] + 1))
+        if self.warm_start and getattr(self, 'coef_', None) is not None and self.coef_.shape == (len(targets), x.shape[1]):
+            w0 = np.hstack((self.coef_, self.intercept_[:, np.newaxis]))
+
+        w = []
+        self.n_iter_ = 0
+        for k, label in enumerate(targets):
+            y_ = np.where(y == label, 1., -1.)
+            res = minimize(_squared_hinge, w0[k], args=(x, y_, sample_weight, self.C), jac=True, method='L-BFGS-B',
+                           options=dict(maxiter=self.max_iter, gtol=self.tol))
+            w.append(res.x)
+            self.n_iter_ = max(self.n_iter_, res.nit)
+        w = np.array(w)
+        self.coef_ = w[:, :-1]
+        self.intercept_ = w[:, -1]
+        return self
+
+    def decision_function(self, x):
+        df = np.asarray(x, dtype=float).dot(self.coef_.T) + self.intercept_
+        if len(self.classes_) == 2:
+            return df[:, 0]
+        return df
+
+    def predict(self, x):
+        df = self.decision_function(x)
+        if len(self.classes_) == 2:
+            return self.classes_[(df > 0).astype(int)]
+        return self.classes_[np.argmax(df, axis=1)]
+
+
 class BaseSvc(object):
-    def __init__(self, scoring_metric='accuracy', param_grid=dict(C=(np.logspace(-2, 1, 15)))):
+    def __init__(self, scoring_metric='accuracy', param_grid=dict(C=(np.logspace(-2, 1, 15))), solver='libsvm',
+                 search='grid', kernel_cache=False):
+        """
+        :param solver: 'libsvm' (SVC with a linear kernel) or 'primal' (PrimalLinearSvc, squared hinge loss)
+        :param kernel_cache: fit the libsvm solver on the Gram matrix of a kernels.KernelCache of the subjects
+        """
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
-        self.clf = SVC(C=1., cache_size=1000, kernel='linear', class_weight='balanced', probability=False,
-                       decision_function_shape='ovr', random_state=1)
-        self.gridclf = GridSearchCV(self.clf, param_grid=self.param_grid,
-                                    cv=StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                                    scoring=self.scoring_metric)
+        self.search = search
+        self.kernel_cache = kernel_cache and solver != 'primal'
+        if solver == 'primal':
+            self.clf = PrimalLinearSvc(C=1., class_weight='balanced')
+        elif self.kernel_cache:
+            self.clf = kernels.PrecomputedSVC(C=1., cache_size=1000, kernel='linear', class_weight='balanced',
+                                              decision_function_shape='ovr', random_state=1)
+        else:
+            self.clf = SVC(C=1., cache_size=1000, kernel='linear', class_weight='balanced', probability=False,
+                           decision_function_shape='ovr', random_state=1)
+        self.gridclf = _search_cv(self.clf, self.param_grid,
+                                  StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                                  self.scoring_metric, self.search)
         #self.gridclf = GridSearchCV(self.clf, param_grid=self.param_grid,
         #                            cv=5, n_jobs=-1,
         #                           scoring=self.scoring_metric)
 
 
-    def fit(self, x, y, hyperparams_optim=True):
+    def fit(self, x, y, hyperparams_optim=True, cache=None):
+        """
+        :param cache: kernels.KernelCache of the subjects, x is then the column of their row indexes in the cache
+                      (kernel_cache only, a cache of x is built for this fit when it is not given)
+        """
+        kernel_cache = getattr(self, 'kernel_cache', False)
+        if kernel_cache:
+            if cache is None:
+                cache = kernels.KernelCache(x)
+                x = np.arange(len(x))[:, np.newaxis]
+            _set_kernel_cache(cache, self.gridclf.estimator, self.clf)
         if hyperparams_optim & (np.sum(y) > 2):
 
             self.gridclf.fit(x, y)
@@ -50,34 +166,67 @@ class BaseSvc(object):
             self.gridclf.cv_results_ = None
         else:
             self.clf.fit(x, y)
+        if kernel_cache:
+            # the model predicts new subjects from its support vectors, the kernels are not kept
+            _set_kernel_cache(None, self.gridclf.estimator, self.clf)
 
-    def predict(self, x):
+    def predict(self, x, cache=None):
         if getattr(self, 'clf', None) is None:
             print('The model was not fit before prediction')
             return None
+        if getattr(self, 'kernel_cache', False):
+            if cache is not None:
+                return _cached_call(self.clf, 'predict', x, cache)
+            return self.clf.predict_data(x)
         return self.clf.predict(x)
 
-    def decision_function(self, x):
+    def decision_function(self, x, cache=None):
         if getattr(self, 'clf', None) is None:
             print('The model was not fit before prediction')
             return None
+        if getattr(self, 'kernel_cache', False):
+            if cache is not None:
+                return _cached_call(self.clf, 'decision_function', x, cache)
+            return self.clf.decision_function_data(x)
         return self.clf.decision_function(x)
 
 class BaseSvc_rbf(object):
-    def __init__(self, scoring_metric='accuracy', param_grid=dict(gamma=(np.logspace(-3, 0, 15)), C=(np.logspace(-2, 1, 15)))):
+    def __init__(self, scoring_metric='accuracy', param_grid=dict(gamma=(np.logspace(-3, 0, 15)), C=(np.logspace(-2, 1, 15))), search='grid',
+                 kernel_cache=False):
+        """
+        :param kernel_cache: fit on the rbf kernels of a kernels.KernelCache of the subjects, the squared distances
+                             are computed once for all the grid points and splits (gamma='scale' is computed on the
+                             training subjects of each fit)
+        """
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
-        self.clf = SVC(C=1., cache_size=1000, kernel='rbf', class_weight='balanced', probability=False,
-                       decision_function_shape='ovr', random_state=1)
-        self.gridclf = GridSearchCV(self.clf, param_grid=self.param_grid,
-                                    cv=StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                                    scoring=self.scoring_metric)
+        self.search = search
+        self.kernel_cache = kernel_cache
+        if kernel_cache:
+            self.clf = kernels.PrecomputedSVC(C=1., cache_size=1000, kernel='rbf', class_weight='balanced',
+                                              decision_function_shape='ovr', random_state=1)
+        else:
+            self.clf = SVC(C=1., cache_size=1000, kernel='rbf', class_weight='balanced', probability=False,
+                           decision_function_shape='ovr', random_state=1)
+        self.gridclf = _search_cv(self.clf, self.param_grid,
+                                  StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                                  self.scoring_metric, self.search)
         #self.gridclf = GridSearchCV(self.clf, param_grid=self.param_grid,
         #                            cv=5, n_jobs=-1,
         #                           scoring=self.scoring_metric)
 
 
-    def fit(self, x, y, hyperparams_optim=True):
+    def fit(self, x, y, hyperparams_optim=True, cache=None):
+        """
+        :param cache: kernels.KernelCache of the subjects, x is then the column of their row indexes in the cache
+                      (kernel_cache only, a cache of x is built for this fit when it is not given)
+        """
+        kernel_cache = getattr(self, 'kernel_cache', False)
+        if kernel_cache:
+            if cache is None:
+                cache = kernels.KernelCache(x)
+                x = np.arange(len(x))[:, np.newaxis]
+            _set_kernel_cache(cache, self.gridclf.estimator, self.clf)
         if hyperparams_optim & (np.sum(y) > 2):
 
             self.gridclf.fit(x, y)
@@ -85,27 +234,44 @@ class BaseSvc_rbf(object):
             self.gridclf.cv_results_ = None
         else:
             self.clf.fit(x, y)
+        if kernel_cache:
+            # the model predicts new subjects from its support vectors, the kernels are not kept
+            _set_kernel_cache(None, self.gridclf.estimator, self.clf)
 
-    def predict(self, x):
+    def predict(self, x, cache=None):
         if getattr(self, 'clf', None) is None:
             print('The model was not fit before prediction')
             return None
+        if getattr(self, 'kernel_cache', False):
+            if cache is not None:
+                return _cached_call(self.clf, 'predict', x, cache)
+            return self.clf.predict_data(x)
         return self.clf.predict(x)
 
-    def decision_function(self, x):
+    def decision_function(self, x, cache=None):
         if getattr(self, 'clf', None) is None:
             print('The model was not fit before prediction')
             return None
+        if getattr(self, 'kernel_cache', False):
+            if cache is not None:
+                return _cached_call(self.clf, 'decision_function', x, cache)
+            return self.clf.decision_function_data(x)
         return self.clf.decision_function(x)
 
 class BaseLR(object):
-    def __init__(self, scoring_metric='accuracy', param_grid=dict(C=(np.logspace(-0.2, 1, 15)))):
+    def __init__(self, scoring_metric='accuracy', param_grid=dict(C=(np.logspace(-0.2, 1, 15))), solver='liblinear',
+                 search='grid'):
+        """
+        :param solver: solver of the logistic regression
+        """
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
-        clf = LogisticRegression(C=1., class_weight='balanced', penalty='l2', solver='liblinear', max_iter=300, random_state=1)
-        self.gridclf = GridSearchCV(clf, param_grid=self.param_grid,
-                                    cv=StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                                    scoring=self.scoring_metric)
+        self.search = search
+        clf = LogisticRegression(C=1., class_weight='balanced', penalty='l2', solver=solver, max_iter=300, random_state=1)
+        self.clf = clf
+        self.gridclf = _search_cv(clf, self.param_grid,
+                                  StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                                  self.scoring_metric, self.search)
 
     def fit(self, x, y, hyperparams_optim=True):
         if hyperparams_optim:
@@ -129,16 +295,17 @@ class BaseLR(object):
 
 
 class ConfidenceLR(object):
-    def __init__(self, scoring_metric='f1_weighted', param_grid=dict(C=(np.logspace(-0.2, 1, 15)))):
+    def __init__(self, scoring_metric='f1_weighted', param_grid=dict(C=(np.logspace(-0.2, 1, 15))), search='grid'):
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
+        self.search = search
         self.t = []
 
     def _fit_branchmodel(self, xwl2, hm_y):
         clf = LogisticRegression(C=1., class_weight='balanced', penalty='l1', solver='liblinear', max_iter=300, random_state=1)
-        gridclf = GridSearchCV(clf, param_grid=self.param_grid,
-                               cv=StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                               scoring=self.scoring_metric)
+        gridclf = _search_cv(clf, self.param_grid,
+                             StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                             self.scoring_metric, self.search)
         # train
         if (len(np.unique(hm_y)) > 1) & (np.sum(hm_y) >= 2):
             gridclf.fit(xwl2, hm_y)
@@ -176,15 +343,16 @@ class ConfidenceLR(object):
 
 
 class MulticlassLR(object):
-    def __init__(self, scoring_metric='f1_weighted', param_grid=dict(C=(np.logspace(-0.2, 1, 15)))):
+    def __init__(self, scoring_metric='f1_weighted', param_grid=dict(C=(np.logspace(-0.2, 1, 15))), search='grid'):
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
+        self.search = search
 
     def _fit_branchmodel(self, xwl2, hm_y):
         clf = LogisticRegression(C=1., class_weight='balanced', penalty='l1', solver='liblinear', max_iter=300, random_state=1)
-        gridclf = GridSearchCV(clf, param_grid=self.param_grid,
-                               cv=StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                               scoring=self.scoring_metric)
+        gridclf = _search_cv(clf, self.param_grid,
+                             StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                             self.scoring_metric, self.search)
         # train
         if len(np.unique(hm_y)) > 1:
             gridclf.fit(xwl2, hm_y)
@@ -209,13 +377,14 @@ class MulticlassLR(object):
 
 
 class HC_LR(object):
-    def __init__(self, scoring_metric='accuracy', param_grid=dict(C=(np.logspace(-0.2, 1, 15)))):
+    def __init__(self, scoring_metric='accuracy', param_grid=dict(C=(np.logspace(-0.2, 1, 15))), search='grid'):
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
+        self.search = search
         clf = LogisticRegression(C=1., class_weight='balanced', penalty='l1', solver='liblinear', max_iter=300, random_state=1)
-        self.gridclf = GridSearchCV(clf, param_grid=self.param_grid,
-                                    cv=StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                                    scoring=self.scoring_metric)
+        self.gridclf = _search_cv(clf, self.param_grid,
+                                  StratifiedShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                                  self.scoring_metric, self.search)
 
     def fit(self, x, y):
         self.gridclf.fit(x, y)
@@ -242,13 +411,14 @@ class HC_LR(object):
 
 
 class HitProbability(object):
-    def __init__(self, scoring_metric='r2', param_grid=dict(C=(np.logspace(-0.1, 0.1, 15)))):
+    def __init__(self, scoring_metric='r2', param_grid=dict(C=(np.logspace(-0.1, 0.1, 15))), search='grid'):
         self.scoring_metric = scoring_metric
         self.param_grid = param_grid
+        self.search = search
         clf = SVR(C=1., cache_size=500, kernel='linear')
-        self.gridclf = GridSearchCV(clf, param_grid=self.param_grid,
-                                    cv=ShuffleSplit(n_splits=50, test_size=.2, random_state=1), n_jobs=-1,
-                                    scoring=self.scoring_metric)
+        self.gridclf = _search_cv(clf, self.param_grid,
+                                  ShuffleSplit(n_splits=50, test_size=.2, random_state=1),
+                                  self.scoring_metric, self.search)
 
     def fit(self, x, y):
         #self.gridclf.fit(x, y)
@@ -270,8 +440,17 @@ class TwoStagesPrediction(object):
     """
 
     def __init__(self, verbose=True, basemodel=[], confidencemodel=[], gamma=1., n_iter=100, min_gamma=0.8,
-                 thresh_ratio=0.1, shuffle_test_split=0.2, gamma_auto_adjust=True, recurrent_modes=3, hitprobability_strategy='shuffle',random_state=1):
+                 thresh_ratio=0.1, shuffle_test_split=0.2, gamma_auto_adjust=True, recurrent_modes=3, hitprobability_strategy='shuffle',random_state=1,
+                 n_jobs=1, warm_start=False):
+        """
+        :param n_jobs: number of workers of the resampling loops
+        :param warm_start: the resampling fits of the base model start from the solution of the previous split, in
+                           one chain of splits per worker (base models with a warm_start solver, e.g.
+                           BaseSvc(solver='primal'), see resampling.benchmark_warm_start)
+        """
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.warm_start = warm_start
         self.gamma = gamma
         self.n_iter = n_iter
         self.scaler_s1 = StandardScaler(with_mean=True, with_std=False)
@@ -331,8 +510,9 @@ class TwoStagesPrediction(object):
         """
         print('Stage 1')
         x_ = self.scaler_s1.fit_transform(x)
-        self.basemodel.fit(x_, y)
-        self.training_hit_probability = self._hitprobability(x_, y)
+        cache = self._kernel_cache(x_)
+        self._fit_basemodel(x_, y, cache)
+        self.training_hit_probability = self._hitprobability(x_, y, cache)
 
         # Learn the hit probability
         self.hitproba = HitProbability()
@@ -367,8 +547,9 @@ class TwoStagesPrediction(object):
         x_ = self.scaler_s1.fit_transform(x)
         x2_ = self.scaler_s2.fit_transform(x2)
 
-        self.basemodel.fit(x_, y)
-        self.training_hit_probability = self._hitprobability(x_, y)
+        cache = self._kernel_cache(x_)
+        self._fit_basemodel(x_, y, cache)
+        self.training_hit_probability = self._hitprobability(x_, y, cache)
 
         # Learn the hit probability
         self.hitproba = HitProbability()
@@ -420,9 +601,23 @@ class TwoStagesPrediction(object):
         x2_ = self.scaler_s2.fit_transform(x2)
         self.confidencemodel.fit(x2_, hm_1hot)
 
+    def _kernel_cache(self, x):
+        # kernels of the examples shared by all the fits of the base model, None when it does not use a cache
+        if getattr(self.basemodel, 'kernel_cache', False):
+            return kernels.KernelCache(x)
+        return None
+
+    def _fit_basemodel(self, x, y, cache=None, **fit_params):
+        # with a cache the base model is fit on the column of row indexes of the examples
+        if cache is not None:
+            x = np.arange(len(x))[:, np.newaxis]
+            fit_params['cache'] = cache
+        self.basemodel.fit(x, y, **fit_params)
+
     def _fit_mode(self, x, y):
-        self.basemodel.fit(x, y)
-        proba = self._hitprobability(x, y)
+        cache = self._kernel_cache(x)
+        self._fit_basemodel(x, y, cache)
+        proba = self._hitprobability(x, y, cache)
         mask_ = y == 1
         proba_tmp = proba.copy()
         proba_tmp[~mask_] = 0
@@ -516,34 +711,26 @@ class TwoStagesPrediction(object):
 
         return data_array, dict_array
 
-    def _hitprobability(self, x, y):
+    def _hitprobability(self, x, y, cache=None):
         if self.hitprobability_strategy == 'clustering':
-            return self._cluster_hitprobability(x, y)
+            return self._cluster_hitprobability(x, y, cache)
         elif self.hitprobability_strategy == 'window':
-            return self._window_hitprobability(x, y)
+            return self._window_hitprobability(x, y, cache)
         elif self.hitprobability_strategy == 'avg_cluster':
-            return self._avg_cluster_hitprobability(x, y)
+            return self._avg_cluster_hitprobability(x, y, cache=cache)
         else:
-            return self._shufflesplit(x, y)
+            return self._shufflesplit(x, y, cache)
 
-    def _shufflesplit(self, x, y):
+    def _shufflesplit(self, x, y, cache=None):
         """
         Random sampling to estimate the probability of a hit for each subjects from the parametrized model
         :param x: Input examples X features
         :param y: Labels to predict
+        :param cache: kernels.KernelCache of x shared by the fits of the base model (None without kernel cache)
         :return: Probability of hit for each examples
         """
-        hm_count = np.zeros_like(y).astype(float)
-        hm = np.zeros_like(y).astype(float)
         skf = StratifiedShuffleSplit(n_splits=self.n_iter, test_size=self.shuffle_test_split, random_state=self.random_state)
-
-        for train, test in skf.split(x, y):
-            # rnd_proba = np.abs(np.random.randn(len(train))*5.+1.)
-            # rnd_proba[train==0] = 1.
-            rnd_proba = None
-            self.basemodel.fit(x[train, :], y[train], hyperparams_optim=False)
-            hm_count[test] += 1.
-            hm[test] += (self.basemodel.predict(x[test, :]) == y[test]).astype(float)
+        hm, hm_count = self._hit_tally(x, y, skf.split(x, y), cache)
 
         proba = hm / hm_count
         if self.verbose:
@@ -551,10 +738,22 @@ class TwoStagesPrediction(object):
             # print(hm_count)
             print('Proba:')
             print(proba)
-        self.basemodel.fit(x, y, hyperparams_optim=False)
+        self._fit_basemodel(x, y, cache, hyperparams_optim=False)
         return proba
 
-    def _avg_cluster_hitprobability(self, x, y, n_clusters=30):
+    def _hit_tally(self, x, y, splits, cache=None):
+        # refit the base model on each split, in parallel with n_jobs, on the kernels of cache when given
+        fit_params = dict(hyperparams_optim=False)
+        predict_params = {}
+        if cache is not None:
+            x = np.arange(len(x))[:, np.newaxis]
+            fit_params['cache'] = cache
+            predict_params['cache'] = cache
+        return resampling.hit_tally(self.basemodel, x, y, splits, n_jobs=getattr(self, 'n_jobs', 1),
+                                    random_state=self.random_state, fit_params=fit_params,
+                                    predict_params=predict_params, warm_start=getattr(self, 'warm_start', False))
+
+    def _avg_cluster_hitprobability(self, x, y, n_clusters=30, cache=None):
         """
         Random sampling to estimate the probability of a hit for each subjects from the parametrized model
         :param x: Input examples X features
@@ -564,7 +763,7 @@ class TwoStagesPrediction(object):
         """
 
         # Compute the individual Hit probability
-        proba = self._shufflesplit(x, y)
+        proba = self._shufflesplit(x, y, cache)
 
         # average the individual hit probability for each cluster
         ind = self._cluster(x, x.shape[0]/2.)
@@ -577,26 +776,20 @@ class TwoStagesPrediction(object):
 
         return avg_proba
 
-    def _cluster_hitprobability(self, x, y):
+    def _cluster_hitprobability(self, x, y, cache=None):
         """
         Evaluate clusters to estimate the probability of a hit for each subjects from the parametrized model
         :param x: Input examples X features
         :param y: Labels to predict
         :return: Probability of hit for each examples
         """
-        hm_count = np.zeros_like(y).astype(float)
-        hm = np.zeros_like(y).astype(float)
         #skf = StratifiedShuffleSplit(n_splits=self.n_iter, test_size=self.shuffle_test_split, random_state=self.random_state)
 
         ind = self._cluster(x, 35)
 
-        for cluster_id in np.unique(ind):
-            test = np.argwhere(ind == cluster_id)[:, 0]
-            train = np.argwhere(ind != cluster_id)[:, 0]
-            #print test
-            self.basemodel.fit(x[train, :], y[train], hyperparams_optim=False)
-            hm_count[test] += 1.
-            hm[test] += (self.basemodel.predict(x[test, :]) == y[test]).astype(float)
+        splits = [(np.argwhere(ind != cluster_id)[:, 0], np.argwhere(ind == cluster_id)[:, 0])
+                  for cluster_id in np.unique(ind)]
+        hm, hm_count = self._hit_tally(x, y, splits, cache)
 
         proba = hm / hm_count
         if self.verbose:
@@ -604,31 +797,29 @@ class TwoStagesPrediction(object):
             # print(hm_count)
             print('Proba:')
             print(proba)
-        self.basemodel.fit(x, y, hyperparams_optim=False)
+        self._fit_basemodel(x, y, cache, hyperparams_optim=False)
         return proba
 
-    def _window_hitprobability(self, x, y):
+    def _window_hitprobability(self, x, y, cache=None):
         """
         Evaluate a window of clusters to estimate the probability of a hit for each subjects from the parametrized model
         :param x: Input examples X features
         :param y: Labels to predict
         :return: Probability of hit for each examples
         """
-        hm_count = np.zeros_like(y).astype(float)
-        hm = np.zeros_like(y).astype(float)
         #skf = StratifiedShuffleSplit(n_splits=self.n_iter, test_size=self.shuffle_test_split, random_state=self.random_state)
-        skf = StratifiedShuffleSplit(n_splits=self.n_iter, test_size=self.shuffle_test_split, random_state=self.random_state)
 
         ind = self._cluster(x, x.shape[0])
         ind = np.argsort(ind)
 
+        # the windows are drawn up front so that they do not depend on the workers
+        rng = np.random.RandomState(self.random_state)
+        splits = []
         for i in range(self.n_iter):
             # variable window size between 10% and 50%
-            window_size = np.random.randint(len(ind)*0.1, len(ind)*0.5)
-            train, test = self._window_indexes(ind, window_size)
-            self.basemodel.fit(x[train, :], y[train], hyperparams_optim=False)
-            hm_count[test] += 1.
-            hm[test] += (self.basemodel.predict(x[test, :]) == y[test]).astype(float)
+            window_size = rng.randint(len(ind)*0.1, len(ind)*0.5)
+            splits.append(self._window_indexes(ind, window_size, rng))
+        hm, hm_count = self._hit_tally(x, y, splits, cache)
 
         proba = hm / hm_count
         if self.verbose:
@@ -636,7 +827,7 @@ class TwoStagesPrediction(object):
             # print(hm_count)
             print('Proba:')
             print(proba)
-        self.basemodel.fit(x, y, hyperparams_optim=False)
+        self._fit_basemodel(x, y, cache, hyperparams_optim=False)
         return proba
 
     def _cluster(self, x, n_clusters):
@@ -649,8 +840,8 @@ class TwoStagesPrediction(object):
         ind = fcluster(row_clusters, n_clusters, criterion='maxclust')
         return ind
 
-    def _window_indexes(self, x, test_size):
-        seed_ = np.random.randint(0, x.shape[0] + 1)
+    def _window_indexes(self, x, test_size, rng=np.random):
+        seed_ = rng.randint(0, x.shape[0] + 1)
         mask = np.zeros_like(x).astype(bool)
 
         if seed_ > x.shape[0] - test_size:
@@ -662,3 +853,86 @@ class TwoStagesPrediction(object):
         test = x[mask]
 
         return train, test
+
+
+
+def test_primal_linear_svc():
+    from sklearn.svm import LinearSVC
+    rng = np.random.RandomState(0)
+    x = rng.randn(120, 10)
+    y = (x[:, :3].sum(1) + .5 * rng.randn(120) > 0.5).astype(int)
+
+    # same objective as LinearSVC, with a large intercept scaling so that its intercept is barely regularized
+    clf = PrimalLinearSvc(C=0.1).fit(x, y)
+    ref = LinearSVC(C=0.1, loss='squared_hinge', class_weight='balanced', intercept_scaling=100., tol=1e-8,
+                    max_iter=100000).fit(x, y)
+    assert np.allclose(clf.coef_, ref.coef_, atol=1e-4)
+    assert np.allclose(clf.intercept_, ref.intercept_, atol=1e-4)
+    assert np.all(clf.predict(x) == ref.predict(x))
+    assert clf.decision_function(x).shape == (len(x),)
+
+    # warm start from the previous solution gives the same model in fewer iterations
+    warm = PrimalLinearSvc(C=0.1, warm_start=True).fit(x, y)
+    n_iter = warm.n_iter_
+    warm.set_params(C=0.11).fit(x, y)
+    cold = PrimalLinearSvc(C=0.11).fit(x, y)
+    assert warm.n_iter_ < n_iter
+    assert np.allclose(warm.coef_, cold.coef_, atol=1e-3)
+
+    # one vs rest
+    y3 = np.digitize(x[:, 0], [-.5, .5])
+    clf = PrimalLinearSvc(C=1.).fit(x, y3)
+    assert clf.coef_.shape == (3, x.shape[1])
+    assert clf.decision_function(x).shape == (len(x), 3)
+    assert set(clf.predict(x)) <= set(y3)
+
+
+def test_two_stages_kernel_cache():
+    rng = np.random.RandomState(0)
+    x = rng.randn(60, 15)
+    x2 = rng.randn(60, 5)
+    y = (x[:, :2].sum(1) + .5 * rng.randn(60) > 0).astype(int)
+    param_grid = dict(C=[0.01, 0.1, 1.])
+
+    # one cache of the examples for all the fits of the base model
+    n_cache = []
+    kernel_cache = kernels.KernelCache
+
+    class CountingCache(kernel_cache):
+        def __init__(self, *args, **kwargs):
+            n_cache.append(1)
+            kernel_cache.__init__(self, *args, **kwargs)
+
+    kernels.KernelCache = CountingCache
+    try:
+        cached = TwoStagesPrediction(verbose=False, n_iter=10, n_jobs=2,
+                                     basemodel=BaseSvc(param_grid=param_grid, kernel_cache=True))
+        cached.fit(x, x2, y)
+    finally:
+        kernels.KernelCache = kernel_cache
+    assert len(n_cache) == 1
+    assert getattr(cached.basemodel.clf, 'cache', None) is None
+
+    # same hit probabilities and predictions as the base model fitted on the features
+    ref = TwoStagesPrediction(verbose=False, n_iter=10, n_jobs=2, basemodel=BaseSvc(param_grid=param_grid))
+    ref.fit(x, x2, y)
+    assert np.allclose(cached.training_hit_probability, ref.training_hit_probability, equal_nan=True)
+    assert np.all(cached.basemodel.predict(x) == ref.basemodel.predict(x))
+    assert np.allclose(cached.predict(x, x2)[0][:, 0], ref.predict(x, x2)[0][:, 0], atol=1e-2)
+
+
+def test_two_stages_warm_start():
+    rng = np.random.RandomState(0)
+    x = rng.randn(80, 15)
+    x2 = rng.randn(80, 5)
+    y = (x[:, :2].sum(1) + .5 * rng.randn(80) > 0).astype(int)
+    param_grid = dict(C=[0.01, 0.1, 1.])
+    probas = []
+    for warm_start in [False, True]:
+        model = TwoStagesPrediction(verbose=False, n_iter=20, n_jobs=2, warm_start=warm_start,
+                                    basemodel=BaseSvc(param_grid=param_grid, solver='primal'))
+        model.fit(x, x2, y)
+        probas.append(model.training_hit_probability)
+    # the warm started splits reach the same solutions
+    assert np.nanmax(np.abs(probas[0] - probas[1])) <= .2
+    assert np.nanmean(np.abs(probas[0] - probas[1])) < .02
@@ -0,0 +1,188 @@
+__author__ = 'Christian Dansereau'
+
+"""
+Precomputed kernels shared by the SVC fits of the grid searches and resampling loops
+The (subjects x subjects) linear Gram matrix and squared distances are computed once, the folds and grid points
+slice them with the row indexes of the subjects instead of recomputing the kernel from the features.
+"""
+from collections import OrderedDict
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.svm import SVC
+from sklearn.metrics.pairwise import linear_kernel, rbf_kernel
+
+class KernelCache(object):
+    '''
+    Linear Gram matrix and squared euclidean distances of the rows of x (float32), and the rbf kernels of the
+    last gammas used, the least recently used rbf kernels are dropped to stay under max_bytes.
+    The cache is read only and shared: a deep copy (sklearn clone) returns the same object. It is built once by
+    the caller for all the subjects and passed explicitly to the estimators with the row indexes of their subjects.
+    '''
+
+    def __init__(self, x, max_bytes=2 ** 30, dtype=np.float32):
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        n = self.x.shape[0]
+        if 2 * n * n * np.dtype(dtype).itemsize > max_bytes:
+            raise MemoryError('The kernels of ' + str(n) + ' subjects do not fit in ' + str(max_bytes) + ' bytes')
+        self.gram = np.empty((n, n), dtype=dtype)
+        self.sqdist = np.empty((n, n), dtype=dtype)
+        sq = np.einsum('ij,ij->i', self.x, self.x)
+        # by blocks of rows so that the float64 products stay a fraction of max_bytes
+        step = max(1, int(max_bytes // (8 * 8 * max(n, 1))))
+        for start in range(0, n, step):
+            block = self.x[start:start + step].dot(self.x.T)
+            self.gram[start:start + step] = block
+            block *= -2.
+            block += sq[start:start + step, np.newaxis]
+            block += sq[np.newaxis, :]
+            np.maximum(block, 0, out=block)
+            self.sqdist[start:start + step] = block
+        self._rbf = OrderedDict()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        # the rbf kernels are recomputed by the worker processes instead of being pickled
+        state = self.__dict__.copy()
+        state['_rbf'] = OrderedDict()
+        return state
+
+    @property
+    def nbytes(self):
+        return self.gram.nbytes + self.sqdist.nbytes + sum(k.nbytes for k in self._rbf.values())
+
+    def gamma_value(self, gamma, idx=None):
+        '''
+            Numeric value of gamma, same definitions as SVC computed on the rows idx (the training subjects)
+        '''
+        x = self.x if idx is None else self.x[idx]
+        if gamma == 'scale':
+            return 1. / (x.shape[1] * x.var())
+        if gamma == 'auto':
+            return 1. / x.shape[1]
+        return float(gamma)
+
+    def kernel(self, kernel='linear', gamma=1.):
+        '''
+            Full (subjects x subjects) kernel matrix
+            kernel: 'linear' or 'rbf'
+            gamma:  numeric gamma of the rbf kernel (see gamma_value)
+        '''
+        if kernel == 'linear':
+            return self.gram
+        if kernel != 'rbf':
+            raise ValueError('Unsupported kernel: ' + str(kernel))
+        gamma = float(gamma)
+        if gamma in self._rbf:
+            k = self._rbf.pop(gamma)
+        else:
+            k = self.sqdist * self.dtype(-gamma)
+            np.exp(k, out=k)
+            while len(self._rbf) and self.nbytes + k.nbytes > self.max_bytes:
+                self._rbf.popitem(last=False)
+            if self.nbytes + k.nbytes > self.max_bytes:
+                return k
+        self._rbf[gamma] = k
+        return k
+
+
+class PrecomputedSVC(BaseEstimator, ClassifierMixin):
+    """
+    SVC fitted on a precomputed kernel sliced from a KernelCache.
+    fit, predict, decision_function and score take a column of row indexes of the cache (n x 1) in place of the
+    features, so that the sklearn splitters and grid searches can be used unchanged.
+    predict_data and decision_function_data take features of new subjects.
+    """
+
+    def __init__(self, cache=None, kernel='linear', C=1., gamma='scale', class_weight=None, cache_size=200,
+                 decision_function_shape='ovr', random_state=None):
+        self.cache = cache
+        self.kernel = kernel
+        self.C = C
+        self.gamma = gamma
+        self.class_weight = class_weight
+        self.cache_size = cache_size
+        self.decision_function_shape = decision_function_shape
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        idx = np.asarray(X, dtype=int).ravel()
+        # gamma='scale' is computed on the training subjects, as SVC does on its features
+        self.gamma_ = self.cache.gamma_value(self.gamma, idx) if self.kernel == 'rbf' else None
+        k = self.cache.kernel(self.kernel, self.gamma_)
+        self.svc_ = SVC(kernel='precomputed', C=self.C, class_weight=self.class_weight, cache_size=self.cache_size,
+                        decision_function_shape=self.decision_function_shape, random_state=self.random_state)
+        self.svc_.fit(k[np.ix_(idx, idx)], y)
+        self.classes_ = self.svc_.classes_
+        self.train_index_ = idx
+        self.support_ = idx[self.svc_.support_]
+        self.support_vectors_ = self.cache.x[self.support_]
+        self.n_support_ = self.svc_.n_support_
+        self.dual_coef_ = self.svc_.dual_coef_
+        self.intercept_ = self.svc_.intercept_
+        return self
+
+    @property
+    def coef_(self):
+        if self.kernel != 'linear':
+            raise AttributeError('coef_ is only available for the linear kernel')
+        return self.dual_coef_.dot(self.support_vectors_)
+
+    def _kernel_index(self, X):
+        idx = np.asarray(X, dtype=int).ravel()
+        return self.cache.kernel(self.kernel, self.gamma_)[np.ix_(idx, self.train_index_)]
+
+    def _kernel_data(self, x):
+        # only the support vector columns contribute to the decision function
+        kx = np.zeros((len(x), len(self.train_index_)))
+        if self.kernel == 'linear':
+            kx[:, self.svc_.support_] = linear_kernel(x, self.support_vectors_)
+        else:
+            kx[:, self.svc_.support_] = rbf_kernel(x, self.support_vectors_, gamma=self.gamma_)
+        return kx
+
+    def decision_function(self, X):
+        return self.svc_.decision_function(self._kernel_index(X))
+
+    def predict(self, X):
+        return self.svc_.predict(self._kernel_index(X))
+
+    def decision_function_data(self, x):
+        return self.svc_.decision_function(self._kernel_data(x))
+
+    def predict_data(self, x):
+        return self.svc_.predict(self._kernel_data(x))
+
+
+def test_precomputed_svc():
+    rng = np.random.RandomState(0)
+    x = rng.randn(60, 20)
+    y = (x[:, :2].sum(1) + .5 * rng.randn(60) > 0).astype(int)
+    x_new = rng.randn(10, 20)
+    train = np.arange(40)
+    test = np.arange(40, 60)
+    cache = KernelCache(x, max_bytes=2 ** 20)
+    assert np.allclose(cache.gram, x.dot(x.T), rtol=1e-5, atol=1e-3)
+    assert np.allclose(cache.sqdist, ((x[:, np.newaxis] - x[np.newaxis]) ** 2).sum(-1), rtol=1e-5, atol=1e-3)
+
+    # same models as SVC fitted on the features of the training subjects, gamma='scale' on the training subjects
+    for kernel, gamma in [('linear', 'scale'), ('rbf', 'scale'), ('rbf', 0.05)]:
+        ref = SVC(kernel=kernel, C=.5, gamma=gamma, class_weight='balanced').fit(x[train], y[train])
+        clf = PrecomputedSVC(cache, kernel=kernel, C=.5, gamma=gamma, class_weight='balanced')
+        clf.fit(train[:, np.newaxis], y[train])
+        assert np.all(clf.predict(test[:, np.newaxis]) == ref.predict(x[test]))
+        assert np.allclose(clf.decision_function(test[:, np.newaxis]), ref.decision_function(x[test]), atol=1e-2)
+        assert np.all(clf.predict_data(x_new) == ref.predict(x_new))
+        assert np.allclose(clf.decision_function_data(x_new), ref.decision_function(x_new), atol=1e-2)
+        if kernel == 'rbf':
+            assert np.isclose(clf.gamma_, ref._gamma)
+
+    # the least recently used rbf kernels are dropped to stay under max_bytes
+    cache = KernelCache(x, max_bytes=4 * x.shape[0] ** 2 * 4)
+    for gamma in [0.1, 0.2, 0.3]:
+        cache.kernel('rbf', gamma)
+    assert list(cache._rbf.keys()) == [0.2, 0.3]
+    assert cache.nbytes <= cache.max_bytes
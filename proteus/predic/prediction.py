@@ -1,6 +1,10 @@
 __author__ = 'Christian Dansereau'
 
 import numpy as np
+import hashlib
+import os
+import threading
+import tempfile
 from sklearn.feature_selection import SelectFpr
 from sklearn.model_selection import StratifiedKFold, LeaveOneOut
 from sklearn.ensemble import AdaBoostClassifier
@@ -41,6 +45,9 @@ def estimate_unbalanced_std(y1, y2):
 
 
 def get_corrvox_gs(data_ts, head_mask, regions):
+    # regions can be a compiled proteus.matrix.Atlas that also hold the brain mask
+    if head_mask is None:
+        head_mask = regions.mask
     # remove GS
     cf_rm = ConfoundsRm(data_ts[head_mask].mean(0).reshape(-1, 1), data_ts[head_mask].T, intercept=False)
     data_ts[head_mask] = cf_rm.transform(data_ts[head_mask].mean(0).reshape(-1, 1), data_ts[head_mask].T).T
@@ -52,6 +59,9 @@ def get_corrvox_gs(data_ts, head_mask, regions):
 
 
 def get_corrvox(data_ts, head_mask, regions):
+    # regions can be a compiled proteus.matrix.Atlas that also hold the brain mask
+    if head_mask is None:
+        head_mask = regions.mask
     # extract time series
     ts_regions = ts.get_ts(data_ts, regions)
     ts_allvox = data_ts[head_mask]
@@ -60,6 +70,8 @@ def get_corrvox(data_ts, head_mask, regions):
 
 
 def get_corrvox_std(data_ts, head_mask, regions):
+    if head_mask is None:
+        head_mask = regions.mask
     # extract time series std
     ts_regions = ts.get_ts(data_ts, regions, metric='std')
     ts_allvox = data_ts[head_mask]
@@ -67,81 +79,266 @@ def get_corrvox_std(data_ts, head_mask, regions):
     return ts.corr(ts_regions, ts_allvox)
 
 
+# cached pseudo-inverse of the confounds design matrices, key: (confounds hash, shape, intercept)
+# the cache is shared by the seeds trained in a thread pool (sbp.SBP with n_jobs != 1)
+_design_cache = {}
+_design_cache_size = 16
+_design_cache_lock = threading.Lock()
+
+
+def design_matrix(confounds, intercept=True):
+    confounds = np.asarray(confounds, dtype=float)
+    if confounds.ndim == 1:
+        confounds = confounds.reshape(-1, 1)
+    if intercept:
+        return np.hstack((np.ones((confounds.shape[0], 1)), confounds))
+    return confounds
+
+
+def pinv_design(confounds, intercept=True):
+    '''
+        Pseudo-inverse of the design matrix, computed once for a given set of confounds
+    '''
+    confounds = np.ascontiguousarray(confounds, dtype=float)
+    key = (hashlib.sha1(confounds.tobytes()).hexdigest(), confounds.shape, bool(intercept))
+    with _design_cache_lock:
+        pinv = _design_cache.get(key)
+    if pinv is None:
+        pinv = np.linalg.pinv(design_matrix(confounds, intercept))
+        with _design_cache_lock:
+            if key not in _design_cache and len(_design_cache) >= _design_cache_size:
+                _design_cache.pop(next(iter(_design_cache)))
+            _design_cache[key] = pinv
+    return pinv
+
+
 class ConfoundsRm:
-    def __init__(self, confounds, data, intercept=True):
-        self.fit(confounds, data, intercept)
+    def __init__(self, confounds=None, data=None, intercept=True):
+        self.fit_intercept = intercept
+        self.nconfounds = 0
+        self._xtx = None
+        if confounds is not None:
+            self.fit(confounds, data, intercept)
 
     def fit(self, confounds, data, intercept=True):
+        '''
+            Least square fit of the confounds on the data (subjects x ...)
+            The design matrix factorization is shared by all the data fitted with the same confounds
+        '''
         self.data_dim = data.shape
-        if confounds == []:
+        self.fit_intercept = intercept
+        if len(confounds) == 0:
             print('No confounds')
             self.nconfounds = 0
         else:
-            if len(self.data_dim) == 3:
-                self.a1, self.a2, self.a3 = data.shape
-                data_ = data.reshape((self.a1, self.a2 * self.a3))
-            elif len(self.data_dim) == 4:
-                self.a1, self.a2, self.a3, self.a4 = data.shape
-                data_ = data.reshape((self.a1, self.a2 * self.a3 * self.a4))
-            else:
-                data_ = data
-            self.nconfounds = confounds.shape[1]
-            self.reg = linear_model.LinearRegression(fit_intercept=intercept)
-            # print data_.shape,confounds.shape
-            self.reg.fit(confounds, data_)
-
-    def transform(self, confounds, data):
-        # compute the residual error
+            data_ = data.reshape((data.shape[0], -1))
+            self.nconfounds = np.shape(confounds)[1]
+            # design coefficients (intercept + confounds x features)
+            self.beta = pinv_design(confounds, intercept).dot(data_)
+            self._beta32 = None
+        self._unsolved = False
+
+    def partial_fit(self, confounds, data):
+        '''
+            Incremental fit on a chunk of subjects, X'X and X'Y are accumulated so that the
+            full (subjects x features) matrix never has to be in memory, the coefficients are solved
+            once after the last chunk (fit_stream) or on first use
+        '''
+        x = design_matrix(confounds, self.fit_intercept)
+        data_ = data.reshape((data.shape[0], -1))
+        if self._xtx is None:
+            self._xtx = np.zeros((x.shape[1], x.shape[1]))
+            self._xty = np.zeros((x.shape[1], data_.shape[1]))
+            self.n_samples = 0
+        self._xtx += x.T.dot(x)
+        self._xty += x.T.dot(data_)
+        self.n_samples += data.shape[0]
+        self.data_dim = (self.n_samples,) + data.shape[1:]
+        self.nconfounds = x.shape[1] - int(self.fit_intercept)
+        self._unsolved = True
+        return self
+
+    def _solve(self):
+        # coefficients of the normal equations accumulated by partial_fit
+        if getattr(self, '_unsolved', False):
+            self.beta = np.linalg.pinv(self._xtx).dot(self._xty)
+            self._beta32 = None
+            self._unsolved = False
+
+    def fit_stream(self, chunks):
+        '''
+            Fit on an iterable of (confounds, data) chunks
+        '''
+        self._xtx = None
+        for confounds, data in chunks:
+            self.partial_fit(confounds, data)
+        self._solve()
+        return self
+
+    def transform_stream(self, chunks, out):
+        '''
+            Residualize an iterable of (confounds, data) chunks in out (e.g. a np.memmap),
+            the rows of out follow the order of the chunks
+        '''
+        self._check_fitted()
+        start = 0
+        for confounds, data in chunks:
+            stop = start + data.shape[0]
+            out[start:stop, ...] = self.transform(confounds, data, dtype=out.dtype).reshape((-1,) + out.shape[1:])
+            start = stop
+        if hasattr(out, 'flush'):
+            out.flush()
+        return out
+
+    def _check_fitted(self):
+        if getattr(self, 'data_dim', None) is None:
+            raise ValueError('ConfoundsRm is not fitted, call fit, partial_fit or fit_stream first')
+
+    def _get_beta(self, dtype):
+        self._solve()
+        if dtype == np.float32:
+            if getattr(self, '_beta32', None) is None:
+                self._beta32 = self.beta.astype(np.float32)
+            return self._beta32
+        return self.beta
+
+    def transform(self, confounds, data, copy=True, dtype=None):
+        '''
+            Compute the residual error
+            copy:  if False the residuals are computed in place in data (same dtype)
+            dtype: type of the residuals (np.float32 halve the memory and the GEMM cost)
+        '''
+        self._check_fitted()
         if self.nconfounds == 0:
             return data
+        if not copy:
+            dtype = data.dtype
+        elif dtype is None:
+            dtype = np.result_type(data.dtype, np.float64)
+        x = design_matrix(confounds, self.fit_intercept).astype(dtype)
+        if copy:
+            res = np.array(data.reshape((data.shape[0], -1)), dtype=dtype)
         else:
-            if len(data.shape) == 3:
-                data_ = data.reshape((data.shape[0], data.shape[1] * data.shape[2]))
-                res = data_ - self.reg.predict(confounds)
-                return res.reshape((data.shape[0], data.shape[1], data.shape[2]))
-            elif len(data.shape) == 4:
-                data_ = data.reshape((data.shape[0], data.shape[1] * data.shape[2] * data.shape[3]))
-                res = data_ - self.reg.predict(confounds)
-                return res.reshape((data.shape[0], data.shape[1], data.shape[2], data.shape[3]))
-            else:
-                data_ = data
-                return data_ - self.reg.predict(confounds)
-
-    def transform_batch(self, confounds, data, batch_size=50):
-        # compute the residual error
+            res = data.reshape((data.shape[0], -1))
+        res -= x.dot(self._get_beta(dtype))
+        return res.reshape(data.shape)
+
+    def batch_rows(self, data, mem_budget=2 ** 28, dtype=None):
+        '''
+            Number of rows of data per batch so that a batch (input copy and residuals) fits in mem_budget bytes
+        '''
+        if dtype is None:
+            dtype = np.result_type(data.dtype, np.float64)
+        row_bytes = 2 * int(np.prod(data.shape[1:])) * np.dtype(dtype).itemsize
+        return max(1, int(mem_budget // row_bytes))
+
+    def iter_transform(self, confounds, data, batch_size=None, mem_budget=2 ** 28, dtype=None):
+        '''
+            Generator of the residuals by batch of rows
+            batch_size: number of rows per batch, default to the number of rows fitting in mem_budget bytes
+        '''
+        self._check_fitted()
+        if batch_size is None:
+            batch_size = self.batch_rows(data, mem_budget, dtype)
+        for start in range(0, data.shape[0], batch_size):
+            stop = start + batch_size
+            yield self.transform(confounds[start:stop, ...], data[start:stop, ...], dtype=dtype)
+
+    def transform_batch(self, confounds, data, batch_size=None, out=None, mem_budget=2 ** 28, dtype=None):
+        '''
+            Compute the residual error by batch of rows
+            out: optional output buffer (e.g. a np.memmap) of the shape of data
+        '''
+        self._check_fitted()
         if self.nconfounds == 0:
-            return data
-        else:
-            # batch convert the data
-            nbatch = data.shape[0] / (batch_size)  # number of batch
-            batch_res = []
-            for idx_batch in range(nbatch):
-                if idx_batch == nbatch - 1:
-                    batch_res.append(
-                        self.transform(confounds[idx_batch * batch_size:-1, ...], data[idx_batch * batch_size:-1, ...]))
-                else:
-                    batch_res.append(self.transform(confounds[idx_batch * batch_size:(1 + idx_batch) * batch_size, ...],
-                                                    data[idx_batch * batch_size:(1 + idx_batch) * batch_size, ...]))
-            return np.vstack(batch_res)
+            if out is None:
+                return data
+            out[...] = data
+            return out
+        if out is None:
+            if dtype is None:
+                dtype = np.result_type(data.dtype, np.float64)
+            out = np.empty(data.shape, dtype=dtype)
+        start = 0
+        for res in self.iter_transform(confounds, data, batch_size, mem_budget, out.dtype):
+            out[start:start + res.shape[0], ...] = res
+            start += res.shape[0]
+        return out
 
     def nConfounds(self):
         return self.nconfounds
 
     def intercept(self):
-        if len(self.data_dim) == 3:
-            return self.reg.intercept_.reshape((1, self.data_dim[1], self.data_dim[2]))
-        elif len(self.data_dim) == 4:
-            return self.reg.intercept_.reshape((1, self.data_dim[1], self.data_dim[2], self.data_dim[3]))
+        self._solve()
+        if not self.fit_intercept:
+            return np.zeros((1,) + self.data_dim[1:])
+        if len(self.data_dim) > 2:
+            return self.beta[0].reshape((1,) + self.data_dim[1:])
         else:
-            return self.reg.intercept_
-
-
-def compute_acc_noconf(x, y, verbose=False, balanced=True, loo=False, nfolds=10, gs_kfolds=5, optimize=True, C=.01):
-    return compute_acc_conf(x, y, [], verbose, balanced, loo, nfolds, gs_kfolds, optimize, C)
+            return self.beta[0]
+
+
+def residualize_stream(make_chunks, out_file=None, dtype=np.float32, intercept=True, tmp_dir=None):
+    '''
+        Out-of-core confounds regression in two streaming passes
+        make_chunks: function returning a new iterator of (confounds, data) chunks at each call
+        out_file:    file of the memory-mapped residuals, default to a temporary file in tmp_dir
+        return the fitted ConfoundsRm and the residuals (np.memmap samples x features)
+    '''
+    crm = ConfoundsRm(intercept=intercept)
+    crm.fit_stream(make_chunks())
+    if out_file is None:
+        fd, out_file = tempfile.mkstemp(suffix='.dat', dir=tmp_dir)
+        os.close(fd)
+    out = np.memmap(out_file, mode='w+', dtype=dtype, shape=(crm.n_samples, int(np.prod(crm.data_dim[1:]))))
+    crm.transform_stream(make_chunks(), out)
+    return crm, out
+
+
+def test_confounds_rm_batch():
+    rng = np.random.RandomState(0)
+    confounds = rng.randn(30, 2)
+    data = rng.randn(30, 4, 5)
+    crm = ConfoundsRm(confounds, data)
+    ref = crm.transform(confounds, data)
+    out = np.zeros_like(data)
+    assert np.allclose(crm.transform_batch(confounds, data, batch_size=7, out=out), ref)
+    assert np.allclose(out, ref)
+    assert np.allclose(np.vstack(list(crm.iter_transform(confounds, data, batch_size=7))), ref)
+    # streaming fit and transform
+    crm_stream = ConfoundsRm().fit_stream((confounds[ii:ii + 10], data[ii:ii + 10]) for ii in range(0, 30, 10))
+    out = np.zeros((30, 20))
+    crm_stream.transform_stream(((confounds[ii:ii + 10], data[ii:ii + 10]) for ii in range(0, 30, 10)), out)
+    assert np.allclose(out, ref.reshape((30, -1)))
+    # the coefficients are solved on first use, not at each chunk
+    crm_partial = ConfoundsRm()
+    for ii in range(0, 30, 10):
+        crm_partial.partial_fit(confounds[ii:ii + 10], data[ii:ii + 10])
+    assert getattr(crm_partial, 'beta', None) is None
+    assert np.allclose(crm_partial.transform(confounds, data), ref)
+    # without confounds the data is copied in the output buffer
+    crm_none = ConfoundsRm([], data)
+    out = np.zeros_like(data)
+    assert crm_none.transform_batch([], data, out=out) is out
+    assert np.all(out == data)
+    # an unfitted model does not pass its input through
+    for transform in [lambda crm_: crm_.transform(confounds, data),
+                      lambda crm_: crm_.transform_batch(confounds, data, out=np.zeros_like(data)),
+                      lambda crm_: list(crm_.iter_transform(confounds, data))]:
+        try:
+            transform(ConfoundsRm())
+            assert False
+        except ValueError:
+            pass
+
+
+def compute_acc_noconf(x, y, verbose=False, balanced=True, loo=False, nfolds=10, gs_kfolds=5, optimize=True, C=.01,
+                       kernel_cache=False):
+    return compute_acc_conf(x, y, [], verbose, balanced, loo, nfolds, gs_kfolds, optimize, C, kernel_cache)
 
 
 def compute_acc_conf(x, y, confounds, verbose=False, balanced=True, loo=False, nfolds=10, gs_kfolds=5, optimize=True,
-                     C=.01):
+                     C=.01, kernel_cache=False):
     encoder = preprocessing.LabelEncoder()
     encoder.fit(y)
 
@@ -191,7 +388,8 @@ def compute_acc_conf(x, y, confounds, verbose=False, balanced=True, loo=False, n
 
         # clf.probability = True
         if optimize:
-            clf, score = plib.grid_search(clf, xtrain, ytrain, n_folds=gs_kfolds, verbose=verbose)
+            clf, score = plib.grid_search(clf, xtrain, ytrain, n_folds=gs_kfolds, verbose=verbose,
+                                          kernel_cache=kernel_cache)
 
         clf.fit(xtrain, ytrain)
         total_test_score.append(clf.score(xtest, ytest))
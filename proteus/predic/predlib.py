@@ -5,6 +5,8 @@ from sklearn import preprocessing
 
 from sklearn import svm
 from sklearn.model_selection import GridSearchCV
+from sklearn.base import clone
+from proteus.predic import kernels
 
 from collections import Counter
 from sklearn.metrics import accuracy_score
@@ -47,13 +49,16 @@ class bagging:
         return pred_matrix
 
 
-def grid_search(clf, x, y, n_folds=10, verbose=True, detailed=False):
+def grid_search(clf, x, y, n_folds=10, verbose=True, detailed=False, kernel_cache=False):
         """
         # Train classifier
         #
         # For an initial search, a logarithmic grid with basis
         # 10 is often helpful. Using a basis of 2, a finer
         # tuning can be achieved but at a much higher cost.
+        #
+        # kernel_cache: search on the kernels of a KernelCache of x (linear and rbf SVC),
+        # the returned classifier is clf set with the best parameters, not fitted
         """
         if verbose:
             print("Running grid search ...")
@@ -77,6 +82,19 @@ def grid_search(clf, x, y, n_folds=10, verbose=True, detailed=False):
                 cv = StratifiedKFold(n_splits=n_folds)
             #cv = cross_validation.LeaveOneOut(len(y))
             #grid = GridSearchCV(clf, param_grid=param_grid, cv=cv, n_jobs=-1, scoring='f1')
+            if kernel_cache and clf.kernel in ('linear', 'rbf'):
+                cache = kernels.KernelCache(x)
+                params = clf.get_params()
+                pclf = kernels.PrecomputedSVC(cache, kernel=clf.kernel, C=clf.C, gamma=params.get('gamma', 'scale'),
+                                              class_weight=clf.class_weight, cache_size=clf.cache_size,
+                                              random_state=clf.random_state)
+                grid = GridSearchCV(pclf, param_grid=param_grid, cv=cv, n_jobs=-1, refit=False)
+                grid.fit(np.arange(len(x))[:, np.newaxis], y)
+                best_clf = clone(clf).set_params(**grid.best_params_)
+                if verbose:
+                    print("The best classifier is: ", best_clf)
+                return best_clf, grid.best_score_
+
             grid = GridSearchCV(clf, param_grid=param_grid, cv=cv, n_jobs=-1)
             grid.fit(x, y)
             if verbose:
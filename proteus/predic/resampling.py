@@ -0,0 +1,179 @@
+__author__ = 'Christian Dansereau'
+
+"""
+Parallel resampling executor
+Each split refits an independent copy of the model, the splits are dispatched to joblib workers and the
+input matrix is shared with them through a read-only memory map instead of a pickled copy per worker.
+With warm_start the splits are grouped in one chain per worker, the splits of a chain are fit in order on
+the same copy of the model, each fit starting from the solution of the previous split.
+"""
+import copy
+import time
+import multiprocessing
+import numpy as np
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+
+
+def split_seeds(n_splits, random_state=None):
+    '''
+        One RNG seed per split, drawn from random_state
+    '''
+    return np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=n_splits)
+
+
+def _n_chains(n_jobs, n_splits):
+    # one chain of splits per worker (joblib convention for a negative n_jobs)
+    if n_jobs < 0:
+        n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return max(min(n_jobs, n_splits), 1)
+
+
+def _set_warm_start(estimator):
+    # the estimator, or the classifier it wraps (BaseSvc, BaseLR, ...), starts each fit from the previous solution
+    for obj in [estimator, getattr(estimator, 'clf', None)]:
+        if hasattr(obj, 'warm_start'):
+            obj.warm_start = True
+
+
+def _fit_predict_chain(estimator, x, y, splits, seeds, fit_params, predict_params, warm_start=False):
+    # the splits of a chain are fit in order on one copy of the estimator
+    # the global RNG is seeded per split so that the result does not depend on the worker
+    estimator = copy.deepcopy(estimator)
+    if warm_start:
+        _set_warm_start(estimator)
+    predictions = []
+    for (train, test), seed in zip(splits, seeds):
+        np.random.seed(seed)
+        estimator.fit(x[train, :], y[train], **fit_params)
+        predictions.append(estimator.predict(x[test, :], **predict_params))
+    return predictions
+
+
+def resample_predict(estimator, x, y, splits, n_jobs=1, random_state=None, fit_params={}, max_nbytes='1M',
+                     predict_params={}, warm_start=False):
+    '''
+        Fit a copy of estimator on the train set of each split and predict its test set
+        splits:     list of (train, test) indexes
+        n_jobs:     number of workers (1 run serially in the current process)
+        max_nbytes: arrays larger than this are sent to the workers as a read-only memory map, including the
+                    arrays of the objects in fit_params and predict_params (dumped once for all the splits)
+        warm_start: the splits are fit in n_jobs contiguous chains, each fit of a chain starts from the solution
+                    of the previous split (estimators with a warm_start parameter, e.g. PrimalLinearSvc)
+        return the list of the predictions of each split, identical for any n_jobs with a fixed random_state
+        (with warm_start, identical for a fixed n_jobs)
+    '''
+    splits = list(splits)
+    seeds = split_seeds(len(splits), random_state)
+    if warm_start:
+        chains = np.array_split(np.arange(len(splits)), _n_chains(n_jobs, len(splits)))
+    else:
+        chains = [[ii] for ii in range(len(splits))]
+    tasks = [([splits[ii] for ii in chain], seeds[chain]) for chain in chains]
+    if n_jobs == 1:
+        state = np.random.get_state()
+        try:
+            results = [_fit_predict_chain(estimator, x, y, chain_splits, chain_seeds, fit_params, predict_params,
+                                          warm_start)
+                       for chain_splits, chain_seeds in tasks]
+        finally:
+            np.random.set_state(state)
+    else:
+        results = Parallel(n_jobs=n_jobs, max_nbytes=max_nbytes, mmap_mode='r')(
+            delayed(_fit_predict_chain)(estimator, x, y, chain_splits, chain_seeds, fit_params, predict_params,
+                                        warm_start)
+            for chain_splits, chain_seeds in tasks)
+    return [y_pred for chain_predictions in results for y_pred in chain_predictions]
+
+
+def hit_tally(estimator, x, y, splits, n_jobs=1, random_state=None, fit_params={}, max_nbytes='1M',
+              predict_params={}, warm_start=False):
+    '''
+        Count the hits (correct predictions) of each example over the splits where it is in the test set
+        return hm (hits), hm_count (number of tests) for each example
+    '''
+    splits = list(splits)
+    predictions = resample_predict(estimator, x, y, splits, n_jobs, random_state, fit_params, max_nbytes,
+                                   predict_params, warm_start)
+    hm_count = np.zeros(len(y))
+    hm = np.zeros(len(y))
+    for (train, test), y_pred in zip(splits, predictions):
+        hm_count[test] += 1.
+        hm[test] += (y_pred == y[test]).astype(float)
+    return hm, hm_count
+
+
+def benchmark_warm_start(estimator, x, y, splits, n_jobs=1, random_state=None, fit_params={}, predict_params={}):
+    '''
+        Wall-clock time and accuracy (hits over the tests of all the splits) of the resampling from scratch
+        and with warm_start
+        return {'cold': (seconds, accuracy), 'warm': (seconds, accuracy)}
+    '''
+    splits = list(splits)
+    results = {}
+    for name, warm_start in [('cold', False), ('warm', True)]:
+        start = time.time()
+        hm, hm_count = hit_tally(estimator, x, y, splits, n_jobs, random_state, fit_params,
+                                 predict_params=predict_params, warm_start=warm_start)
+        results[name] = (time.time() - start, hm.sum() / hm_count.sum())
+    return results
+
+
+def test_resample_predict_n_jobs():
+    from sklearn.model_selection import StratifiedShuffleSplit
+    from sklearn.ensemble import RandomForestClassifier
+    rng = np.random.RandomState(0)
+    x = rng.randn(60, 5)
+    y = (x[:, 0] + rng.randn(60) > 0).astype(int)
+    splits = list(StratifiedShuffleSplit(n_splits=6, test_size=.2, random_state=0).split(x, y))
+    # the forest draws from the global RNG, seeded per split
+    clf = RandomForestClassifier(n_estimators=5)
+    pred_serial = resample_predict(clf, x, y, splits, n_jobs=1, random_state=0)
+    pred_parallel = resample_predict(clf, x, y, splits, n_jobs=2, random_state=0)
+    assert all(np.array_equal(a, b) for a, b in zip(pred_serial, pred_parallel))
+    hm, hm_count = hit_tally(clf, x, y, splits, n_jobs=2, random_state=0)
+    assert hm_count.sum() == 6 * 12
+    assert np.all(hm <= hm_count)
+
+
+def test_resample_predict_warm_start():
+    from sklearn.model_selection import StratifiedShuffleSplit
+    from proteus.predic.high_confidence import PrimalLinearSvc, BaseSvc
+    rng = np.random.RandomState(0)
+    x = rng.randn(100, 20)
+    y = (x[:, :3].sum(1) + rng.randn(100) > 0).astype(int)
+    splits = list(StratifiedShuffleSplit(n_splits=12, test_size=.2, random_state=0).split(x, y))
+    clf = PrimalLinearSvc(C=0.1)
+    cold = resample_predict(clf, x, y, splits)
+    for n_jobs in [1, 2]:
+        warm = resample_predict(clf, x, y, splits, n_jobs=n_jobs, warm_start=True)
+        # same optimum from another starting point
+        assert np.mean(np.hstack(cold) == np.hstack(warm)) > 0.95
+    assert clf.warm_start is False
+    # the classifier wrapped by BaseSvc
+    chain = _fit_predict_chain(BaseSvc(solver='primal'), x, y, splits[:2], [0, 1],
+                               dict(hyperparams_optim=False), {}, warm_start=True)
+    assert len(chain) == 2
+    results = benchmark_warm_start(clf, x, y, splits)
+    assert set(results) == set(['cold', 'warm'])
+    assert abs(results['cold'][1] - results['warm'][1]) < 0.05
+
+
+if __name__ == "__main__":
+    # benchmark of the warm started resampling of the two stages base model (100 shuffle splits)
+    from sklearn.model_selection import StratifiedShuffleSplit
+    from sklearn.linear_model import LogisticRegression
+    from proteus.predic.high_confidence import PrimalLinearSvc
+    rng = np.random.RandomState(0)
+    x = rng.randn(400, 300)
+    y = (x[:, :10].sum(1) + 2 * rng.randn(400) > 0).astype(int)
+    splits = list(StratifiedShuffleSplit(n_splits=100, test_size=.2, random_state=1).split(x, y))
+    for clf in [PrimalLinearSvc(C=0.1), LogisticRegression(C=0.1, solver='lbfgs', max_iter=1000)]:
+        for n_jobs in [1, 4]:
+            results = benchmark_warm_start(clf, x, y, splits, n_jobs=n_jobs, random_state=1)
+            print(type(clf).__name__, 'n_jobs', n_jobs, 'cold %.2fs acc %.3f' % results['cold'],
+                  'warm %.2fs acc %.3f' % results['warm'])
+
@@ -3,6 +3,7 @@ __author__ = 'Christian Dansereau'
 import numpy as np
 from proteus.predic import prediction
 from proteus.predic import subtypes
+from proteus.predic import clustering
 from proteus.predic.high_confidence import TwoStagesPrediction
 from sklearn.svm import SVC, LinearSVC, l1_min_c
 from sklearn.linear_model import LogisticRegression, LogisticRegressionCV
@@ -11,7 +12,10 @@ from sklearn.model_selection import LeaveOneOut, LeavePOut, StratifiedKFold, Str
 from sklearn.metrics import accuracy_score
 from sklearn.ensemble import RandomForestClassifier
 import multiprocessing
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import time
+import os
 from proteus.io import sbp_util
 
 
@@ -23,6 +27,54 @@ def compute_loo_parall((net_data_low_main, y, confounds, n_subtypes, train_index
     return np.hstack((y[test_index], tmp_scores[0][0], tmp_scores[1][0]))
 
 
+def _train_seed(x_dyn, confounds_dyn, params):
+    ## regress confounds
+    crm = prediction.ConfoundsRm(confounds_dyn, x_dyn)
+    x_res = crm.transform(confounds_dyn, x_dyn)
+    ## extract subtypes, stage 1 and stage 2 share the same linkage
+    st, st_s2 = subtypes.fit_network_multi(x_res, [params['nSubtypes'], params['nSubtypes_stage2']],
+                                           params['ward_max_rows'], params['ward_centroids'])
+    return [crm, st, st_s2]
+
+
+def _train_seed_stream(files_path, subjects_id_list, confounds, seed_index, params):
+    make_chunks = lambda: sbp_util.iter_rmap_chunks(subjects_id_list, files_path, seed_index, confounds,
+                                                    dynamic=params['dynamic'], chunk_size=params['chunk_size'])
+    crm, x_res = prediction.residualize_stream(make_chunks, tmp_dir=params['tmp_dir'])
+    try:
+        st, st_s2 = subtypes.fit_network_multi(x_res, [params['nSubtypes'], params['nSubtypes_stage2']],
+                                               params['ward_max_rows'], params['ward_centroids'])
+    finally:
+        file_name = x_res.filename
+        del x_res
+        os.remove(file_name)
+    return [crm, st, st_s2]
+
+
+def _train_seed_array(args):
+    x_dyn, confounds_dyn, params = args
+    start = time.time()
+    st_crm = _train_seed(x_dyn, confounds_dyn, params)
+    return st_crm, time.time() - start
+
+
+def _train_seed_files(args):
+    files_path, subjects_id_list, confounds, seed_index, params = args
+    start = time.time()
+    if params['chunk_size']:
+        st_crm = _train_seed_stream(files_path, subjects_id_list, confounds, seed_index, params)
+    else:
+        if params['dynamic']:
+            x_dyn = sbp_util.grab_rmap(subjects_id_list, files_path, seed_index, dynamic=True, verbose=False)[0]
+            confounds_dyn = np.vstack([np.tile(confounds[jj], (x_dyn[jj].shape[0], 1)) for jj in range(len(x_dyn))])
+            x_dyn = np.vstack(x_dyn)
+        else:
+            x_dyn = sbp_util.grab_rmap(subjects_id_list, files_path, seed_index, dynamic=False, verbose=False)
+            confounds_dyn = confounds
+        st_crm = _train_seed(x_dyn, confounds_dyn, params)
+    return st_crm, time.time() - start
+
+
 class SBP:
     '''
     Pipeline for subtype base prediction
@@ -31,8 +83,24 @@ class SBP:
     def __init__(self, verbose=True, dynamic=True, stage1_model_type='svm', nSubtypes=7,
                  nSubtypes_stage2=0, mask_part=[], stage1_metric='accuracy', stage2_metric='f1_weighted',
                  s2_branches=True, min_gamma=0.8, thresh_ratio=0.1, n_iter=100, shuffle_test_split=0.2, gamma=1.,
-                 gamma_auto_adjust=True, flag_recurrent=False, recurrent_modes=3):
+                 gamma_auto_adjust=True, flag_recurrent=False, recurrent_modes=3, chunk_size=0, tmp_dir=None, n_jobs=1,
+                 tlp_n_jobs=1, ward_max_rows=clustering.WARD_MAX_ROWS, ward_centroids=1000):
+        '''
+        n_jobs:     number of seeds trained in parallel (-1 for all the cores)
+        tlp_n_jobs: number of resampling splits of the two stages prediction fitted in parallel, kept apart
+                    from n_jobs so that the seed workers and the prediction workers are sized independently
+        ward_max_rows, ward_centroids: above ward_max_rows rows of subtype training data (per seed) the Ward
+                    linkage is done on ward_centroids k-means centroids
+        chunk_size: if > 0 the confounds of the subtype training data are regressed out of core, by
+                    chunks of chunk_size subjects, in a memory-mapped file of tmp_dir
+        '''
         self.verbose = verbose
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.tlp_n_jobs = tlp_n_jobs
+        self.ward_max_rows = ward_max_rows
+        self.ward_centroids = ward_centroids
+        self.tmp_dir = tmp_dir
         self.dynamic = dynamic
         self.gamma = gamma
         self.min_gamma = min_gamma
@@ -59,27 +127,31 @@ class SBP:
         W = []
         W2 = []
         for ii in range(len(self.st_crm)):
-            W.append(self.st_crm[ii][1].compute_weights(self.st_crm[ii][0].transform(confounds, x[:, ii, :]),
-                                                        mask_part=self.mask_part))
-            W2.append(self.st_crm[ii][2].compute_weights(self.st_crm[ii][0].transform(confounds, x[:, ii, :]),
-                                                         mask_part=self.mask_part))
+            x_res = self.st_crm[ii][0].transform(confounds, x[:, ii, :])
+            W.append(self.st_crm[ii][1].transform(x_res, mask_part=self.mask_part, reshape_w=False))
+            W2.append(self._stage2_w(ii, x_res, W[-1]))
         xw = np.hstack(W)
         xw2 = np.hstack(W2)
         return subtypes.reshapeW(xw), subtypes.reshapeW(xw2)
 
+    def _stage2_w(self, ii, x_res, w):
+        # stage 1 and stage 2 share the model when they have the same number of subtypes
+        if self.st_crm[ii][2] is self.st_crm[ii][1]:
+            return w
+        return self.st_crm[ii][2].transform(x_res, mask_part=self.mask_part, reshape_w=False)
+
     def get_w_files(self, files_path, subjects_id_list, confounds):
         ### extract w values
         W = []
         W2 = []
+        files_path = self._files_index(files_path)
         for ii in range(len(self.st_crm)):
             x_ref = sbp_util.grab_rmap(subjects_id_list, files_path, ii, dynamic=False)
             ## compute w values
-            W.append(self.st_crm[ii][1].compute_weights(self.st_crm[ii][0].transform(confounds, x_ref),
-                                                        mask_part=self.mask_part))
-
-            W2.append(self.st_crm[ii][2].compute_weights(self.st_crm[ii][0].transform(confounds, x_ref),
-                                                         mask_part=self.mask_part))
-            del x_ref
+            x_res = self.st_crm[ii][0].transform(confounds, x_ref)
+            W.append(self.st_crm[ii][1].transform(x_res, mask_part=self.mask_part, reshape_w=False))
+            W2.append(self._stage2_w(ii, x_res, W[-1]))
+            del x_ref, x_res
 
         xw = np.hstack(W)
         xw2 = np.hstack(W2)
@@ -89,16 +161,8 @@ class SBP:
 
         if self.verbose: start = time.time()
         ### train subtypes
-        self.st_crm = []
-        for ii in range(x.shape[1]):
-            crm = prediction.ConfoundsRm(confounds_dyn, x_dyn[:, ii, :])
-            # st
-            st = subtypes.clusteringST()
-            st.fit_network(crm.transform(confounds_dyn, x_dyn[:, ii, :]), nSubtypes=self.nSubtypes)
-            # stage 2                                                                                                                                         
-            st_s2 = subtypes.clusteringST()
-            st_s2.fit_network(crm.transform(confounds_dyn, x_dyn[:, ii, :]), nSubtypes=self.nSubtypes_stage2)
-            self.st_crm.append([crm, st, st_s2])
+        tasks = ((x_dyn[:, ii, :], confounds_dyn, self._seed_params()) for ii in range(x.shape[1]))
+        self._train_seeds(_train_seed_array, tasks, ThreadPool)
 
         ### extract w values
         xw, xw2 = self.get_w(x, confounds)
@@ -118,7 +182,7 @@ class SBP:
         #self.tlp = TwoLevelsPrediction(self.verbose, stage1_model_type=self.stage1_model_type, gamma=self.gamma,
         #                               stage1_metric=self.stage1_metric, stage2_metric=self.stage2_metric,
         #                               s2_branches=self.s2_branches)
-        self.tlp = TwoStagesPrediction(self.verbose, thresh_ratio=self.thresh_ratio, min_gamma=self.min_gamma, shuffle_test_split=self.shuffle_test_split, n_iter=self.n_iter, gamma_auto_adjust=self.gamma_auto_adjust, recurrent_modes=self.recurrent_modes)
+        self.tlp = TwoStagesPrediction(self.verbose, thresh_ratio=self.thresh_ratio, min_gamma=self.min_gamma, shuffle_test_split=self.shuffle_test_split, n_iter=self.n_iter, gamma_auto_adjust=self.gamma_auto_adjust, recurrent_modes=self.recurrent_modes, n_jobs=self.tlp_n_jobs)
         #self.tlp_recurrent = TwoStagesPrediction(self.verbose, thresh_ratio=self.thresh_ratio, min_gamma=self.min_gamma)
         self.tlp.fit(all_var, all_var_s2, y)
         # self.tlp_recurrent.fit_recurrent(all_var, all_var_s2, y)
@@ -131,38 +195,57 @@ class SBP:
         Same as fit_files() except that you can train and test on different set of data
         '''
         if self.verbose: start = time.time()
-        ### train subtypes
-        self.st_crm = []
-        # for ii in [5,13]:#range(x.shape[1]):
-        xw = []
-        for ii in range(n_seeds):
-            print('Train seed ' + str(ii + 1))
-            if self.dynamic:
-                [x_dyn, x_ref] = sbp_util.grab_rmap(subjects_id_list_st, files_path_st, ii, dynamic=self.dynamic)
-                confounds_dyn = []
-                for jj in range(len(x_dyn)):
-                    confounds_dyn.append((confounds_st[jj],) * x_dyn[jj].shape[0])
-                confounds_dyn = np.vstack(confounds_dyn)
-                x_dyn = np.vstack(x_dyn)
-            else:
-                x_ref = sbp_util.grab_rmap(subjects_id_list_st, files_path_st, ii, dynamic=self.dynamic)
-                x_dyn = x_ref
-                confounds_dyn = confounds_st
-
-            del x_ref
-            ## regress confounds
-            crm = prediction.ConfoundsRm(confounds_dyn, x_dyn)
-            ## extract subtypes
-            st = subtypes.clusteringST()
-            st.fit_network(crm.transform(confounds_dyn, x_dyn), nSubtypes=self.nSubtypes)
-            # stage 2
-            st_s2 = subtypes.clusteringST()
-            st_s2.fit_network(crm.transform(confounds_dyn, x_dyn), nSubtypes=self.nSubtypes_stage2)
-            self.st_crm.append([crm, st, st_s2])
-            del x_dyn
+        ### train subtypes, the data of each seed is loaded by the worker
+        files_path_st = self._files_index(files_path_st)
+        tasks = ((files_path_st, subjects_id_list_st, confounds_st, ii, self._seed_params()) for ii in range(n_seeds))
+        self._train_seeds(_train_seed_files, tasks, Pool)
 
         if self.verbose: print("Subtype extraction, Time elapsed: {}s)".format(int(time.time() - start)))
 
+    def _files_index(self, files_path):
+        '''
+            sbp_util.PathIndex of the seed map files, listed once and kept on the model for all the seeds
+            (a RmapStore or a PathIndex is used as is)
+        '''
+        if isinstance(files_path, (sbp_util.RmapStore, sbp_util.PathIndex)):
+            return files_path
+        if not hasattr(self, 'path_indexes'):
+            self.path_indexes = {}
+        if files_path not in self.path_indexes:
+            self.path_indexes[files_path] = sbp_util.PathIndex(files_path)
+        return self.path_indexes[files_path]
+
+    def _seed_params(self):
+        return dict(dynamic=self.dynamic, nSubtypes=self.nSubtypes, nSubtypes_stage2=self.nSubtypes_stage2,
+                    chunk_size=self.chunk_size, tmp_dir=self.tmp_dir, ward_max_rows=self.ward_max_rows,
+                    ward_centroids=self.ward_centroids)
+
+    def _train_seeds(self, worker, tasks, pool_class):
+        '''
+            Train the seeds serially (n_jobs=1) or in a pool of n_jobs workers, the results are in the seeds order
+        '''
+        self.st_crm = []
+        self.seed_timing = []
+        if self.n_jobs == 1:
+            pool = None
+            results = (worker(task) for task in tasks)
+        else:
+            pool = pool_class(self.n_jobs if self.n_jobs > 0 else None)
+            results = pool.imap(worker, tasks)
+        try:
+            for ii, (st_crm, elapsed) in enumerate(results):
+                if self.verbose: print('Train seed ' + str(ii + 1) + ', Time elapsed: {}s'.format(int(elapsed)))
+                self.st_crm.append(st_crm)
+                self.seed_timing.append(elapsed)
+        except:
+            # a failed seed stop the training, the remaining workers are killed
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
     def fit_files(self, files_path, subjects_id_list, confounds, y, n_seeds, extra_var=[], skip_st_training=False):
         '''
@@ -187,7 +270,7 @@ class SBP:
         if self.verbose: start = time.time()
         # self.tlp = TwoLevelsPrediction(self.verbose, stage1_model_type=self.stage1_model_type, gamma=self.gamma,
         #                               stage1_metric=self.stage1_metric, stage2_metric=self.stage2_metric)
-        self.tlp = TwoStagesPrediction(self.verbose, thresh_ratio=self.thresh_ratio, min_gamma=self.min_gamma, shuffle_test_split=self.shuffle_test_split, n_iter=self.n_iter, gamma_auto_adjust=self.gamma_auto_adjust, recurrent_modes=self.recurrent_modes)
+        self.tlp = TwoStagesPrediction(self.verbose, thresh_ratio=self.thresh_ratio, min_gamma=self.min_gamma, shuffle_test_split=self.shuffle_test_split, n_iter=self.n_iter, gamma_auto_adjust=self.gamma_auto_adjust, recurrent_modes=self.recurrent_modes, n_jobs=self.tlp_n_jobs)
         # self.tlp_recurrent = TwoStagesPrediction(self.verbose, thresh_ratio=self.thresh_ratio, min_gamma=self.min_gamma)
         if self.flag_recurrent:
             self.tlp.fit_recurrent(all_var, all_var_s2, y)
@@ -284,6 +367,29 @@ class nullClassifier():
     def decision_function(self, x):
         return -np.ones_like(x[:, 0])
 
+
+def test_train_seeds():
+    # seeds trained in a pool are returned in the seeds order, equal to the serial training
+    rng = np.random.RandomState(0)
+    x_dyn = rng.randn(60, 3, 30)
+    confounds_dyn = rng.randn(60, 2)
+    st_crms = []
+    for n_jobs in [1, 2]:
+        model = SBP(verbose=False, nSubtypes=3, n_jobs=n_jobs)
+        tasks = ((x_dyn[:, ii, :], confounds_dyn, model._seed_params()) for ii in range(x_dyn.shape[1]))
+        model._train_seeds(_train_seed_array, tasks, ThreadPool)
+        assert len(model.st_crm) == x_dyn.shape[1]
+        assert len(model.seed_timing) == x_dyn.shape[1]
+        st_crms.append(model.st_crm)
+    for ii, (crm, st, st_s2) in enumerate(st_crms[1]):
+        ref_crm, ref_st = st_crms[0][ii][:2]
+        assert np.allclose(crm._get_beta(np.float64), ref_crm._get_beta(np.float64))
+        assert np.allclose(st.st_templates, ref_st.st_templates)
+        assert np.allclose(st.W, ref_st.W)
+        # seed ii is trained on the network ii
+        res = ref_crm.transform(confounds_dyn, x_dyn[:, ii, :])
+        assert np.allclose(crm.transform(confounds_dyn, x_dyn[:, ii, :]), res)
+
 '''
 class TwoLevelsPrediction:
 
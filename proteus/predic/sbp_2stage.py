@@ -3,6 +3,7 @@ __author__ = 'Christian Dansereau'
 import numpy as np
 from proteus.predic import prediction
 from proteus.predic import subtypes
+from proteus.predic import resampling
 from sklearn.svm import SVC,l1_min_c
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import GridSearchCV
@@ -314,18 +315,9 @@ class TwoLevelsPrediction:
         self.clf1.fit(x,y)
         return hm_results, predictions[:,0]
 
-    def suffle_hm(self,x,y,gamma=0.5,n_iter=50):
-        hm_count = np.zeros_like(y).astype(float)
-        hm = np.zeros_like(y).astype(float)
-        skf = StratifiedShuffleSplit(y, n_iter=n_iter, test_size=.25,random_state=np.random.seed(42))
-        coefs_ = []
-        intercepts_ = []
-        for train,test in skf:
-            self.clf1.fit(x[train,:],y[train])
-            hm_count[test] += 1.
-            hm[test] += (self.clf1.predict(x[test,:])==y[test]).astype(float)
-            coefs_.append(self.clf1.coef_)
-            intercepts_.append(self.clf1.intercept_)
+    def suffle_hm(self,x,y,gamma=0.5,n_iter=50,n_jobs=1):
+        skf = StratifiedShuffleSplit(n_splits=n_iter, test_size=.25, random_state=42)
+        hm, hm_count = resampling.hit_tally(self.clf1, x, y, skf.split(x, y), n_jobs=n_jobs, random_state=42)
         proba = hm/hm_count
         print hm_count
         print proba
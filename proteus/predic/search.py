@@ -0,0 +1,177 @@
+__author__ = 'Christian Dansereau'
+
+"""
+Hyper-parameter search with regularization paths and pruning of the grid points significantly worse than the best
+"""
+import numpy as np
+from sklearn.base import clone
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterGrid
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+
+
+def _nanmean(scores):
+    # mean over the evaluated folds (last axis), nan for the grid points never evaluated
+    count = np.sum(~np.isnan(scores), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nansum(scores, axis=-1) / count
+
+
+def _prune(scores, alive, prune_se):
+    # keep the grid points not worse than the best one by more than prune_se standard errors of the paired
+    # differences of their scores over the folds (all the grid points alive are scored on the same folds)
+    mean_scores = np.where(alive, _nanmean(scores), -np.inf)
+    best = np.unravel_index(np.argmax(mean_scores), mean_scores.shape)
+    diff = scores - scores[best]
+    n_folds = scores.shape[-1]
+    with np.errstate(invalid='ignore'):
+        se = np.std(diff, axis=-1, ddof=1) / np.sqrt(n_folds)
+        worse = diff.mean(-1) < -prune_se * se
+    return alive & ~worse
+
+
+def _fit_path(estimator, x, y, train, test, params, path_values, path_param, scorer):
+    # fit the path values in order of decreasing regularization on the same model, so that the models with
+    # warm start enabled start from the solution of the previous value
+    estimator = clone(estimator).set_params(**params)
+    if 'warm_start' in estimator.get_params():
+        estimator.set_params(warm_start=True)
+    scores = []
+    for value in path_values:
+        if path_param is not None:
+            estimator.set_params(**{path_param: value})
+        estimator.fit(x[train], y[train])
+        scores.append(scorer(estimator, x[test], y[test]))
+    return scores
+
+
+class PathSearchCV(object):
+    """
+    Drop-in replacement of GridSearchCV (fit, best_estimator_, best_params_, best_score_, cv_results_).
+    For each fold and each combination of the other parameters the values of path_param (C by default) are fitted
+    as a regularization path, from the strongest to the weakest regularization, warm started when the estimator
+    supports it (warm_start is ignored by the liblinear and libsvm solvers). path_ascending tells the direction of path_param: True when the regularization decreases as the
+    value increases (C), False when it increases with the value (e.g. alpha).
+    The folds are shared by all the grid points and evaluated by rounds: the grid points are scored on min_folds
+    folds, then on factor times more folds at each round. After each round the grid points whose mean score is
+    below the one of the best grid point by more than prune_se standard errors of their paired differences over the
+    folds are dropped (prune_se=None evaluates the full grid on all the folds).
+    """
+
+    def __init__(self, estimator, param_grid, cv, scoring='accuracy', n_jobs=1, path_param='C', path_ascending=True,
+                 min_folds=5, factor=2, prune_se=2., refit=True):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.path_param = path_param
+        self.path_ascending = path_ascending
+        self.min_folds = min_folds
+        self.factor = factor
+        self.prune_se = prune_se
+        self.refit = refit
+
+    def _candidates(self):
+        grid = dict(self.param_grid)
+        path_param = self.path_param if self.path_param in grid else None
+        path_values = np.sort(grid.pop(path_param)) if path_param is not None else np.array([None])
+        if path_param is not None and not self.path_ascending:
+            path_values = path_values[::-1]
+        others = list(ParameterGrid(grid)) if len(grid) else [{}]
+        return path_param, path_values, others
+
+    def fit(self, x, y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        scorer = get_scorer(self.scoring)
+        folds = list(self.cv.split(x, y))
+        path_param, path_values, others = self._candidates()
+        n_path = len(path_values)
+
+        # scores (other params x path values x folds), nan where not evaluated
+        scores = np.full((len(others), n_path, len(folds)), np.nan)
+        alive = np.ones((len(others), n_path), dtype=bool)
+        start = 0
+        n_round = min(self.min_folds, len(folds))
+        parallel = Parallel(n_jobs=self.n_jobs)
+        while start < len(folds):
+            stop = min(start + n_round, len(folds))
+            tasks = [(k, f) for k in range(len(others)) if alive[k].any() for f in range(start, stop)]
+            results = parallel(
+                delayed(_fit_path)(self.estimator, x, y, folds[f][0], folds[f][1], others[k],
+                                   path_values[alive[k]], path_param, scorer) for k, f in tasks)
+            for (k, f), fold_scores in zip(tasks, results):
+                scores[k, alive[k], f] = fold_scores
+            start = stop
+            n_round = start * (self.factor - 1) if start else n_round
+
+            if alive.sum() <= 1:
+                break
+            if start < len(folds) and self.prune_se is not None:
+                alive = _prune(scores[..., :start], alive, self.prune_se)
+
+        mean_scores = np.where(alive, _nanmean(scores), -np.inf)
+        best = np.argmax(mean_scores.ravel())
+        k, p = np.unravel_index(best, mean_scores.shape)
+        self.best_params_ = dict(others[k])
+        if path_param is not None:
+            self.best_params_[path_param] = path_values[p]
+        self.best_score_ = mean_scores[k, p]
+
+        params = []
+        for k in range(len(others)):
+            for p in range(n_path):
+                param = dict(others[k])
+                if path_param is not None:
+                    param[path_param] = path_values[p]
+                params.append(param)
+        self.cv_results_ = {'params': params,
+                            'mean_test_score': _nanmean(scores).ravel(),
+                            'n_folds': np.sum(~np.isnan(scores), axis=2).ravel()}
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+            self.best_estimator_.fit(x, y)
+        return self
+
+
+def test_path_search_cv():
+    from sklearn.linear_model import LogisticRegression, RidgeClassifier
+    from sklearn.model_selection import GridSearchCV, StratifiedShuffleSplit
+    rng = np.random.RandomState(0)
+    x = rng.randn(100, 8)
+    y = (x[:, :2].sum(1) + rng.randn(100) > 0).astype(int)
+    cv = StratifiedShuffleSplit(n_splits=4, test_size=.3, random_state=1)
+
+    # all the folds are evaluated (min_folds >= n_splits), the best parameters are the ones of the full grid search
+    clf = LogisticRegression(solver='lbfgs', tol=1e-8, max_iter=1000)
+    param_grid = dict(C=[10., 0.001, 0.01, 0.1, 1.])
+    path = PathSearchCV(clf, param_grid, cv, min_folds=4).fit(x, y)
+    grid = GridSearchCV(clf, param_grid, cv=cv).fit(x, y)
+    assert path.best_params_ == grid.best_params_
+    assert np.isclose(path.best_score_, grid.best_score_)
+
+    # pruning after 3 folds out of 20, the best parameters are still the ones of the full grid search
+    cv_long = StratifiedShuffleSplit(n_splits=20, test_size=.3, random_state=1)
+    param_grid = dict(C=[10., 0.001, 0.01, 0.1, 1., 0.003, 0.03, 0.3])
+    path = PathSearchCV(clf, param_grid, cv_long, min_folds=3).fit(x, y)
+    grid = GridSearchCV(clf, param_grid, cv=cv_long).fit(x, y)
+    assert path.best_params_ == grid.best_params_
+    assert np.isclose(path.best_score_, grid.best_score_)
+    assert path.cv_results_['n_folds'].min() == 3 and path.cv_results_['n_folds'].max() == 20
+    full = PathSearchCV(clf, param_grid, cv_long, min_folds=3, prune_se=None).fit(x, y)
+    assert np.all(full.cv_results_['n_folds'] == 20)
+    assert full.best_params_ == grid.best_params_
+
+    # alpha: the regularization increases with the value
+    clf = RidgeClassifier()
+    param_grid = dict(alpha=[0.1, 1000., 10., 1.], fit_intercept=[True, False])
+    path = PathSearchCV(clf, param_grid, cv, path_param='alpha', path_ascending=False, min_folds=4).fit(x, y)
+    grid = GridSearchCV(clf, param_grid, cv=cv).fit(x, y)
+    assert path.best_params_ == grid.best_params_
+    assert np.isclose(path.best_score_, grid.best_score_)
+    assert path.cv_results_['params'][0]['alpha'] == 1000.
@@ -31,18 +31,14 @@ def itStability(x,y,ind,k=1,samp_ratio=0.5,nsample=100):
     A random iterative resampling of the subject to compute the stability of the selected features
     '''
     subj_idx = range(0,x.shape[0])
-    stability_hr_mat = np.zeros((len(ind),len(ind)))
+    votes = np.zeros(x.shape[1])
     for i in range(0,nsample):
-        sample_idx = np.random.permutation(subj_idx)[:np.int(len(subj_idx)*samp_ratio)]
+        sample_idx = np.random.permutation(subj_idx)[:int(len(subj_idx)*samp_ratio)]
         bestidx = getkBest(x[sample_idx,:],y[sample_idx],k)
-        it_vote = np.zeros(x.shape[1])
-        it_vote[bestidx] = 1 # create the vector of selected features
-        lr_mat = ts.vec2mat(it_vote,include_diag=True) # convert to the low resolution matrix
-        hr_mat = cls.projectmat(lr_mat,ind) # remap in HR
-        # Add the matrix to the main HR stability matrix
-        stability_hr_mat += hr_mat
-
-    stability_hr_mat /= nsample
+        votes[bestidx] += 1 # accumulate the selected features
+    # the projection is linear, remap the average votes in HR once
+    lr_mat = ts.vec2mat(votes / nsample,include_diag=True) # convert to the low resolution matrix
+    stability_hr_mat = cls.projectmat(lr_mat,ind) # remap in HR
     return stability_hr_mat
 
 '''
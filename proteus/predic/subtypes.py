@@ -4,9 +4,12 @@ import numpy as np
 from sklearn.cluster import KMeans
 from proteus.predic import clustering as cls
 from proteus.matrix import tseries as ts
+from proteus.matrix import Atlas
 from sklearn.neighbors.nearest_centroid import NearestCentroid
 from sklearn.model_selection import ShuffleSplit
 from proteus.predic import prediction
+from multiprocessing import Pool
+from scipy import sparse
 
 
 def st_multi_fit(confounds, x, nSubtypes=3):
@@ -43,13 +46,59 @@ def _chunks(l, n):
     return l
 
 
+# data of the bootstrap clusterings, set once per worker
+_bootstrap_params = {}
+
+
+def _init_bootstrap_worker(data, nSubtypes):
+    _bootstrap_params['data'] = data
+    _bootstrap_params['nSubtypes'] = nSubtypes
+
+
+def _bootstrap_worker(train):
+    return cls.hclustering(_bootstrap_params['data'][train, :], _bootstrap_params['nSubtypes'])
+
+
+def _coassignment(h, n_iter, block_size, prune=None):
+    '''
+        Co-assignment rate H H' / n_iter of the (subjects x (bootstraps x subtypes)) assignments, by blocks of rows.
+        Dense float32 by default, or sparse with the rates below prune dropped block by block.
+    '''
+    n = h.shape[0]
+    if prune is None:
+        stab_ = np.empty((n, n), dtype=np.float32)
+    else:
+        stab_ = []
+    for start in range(0, n, block_size):
+        block = h[start:start + block_size].dot(h.T)
+        block /= n_iter
+        if prune is None:
+            stab_[start:start + block_size] = block
+        else:
+            block[block < prune] = 0
+            stab_.append(sparse.csr_matrix(block))
+    if prune is None:
+        return stab_
+    return sparse.vstack(stab_, format='csr')
+
+
 class clusteringST:
     '''
     Identification of sub-types for prediction
     '''
 
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, n_jobs=1, sparse_stability=False, stability_prune=0.1, block_size=1000):
+        '''
+            n_jobs:           bootstrap clusterings run in parallel by fit_robust (-1 for all the cores)
+            sparse_stability: the co-assignment rates below stability_prune are dropped and the stability
+                              matrix is kept sparse (the rates of the subjects rarely clustered together)
+            block_size:       rows of the stability matrix computed at once
+        '''
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.sparse_stability = sparse_stability
+        self.stability_prune = stability_prune
+        self.block_size = block_size
 
     def fit(self, net_data_low, nSubtypes=3, reshape_w=True):
         # net_data_low = net_data_low_main.copy()
@@ -95,6 +144,7 @@ class clusteringST:
             del st_templates_tmp
 
         # calculate the weights for each subjects
+        self._freeze_templates()
         self.W = self.compute_weights(net_data_low, self.st_templates)
 
 
@@ -118,18 +168,36 @@ class clusteringST:
             return np.swapaxes(np.swapaxes(data, 0, 2) * np.swapaxes(scaling_factor, 0, 1), 0, 2)
 
     def _robust_st(self, net_data_low, nSubtypes, n_iter=50):
-        bs_cluster = []
+        '''
+            Stability of the co-assignment of the subjects over n_iter bootstrap hierarchical clusterings
+            (run in parallel with self.n_jobs, sparse co-assignment matrix pruned at self.stability_prune with
+            self.sparse_stability)
+        '''
         n = net_data_low.shape[0]
-        stab_ = np.zeros((n, n)).astype(float)
-        rs = ShuffleSplit(net_data_low.shape[0], n_iter=n_iter, test_size=.05, random_state=1)
-        for train, test in rs:
-            # indentity matrix of the corelation between subjects
-            ind_st = cls.hclustering(net_data_low[train, :], nSubtypes)
-            mat_ = (cls.ind2matrix(ind_st) > 0).astype(float)
-            for ii in range(len(train)):
-                stab_[train, train[ii]] += mat_[:, ii]
-
-        stab_ = stab_ / n_iter
+        rs = ShuffleSplit(n_splits=n_iter, test_size=.05, random_state=1)
+        trains = [train for train, test in rs.split(net_data_low)]
+        n_jobs = getattr(self, 'n_jobs', 1)
+        if n_jobs == 1:
+            _init_bootstrap_worker(net_data_low, nSubtypes)
+            bs_cluster = [_bootstrap_worker(train) for train in trains]
+        else:
+            pool = Pool(n_jobs if n_jobs > 0 else None, initializer=_init_bootstrap_worker,
+                        initargs=(net_data_low, nSubtypes))
+            try:
+                bs_cluster = pool.map(_bootstrap_worker, trains)
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.close()
+                pool.join()
+
+        # subjects x (bootstraps x subtypes) assignments, stab_ = H H' / n_iter
+        h = np.zeros((n, n_iter * nSubtypes), dtype=np.float32)
+        for k, (train, ind_st) in enumerate(zip(trains, bs_cluster)):
+            h[train, k * nSubtypes + ind_st - 1] = 1.
+        prune = getattr(self, 'stability_prune', 0.1) if getattr(self, 'sparse_stability', False) else None
+        stab_ = _coassignment(h, n_iter, getattr(self, 'block_size', 1000), prune)
         ms = KMeans(nSubtypes)
         ind = ms.fit_predict(stab_)
         # row_clusters = linkage(stab_, method='ward')
@@ -152,7 +220,7 @@ class clusteringST:
             ind_st, stab_ = self._robust_st(net_data_low[:, i, :] - self.normalized_net_template[-1], nSubtypes)
 
             for j in range(nSubtypes):
-                mask_stable = (stab_[ind_st == j + 1, :].mean(0) > stab_thereshold)[ind_st == j + 1]
+                mask_stable = (np.asarray(stab_[ind_st == j + 1, :].mean(0)).ravel() > stab_thereshold)[ind_st == j + 1]
                 if self.verbose: print('Robust: new N ', mask_stable.sum(), ' old N ', mask_stable.shape)
                 data_ = net_data_low[ind_st == j + 1, i, :][mask_stable, :]
                 if j == 0:
@@ -168,6 +236,7 @@ class clusteringST:
             del st_templates_tmp
 
         # calculate the weights for each subjects
+        self._freeze_templates()
         self.W = self.compute_weights(net_data_low, self.st_templates)
         if reshape_w:
             return reshapeW(self.W)
@@ -188,7 +257,7 @@ class clusteringST:
         ind_st, stab_ = self._robust_st(net_data_low - self.normalized_net_template[-1], nSubtypes)
 
         for j in range(nSubtypes):
-            mask_stable = (stab_[ind_st == j + 1, :].mean(0) > stab_thereshold)[ind_st == j + 1]
+            mask_stable = (np.asarray(stab_[ind_st == j + 1, :].mean(0)).ravel() > stab_thereshold)[ind_st == j + 1]
             if self.verbose: print('Robust: new N ', mask_stable.sum(), ' old N ', mask_stable.shape)
             data_ = net_data_low[ind_st == j + 1, :][mask_stable, :]
             if j == 0:
@@ -200,13 +269,19 @@ class clusteringST:
         self.st_templates = st_templates_tmp[np.newaxis, ...]
         del st_templates_tmp
         # calculate the weights for each subjects
+        self._freeze_templates()
         self.W = self.compute_weights(net_data_low, self.st_templates)
         if reshape_w:
             return reshapeW(self.W)
         else:
             return self.W
 
-    def fit_network(self, net_data_low, nSubtypes=3, reshape_w=True):
+    def fit_network(self, net_data_low, nSubtypes=3, reshape_w=True, tree=None, max_rows=cls.WARD_MAX_ROWS,
+                    n_centroids=1000):
+        '''
+            tree: optional Ward linkage of net_data_low (clustering.ward_tree) shared between several fits
+            max_rows, n_centroids: above max_rows subjects the Ward linkage is done on n_centroids k-means centroids
+        '''
         self.flag_2level = False
         self.nnet_cluster = 1
         self.nSubtypes = nSubtypes
@@ -220,7 +295,9 @@ class clusteringST:
         self.normalized_net_template.append(np.mean(net_data_low, axis=0))
         # self.normalized_net_template.append(np.zeros_like(net_data_low[0,:]))
         # identity matrix of the correlation between subjects
-        ind_st = cls.hclustering(net_data_low, nSubtypes)
+        if tree is None:
+            tree = cls.ward_tree(net_data_low, max_rows, n_centroids)
+        ind_st = cls.cut_tree(tree, nSubtypes)
 
         for j in range(nSubtypes):
             data_tmp = np.median(net_data_low[ind_st == j + 1, :], axis=0)[np.newaxis, ...]
@@ -233,6 +310,7 @@ class clusteringST:
         self.st_templates = st_templates_tmp[np.newaxis, ...]
         del st_templates_tmp
         # calculate the weights for each subjects
+        self._freeze_templates()
         self.W = self.compute_weights(net_data_low, self.st_templates)
 
         if reshape_w:
@@ -341,56 +419,53 @@ class clusteringST:
             return self.W_l2
 
     def compute_weights(self, net_data_low, st_templates=[], mask_part=[]):
-
-        if st_templates == []:
+        '''
+            Correlation of each subject with the subtypes of each network, computed for all the networks at once
+            net_data_low: (subjects x voxels) for one network or (subjects x networks x voxels)
+            mask_part: optional sub-partition of the voxels (0 is ignored), one set of weights per sub-partition
+            return W (subjects x networks x sub-partitions*subtypes)
+        '''
+        if len(st_templates) == 0:
             st_templates = self.st_templates
-        # calculate the weights for each subjects
-        # W = np.zeros((net_data_low.shape[0],st_templates.shape[0],st_templates.shape[1]))
-        for j in range(st_templates.shape[0]):
-            average_template = self.normalized_net_template[j]
-            if len(net_data_low.shape) == 2:
-                # net_data_low = self.scalers[j].transform(net_data_low_)
-                rmaps = net_data_low - average_template
-            else:
-                # net_data_low[:,j,:] = self.scalers[j].transform(net_data_low_[:,j,:])
-                rmaps = net_data_low[:, j, :] - average_template
-            st_rmap = st_templates[j, :, :] - average_template
-            tmp_rmap = self._compute_w(rmaps, st_rmap, mask_part)
-            if j == 0:
-                W = np.zeros((net_data_low.shape[0], st_templates.shape[0], tmp_rmap.shape[1]))
-            W[:, j, :] = np.nan_to_num(tmp_rmap)
-
-            return W
-
-    def _compute_w_global(self, X, ref):
-        range_ = 1
-        if len(X.shape) == 3:
-            # multiple networks
-            for net in range(X.shape[1]):
-                if len(ref.shape) > 2:
-                    range_ = ref.shape[1]
-                w_global = np.corrcoef(ref[net, ...], X[:, net, :])[range_:, 0:range_]
-        else:
-            # One network
-            if len(ref.shape) > 1:
-                range_ = ref.shape[0]
-            w_global = np.corrcoef(ref, X)[range_:, 0:range_]
-
-        return w_global
+        n_net = st_templates.shape[0]
+        if len(net_data_low.shape) == 2:
+            net_data_low = net_data_low[:, np.newaxis, :]
+        average_template = np.array(self.normalized_net_template[:n_net])
+        rmaps = net_data_low[:, :n_net, :] - average_template[np.newaxis, ...]
+        st_rmap = st_templates - average_template[:, np.newaxis, :]
+        return self._compute_w(rmaps, st_rmap, mask_part)
+
+    def _freeze_templates(self):
+        '''
+            Inference representation of the subtypes: demeaned, centered and unit norm templates (float32)
+        '''
+        n_net = self.st_templates.shape[0]
+        self.average_template = np.ascontiguousarray(self.normalized_net_template[:n_net], dtype=np.float32)
+        st_rmap = self.st_templates - np.array(self.normalized_net_template[:n_net])[:, np.newaxis, :]
+        st_rmap -= st_rmap.mean(2)[..., np.newaxis]
+        norm = np.sqrt((st_rmap ** 2).sum(2))[..., np.newaxis]
+        norm[norm == 0] = 1.
+        self.unit_templates = np.ascontiguousarray(st_rmap / norm, dtype=np.float32)
+
+    def _transform_frozen(self, net_data_low):
+        if getattr(self, 'unit_templates', None) is None:
+            # model fitted before the templates were frozen
+            self._freeze_templates()
+        n_net = self.unit_templates.shape[0]
+        if len(net_data_low.shape) == 2:
+            net_data_low = net_data_low[:, np.newaxis, :]
+        x = net_data_low[:, :n_net, :].astype(np.float32) - self.average_template
+        x -= x.mean(2)[..., np.newaxis]
+        norm = np.sqrt((x ** 2).sum(2))[..., np.newaxis]
+        w = np.swapaxes(np.matmul(np.swapaxes(x, 0, 1), np.swapaxes(self.unit_templates, 1, 2)), 0, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num(w / norm)
 
     def _compute_w(self, X, ref, mask_part=[]):
-        if mask_part != []:
-            # sub_w based on partition
-            w_ = []
-            list_id = np.unique(mask_part)
-            for idx in np.delete(list_id, np.where(list_id == 0)):
-                mask_ = mask_part == idx
-                w_.append(self._compute_w_global(X[..., mask_], ref[..., mask_]))
-            w_ = np.hstack(w_)
-        else:
-            # global mode, no sub-partition
-            w_ = self._compute_w_global(X, ref)
-        return w_
+        if len(X.shape) == 2:
+            # one network
+            return subtype_weights(X[:, np.newaxis, :], ref[np.newaxis, ...], mask_part)[:, 0, :]
+        return subtype_weights(X, ref, mask_part)
 
     def _compute_weights_l2(self, net_data_low):
         corrected_ndl = net_data_low.copy()
@@ -426,7 +501,10 @@ class clusteringST:
         #    W = self._compute_weights_l2(net_data_low)
         #else:
             # calculate the weights for each subjects
-        W = self.compute_weights(net_data_low, self.st_templates, mask_part)
+        if len(mask_part) == 0:
+            W = self._transform_frozen(net_data_low)
+        else:
+            W = self.compute_weights(net_data_low, self.st_templates, mask_part)
 
         if reshape_w:
             return reshapeW(W)
@@ -465,23 +543,79 @@ class clusteringST:
         return self.consensus
 
 
+def _segment_onehot(mask_part, n_vox):
+    # voxels x sub-partitions indicator, a single sub-partition of all the voxels by default
+    if len(mask_part) == 0:
+        return np.ones((n_vox, 1))
+    labels = np.asarray(mask_part).ravel()
+    ids = np.unique(labels)
+    ids = ids[ids != 0]
+    return (labels[:, np.newaxis] == ids[np.newaxis, :]).astype(float)
+
+
+def _segment_center(x, onehot):
+    # remove the mean of each sub-partition
+    means = x.dot(onehot) / onehot.sum(0)
+    return x - means.dot(onehot.T)
+
+
+def subtype_weights(x, templates, mask_part=[]):
+    '''
+        Pearson correlation between the subjects and the subtype templates of each network
+        x:         (subjects x networks x voxels)
+        templates: (networks x subtypes x voxels)
+        mask_part: optional sub-partition of the voxels, the correlations are computed within each sub-partition
+        return (subjects x networks x sub-partitions*subtypes), ordered by sub-partition then subtype
+    '''
+    n_subj, n_net, n_vox = x.shape
+    n_st = templates.shape[1]
+    onehot = _segment_onehot(mask_part, n_vox)
+    n_seg = onehot.shape[1]
+    xc = _segment_center(x, onehot)
+    tc = _segment_center(templates, onehot)
+    x_norm = np.sqrt((xc ** 2).dot(onehot))
+    t_norm = np.sqrt((tc ** 2).dot(onehot))
+    # templates masked by sub-partition (networks x sub-partitions*subtypes x voxels)
+    t_seg = (onehot.T[np.newaxis, :, np.newaxis, :] * tc[:, np.newaxis, :, :]).reshape((n_net, n_seg * n_st, n_vox))
+    cross = np.matmul(np.swapaxes(xc, 0, 1), np.swapaxes(t_seg, 1, 2))
+    cross = np.swapaxes(cross, 0, 1).reshape((n_subj, n_net, n_seg, n_st))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = cross / (x_norm[..., np.newaxis] * np.swapaxes(t_norm, 1, 2)[np.newaxis, ...])
+    return np.nan_to_num(w.reshape((n_subj, n_net, n_seg * n_st)))
+
+
+def fit_network_multi(net_data_low, list_nSubtypes, max_rows=cls.WARD_MAX_ROWS, n_centroids=1000):
+    '''
+        Fit one clusteringST per number of subtypes from a single Ward linkage of the subjects,
+        the same model is returned for repeated numbers of subtypes
+        max_rows, n_centroids: above max_rows subjects the Ward linkage is done on n_centroids k-means centroids
+    '''
+    tree = cls.ward_tree(net_data_low, max_rows, n_centroids)
+    models = {}
+    for nSubtypes in list_nSubtypes:
+        if nSubtypes not in models:
+            models[nSubtypes] = clusteringST()
+            models[nSubtypes].fit_network(net_data_low, nSubtypes=nSubtypes, tree=tree)
+    return [models[nSubtypes] for nSubtypes in list_nSubtypes]
+
+
 def transform_low_scale(ts_data, ind_low_scale, normalize=True):
+    '''
+        ind_low_scale: low scale label of each high scale network, or a compiled proteus.matrix.Atlas
+    '''
+    if not isinstance(ind_low_scale, Atlas):
+        ind_low_scale = Atlas(ind_low_scale)
+    n_low_scale = len(ind_low_scale)
     # compute the connectivity for at template at a given resolution
     allsubj_lowxhigh_conn = []
     for i in range(len(ts_data)):
         ind_data = ts_data[i]
-        tmp_ts_array = []
-        max_id_scale = ind_low_scale.max()
         # compute the time series for the low scale
-        for j in range(max_id_scale):
-            if j == 0:
-                tmp_ts_array = np.mean(ind_data[ind_low_scale == j + 1, :], axis=0)
-            else:
-                tmp_ts_array = np.vstack((tmp_ts_array, np.mean(ind_data[ind_low_scale == j + 1, :], axis=0)))
+        tmp_ts_array = ind_low_scale.get_ts(ind_data)
 
         # calculation of the correlation between each timeseries
         allsubj_lowxhigh_conn.append(
-            np.corrcoef(np.vstack((ind_data, tmp_ts_array)))[-max_id_scale:, :][:, :-max_id_scale])
+            np.corrcoef(np.vstack((ind_data, tmp_ts_array)))[-n_low_scale:, :][:, :-n_low_scale])
     # reorder the dimensions
     allsubj_lowxhigh_conn = np.dstack(allsubj_lowxhigh_conn)
     net_data_low = np.swapaxes(np.swapaxes(allsubj_lowxhigh_conn, 1, 2), 0, 1)
@@ -494,14 +628,7 @@ def transform_low_scale(ts_data, ind_low_scale, normalize=True):
 
 def reshape_netwise(data_scale):
     # Reshape with the following dim: nSubjects, nfeatures, nfeatures
-    for i in range(0, data_scale.shape[0]):
-        if i == 0:
-            all_subjmat = ts.vec2mat(data_scale[i, :])[np.newaxis, ...]
-        else:
-            all_subjmat = np.vstack((all_subjmat, ts.vec2mat(data_scale[i, :])[np.newaxis, ...]))
-
-    # print all_subjmat.shape
-    return all_subjmat
+    return ts.vecs2mats(data_scale)
 
 
 def format_nets(data, select_idx=[]):
@@ -530,3 +657,56 @@ def reshapeW(W):
     # reshape the matrix from [subjects, Nsubtypes, weights] to [subjects, vector of weights]
     xw = W.reshape((W.shape[0], W.shape[1] * W.shape[2]))
     return xw
+
+
+def test_subtype_weights():
+    # reference: np.corrcoef per network and per sub-partition
+    rng = np.random.RandomState(0)
+    x = rng.randn(12, 3, 40)
+    templates = rng.randn(3, 4, 40)
+    templates[1, 2, :] = 1.
+    parts = rng.randint(0, 4, 40)
+    for mask_part in [[], parts]:
+        if len(mask_part) == 0:
+            masks = [np.ones(40, dtype=bool)]
+        else:
+            masks = [mask_part == idx for idx in np.unique(mask_part) if idx != 0]
+        ref = np.zeros((12, 3, 4 * len(masks)))
+        for j in range(3):
+            w_ = [np.corrcoef(templates[j][:, m], x[:, j, m])[4:, :4] for m in masks]
+            ref[:, j, :] = np.nan_to_num(np.hstack(w_))
+        assert np.allclose(subtype_weights(x, templates, mask_part), ref)
+
+        st = clusteringST(verbose=False)
+        st.normalized_net_template = rng.randn(3, 40)
+        # keep the constant template constant once the average is removed
+        st.normalized_net_template[1] = 0.
+        st.st_templates = templates + st.normalized_net_template[:, np.newaxis, :]
+        assert np.allclose(st.compute_weights(x + st.normalized_net_template, mask_part=mask_part), ref)
+        assert np.allclose(st.compute_weights(x[:, 0, :] + st.normalized_net_template[0], st.st_templates[:1],
+                                              mask_part), ref[:, :1, :])
+
+
+def test_robust_st():
+    rng = np.random.RandomState(0)
+    x = np.vstack([c + rng.randn(40, 20) for c in 3 * rng.randn(3, 20)])
+    # reference: sum of the co-assignments of each bootstrap clustering
+    rs = ShuffleSplit(n_splits=10, test_size=.05, random_state=1)
+    ref = np.zeros((120, 120))
+    for train, test in rs.split(x):
+        ind_st = cls.hclustering(x[train, :], 3)
+        ref[np.ix_(train, train)] += ind_st[:, np.newaxis] == ind_st
+    ref /= 10
+
+    st = clusteringST(verbose=False, block_size=50)
+    ind, stab_ = st._robust_st(x, 3, n_iter=10)
+    assert stab_.dtype == np.float32
+    assert np.allclose(stab_, ref)
+    assert len(np.unique(ind)) == 3
+
+    st_sparse = clusteringST(verbose=False, n_jobs=2, sparse_stability=True, stability_prune=0.2, block_size=50)
+    ind_sparse, stab_sparse = st_sparse._robust_st(x, 3, n_iter=10)
+    assert sparse.issparse(stab_sparse)
+    assert np.allclose(stab_sparse.toarray(), np.where(ref >= 0.2, ref, 0))
+    assert stab_sparse.nnz < 120 * 120 / 2
+
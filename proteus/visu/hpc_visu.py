@@ -5,6 +5,7 @@ import seaborn as sns
 from sklearn.metrics import classification_report,accuracy_score
 from sklearn.metrics import roc_curve, auc
 from sklearn import metrics
+from proteus.predic import resampling
 
 def plot_roc(y_test,y_score):
 
@@ -54,22 +55,14 @@ def get_hm_score_(lr,x,hm_y):
 def idx_decision(lr,data):
     return lr.decision_function(data)
 
-def estimate_hitmiss(clf,x,y):
+def estimate_hitmiss(clf,x,y,n_jobs=1):
    
     label=1
-    hm_results = []
-    predictions =[]
-    for i in range(len(y)):
-        train_idx = np.array(np.hstack((np.arange(0,i),np.arange(i+1,len(y)))),dtype=int)
-        #print train_idx.shape
-        clf.fit(x[train_idx,:],y[train_idx])
-        #print clf.predict(x[i,:]) == y[i]
-        hm_results.append(int(clf.predict(x[i,:]) == y[i]))
-        predictions.append(clf.predict(x[i,:]))
-        #hm_results.append(int((y[i] == label) & (clf.predict(x[i,:]) == y[i]) ))#   clf.predict(x[i,:]) == y[i]))
-
-    predictions = np.array(predictions)
-    hm_results = np.array(hm_results)
+    # leave one out
+    splits = [(np.array(np.hstack((np.arange(0,i),np.arange(i+1,len(y)))),dtype=int), np.array([i]))
+              for i in range(len(y))]
+    predictions = np.array(resampling.resample_predict(clf, x, y, splits, n_jobs=n_jobs))
+    hm_results = (predictions[:,0] == y).astype(int)
     #print hm_results.shape
     clf.fit(x,y)
     return hm_results, predictions[:,0]